@@ -1,22 +1,60 @@
 import asyncio
 import datetime
+import heapq
 import logging
-from app.client.mongo import mongo_db
-from app.client.weather import get_weather_by_bbox
-from app.types.zone_types import AutoGroupPayload, Threshold, Zone, ZoneType
+import os
+import socket
+import time
+import uuid
+from pymongo.errors import PyMongoError
+from app.client.mongo import LeaseLostError, mongo_db
+from app.client.weather import get_weather_by_coordinates
+from app.client.weather_cache import snap_to_grid
+from app.metrics import ZONE_REFRESH_DURATION, ZONE_REFRESH_LAG, ZONE_REFRESH_WRITTEN_BYTES
+from app.profiling import profiler
+from app.types.zone_types import AutoGroupPayload, Threshold, Zone, weather_payload, weather_timestamp
+from app.zone_filters import RestrictionPredicate, payload_columns, thresholds_to_restrictions
+from app.zone_index import zone_index
 
 logger = logging.getLogger(__name__)
 
+# OpenWeather current weather is much coarser than sub-zones, sub-zones whose centers fall into
+# the same cell of this size (meters) are refreshed from one upstream call, 0 fetches every sub-zone
+WEATHER_SAMPLE_RESOLUTION = float(os.getenv("WEATHER_SAMPLE_RESOLUTION", "5000"))
+
 
 class Background:
+    """
+    Refreshes weather of auto groups when they are due.
+
+    Groups are kept in a min-heap ordered by `next_refresh`, the task sleeps until the earliest
+    group is due and wakes up immediately on `refresh_zones()` (new groups) or on shutdown.
+    Every due group is refreshed in its own task, so a long refresh doesn't delay other groups.
+    Failed database operations are logged and retried after ERROR_BACKOFF.
+
+    Every process runs its own task, a due group is leased in MongoDB before it is refreshed,
+    so each refresh is done by one worker only. The lease is renewed while the group is refreshed
+    and expires when the worker dies, the refresh stops when the lease is lost to another worker.
+    The full schedule is reloaded periodically to pick up groups created by other workers.
+    """
+
     _refresh_event = asyncio.Event()
-    WAKEUP_TIMEOUT = 60
+    RETRY_DELAY = 60  # seconds until a group which failed to refresh is retried
+    ERROR_BACKOFF = 5  # seconds until the schedule is reloaded after a database error
+    LEASE_TIME = int(os.getenv("REFRESH_LEASE_TIME", "300"))  # seconds a worker may take to refresh a group
+    SCHEDULE_RELOAD = int(os.getenv("REFRESH_SCHEDULE_RELOAD", "300"))  # seconds between full schedule reloads
 
     def __init__(self):
         self._shutdown_event = asyncio.Event()
         self._background_task: asyncio.Task = None
+        self._schedule: list[tuple[datetime.datetime, str]] = []  # heap of (next_refresh, zone id)
+        self._schedule_loaded = datetime.datetime.min
+        self._schedule_changed = asyncio.Event()  # a group task scheduled a refresh
+        self._refreshing: dict[str, asyncio.Task] = {}  # zone id -> task refreshing the group
+        self._worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
 
     async def __aenter__(self):
+        Background._refresh_event = asyncio.Event()
         self._background_task = asyncio.create_task(self.run())
         return self
 
@@ -28,61 +66,304 @@ class Background:
     def refresh_zones(cls):
         cls._refresh_event.set()
 
-    async def _event_aware_wait(self, timeout) -> bool:
-        countdown = timeout
-        while countdown > 0:
-            await asyncio.sleep(1)
-            countdown -= 1
-            if self._shutdown_event.is_set():
-                return False
-            elif self._refresh_event.is_set():
-                self._refresh_event.clear()
-                return True
+    async def _wait_until_due(self) -> bool:
+        """
+        Waits until the earliest scheduled group is due, a refresh is requested or shutdown.
+        Returns False on shutdown.
+        """
+        wake_up = self._schedule_loaded + datetime.timedelta(seconds=Background.SCHEDULE_RELOAD)
+        if self._schedule:
+            wake_up = min(wake_up, self._schedule[0][0])
+        timeout = max((wake_up - datetime.datetime.now()).total_seconds(), 0)
+
+        if timeout != 0:
+            waiters = [
+                asyncio.create_task(self._shutdown_event.wait()),
+                asyncio.create_task(self._refresh_event.wait()),
+                asyncio.create_task(self._schedule_changed.wait()),
+            ]
+            await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+
+        self._schedule_changed.clear()
+        return not self._shutdown_event.is_set()
+
+    async def _backoff(self):
+        """Waits ERROR_BACKOFF seconds or until shutdown."""
+        try:
+            await asyncio.wait_for(self._shutdown_event.wait(), timeout=Background.ERROR_BACKOFF)
+        except asyncio.TimeoutError:
+            pass
+
+    def _schedule_refresh(self, next_refresh: datetime.datetime, zone_id: str):
+        heapq.heappush(self._schedule, (next_refresh, zone_id))
+        self._schedule_changed.set()
+
+    async def _load_schedule(self, zone_ids: list[str] = None):
+        """Schedules all auto groups, or re-schedules the given ones, from next_refresh stored in the database."""
+        schedule = await mongo_db.get_refresh_schedule(zone_ids)
+        if zone_ids is None:
+            self._schedule = schedule
+            self._schedule_loaded = datetime.datetime.now()
+            heapq.heapify(self._schedule)
+        else:
+            for entry in schedule:
+                heapq.heappush(self._schedule, entry)
+
+    def _pop_due(self, now: datetime.datetime) -> dict[str, datetime.datetime]:
+        """
+        Removes due groups from the schedule, returns their IDs with the time they became due.
+        Groups being refreshed are skipped, their task schedules the next refresh.
+        """
+        due = {}
+        while self._schedule and self._schedule[0][0] <= now:
+            next_refresh, zone_id = heapq.heappop(self._schedule)
+            if zone_id not in self._refreshing:
+                due.setdefault(zone_id, next_refresh)
+        return due
+
+    async def run(self):
+        reload_interval = datetime.timedelta(seconds=Background.SCHEDULE_RELOAD)
+        try:
+            while await self._wait_until_due():
+                now = datetime.datetime.now()
+                if self._refresh_event.is_set() or now - self._schedule_loaded >= reload_interval:
+                    self._refresh_event.clear()
+                    try:
+                        await self._load_schedule()
+                    except PyMongoError as e:
+                        logger.error("Loading the refresh schedule failed, retrying", exc_info=e)
+                        Background._refresh_event.set()
+                        await self._backoff()
+                        continue
+
+                # all due groups are refreshed concurrently, the weather client limits the upstream load
+                for zone_id, due_at in self._pop_due(now).items():
+                    self._refreshing[zone_id] = asyncio.create_task(self._refresh_due(zone_id, due_at, now))
+        finally:
+            # on shutdown, interrupted refreshes are retried once their lease expires
+            for task in self._refreshing.values():
+                task.cancel()
+            await asyncio.gather(*self._refreshing.values(), return_exceptions=True)
+
+    async def _refresh_due(self, zone_id: str, due_at: datetime.datetime, now: datetime.datetime):
+        """Leases and refreshes a due group, then schedules its next refresh."""
+        try:
+            with profiler.maybe_profile("background refresh"):
+                try:
+                    zone = await mongo_db.claim_zone_for_refresh(zone_id, now, self._worker_id, Background.LEASE_TIME)
+                    if zone is None:
+                        # deleted, re-scheduled or leased by another worker in the meantime
+                        await self._load_schedule([zone_id])
+                        self._schedule_changed.set()
+                        return
+                except PyMongoError as e:
+                    logger.error("Claiming zone %s for refresh failed", zone_id, exc_info=e)
+                    retry_at = datetime.datetime.now() + datetime.timedelta(seconds=Background.ERROR_BACKOFF)
+                    self._schedule_refresh(retry_at, zone_id)
+                    return
+
+                ZONE_REFRESH_LAG.observe((now - due_at).total_seconds())
+                await self._refresh_group(zone)
+                self._schedule_refresh(zone.payload.next_refresh, zone.id)
+        finally:
+            self._refreshing.pop(zone_id, None)
+
+    async def _refresh_group(self, zone: Zone) -> bool:
+        logger.debug("Refreshing weather for zone %s - %s", zone.name, zone.id)
+        started = time.perf_counter()
+        payload: AutoGroupPayload = zone.payload
+        try:
+            if payload.grid is not None:
+                changed, samples, fetched_at = await self._with_lease(zone.id, self._refresh_grid(payload))
+            else:
+                changed, samples, fetched_at = await self._with_lease(zone.id, self._refresh_sub_zones(payload))
+
+            # the group is as fresh as its oldest weather sample, which may have come from the weather cache
+            zone.weather_updated_at = fetched_at
+            if payload.grid is not None:
+                payload.grid.updated_at = fetched_at
+            for sub_zone in payload.zones:
+                sub_zone.weather_updated_at = fetched_at
+            payload.next_refresh = weather_timestamp() + datetime.timedelta(seconds=payload.refresh_rate)
+
+            bytes_written = await mongo_db.update_refreshed_sub_zones(zone, changed, self._worker_id)
+            zone_index.upsert(zone)
+        except LeaseLostError as e:
+            # another worker refreshes the group, it is re-scheduled from the database when due here
+            logger.warning("Refreshing weather for zone %s - %s stopped: %s", zone.name, zone.id, e)
+            payload.next_refresh = datetime.datetime.now() + datetime.timedelta(seconds=Background.RETRY_DELAY)
+            ZONE_REFRESH_DURATION.observe(time.perf_counter() - started, result="lease_lost")
+            return False
+        except Exception as e:
+            logger.error("Refreshing weather for zone %s - %s failed", zone.name, zone.id, exc_info=e)
+            payload.next_refresh = datetime.datetime.now() + datetime.timedelta(seconds=Background.RETRY_DELAY)
+            try:
+                await mongo_db.release_zone_lease(zone.id, self._worker_id, payload.next_refresh)
+            except PyMongoError as release_error:
+                # the group becomes due again when the lease expires
+                logger.error("Releasing the lease of zone %s failed", zone.id, exc_info=release_error)
+            ZONE_REFRESH_DURATION.observe(time.perf_counter() - started, result="error")
+            return False
+
+        duration = time.perf_counter() - started
+        ZONE_REFRESH_DURATION.observe(duration, result="success")
+        ZONE_REFRESH_WRITTEN_BYTES.observe(bytes_written)
 
+        # one record per group refresh, the values are also attached as fields for structured handlers
+        summary = {
+            "zone_id": zone.id,
+            "sub_zones": payload.grid.cell_count if payload.grid is not None else len(payload.zones),
+            "changed": len(changed),
+            "weather_samples": samples,
+            "bytes_written": bytes_written,
+            "duration": duration,
+        }
+        logger.info(
+            "Refreshed weather for zone %s - %s: %d/%d sub-zones changed from %d weather samples, "
+            "%d bytes written in %.2f s",
+            zone.name,
+            zone.id,
+            summary["changed"],
+            summary["sub_zones"],
+            samples,
+            bytes_written,
+            duration,
+            extra={"refresh": summary},
+        )
         return True
 
-    def _load_zones_for_refresh(self):
-        return mongo_db._zones.find(
-            {
-                "zone_type": ZoneType.AUTO_GROUP,
-                "payload.next_refresh": {"$lt": datetime.datetime.now()},
-            }
+    async def _with_lease(self, zone_id: str, coroutine):
+        """
+        Awaits the coroutine while the lease of the group is renewed every third of LEASE_TIME.
+        When the lease is lost the coroutine is cancelled and LeaseLostError is raised.
+        """
+        work = asyncio.create_task(coroutine)
+        lost = False
+
+        async def renew():
+            nonlocal lost
+            while True:
+                await asyncio.sleep(Background.LEASE_TIME / 3)
+                try:
+                    renewed = await mongo_db.renew_zone_lease(zone_id, self._worker_id, Background.LEASE_TIME)
+                except PyMongoError as e:
+                    # the lease is still valid, the renewal is retried with the next one
+                    logger.warning("Renewing the lease of zone %s failed", zone_id, exc_info=e)
+                    continue
+                if not renewed:
+                    lost = True
+                    work.cancel()
+                    return
+
+        renewal = asyncio.create_task(renew())
+        try:
+            return await work
+        except asyncio.CancelledError:
+            if lost:
+                raise LeaseLostError(f"Zone {zone_id} is no longer leased by {self._worker_id}")
+            raise
+        finally:
+            renewal.cancel()
+            work.cancel()
+
+    async def _refresh_sub_zones(self, payload: AutoGroupPayload) -> tuple[list[int], int, datetime.datetime]:
+        """
+        Refreshes sub-zones listed in payload.zones, returns positions of changed sub-zones,
+        the number of weather samples fetched and the fetch time of the oldest one.
+        """
+        previous = [(sub_zone.active, sub_zone.payload) for sub_zone in payload.zones]
+        samples, fetched_at = await self._refresh_zone_weather(payload.zones)
+        if payload.threshold:
+            self._evaluate_weather_thresholds(payload.zones, payload.threshold)
+
+        # only sub-zones whose weather or active flag changed are written
+        changed = [
+            position
+            for position, (sub_zone, (active, weather)) in enumerate(zip(payload.zones, previous))
+            if sub_zone.active != active or sub_zone.payload != weather
+        ]
+        return changed, samples, fetched_at
+
+    async def _refresh_grid(self, payload: AutoGroupPayload) -> tuple[list[int], int, datetime.datetime]:
+        """
+        Refreshes cells of a compact sub-zone grid column-wise, returns positions of changed cells,
+        the number of weather samples fetched and the fetch time of the oldest one.
+        """
+        grid = payload.grid
+        previous_active = list(grid.active) or [False] * grid.cell_count
+        previous_metrics = {name: list(values) for name, values in grid.metrics.items()}
+
+        sw_lat, sw_lon, ne_lat, ne_lon = grid.cell_bounds()
+        samples = group_positions_by_sample_point(
+            (sw_lat + ne_lat) / 2, (sw_lon + ne_lon) / 2, WEATHER_SAMPLE_RESOLUTION
         )
+        weathers = await asyncio.gather(*(get_weather_by_coordinates(lat, lon) for lat, lon in samples))
+        for positions, (weather, _) in zip(samples.values(), weathers):
+            sample_payload = weather_payload(payload.sub_zone_type, weather) if weather else None
+            grid.set_payload(positions, sample_payload, payload.sub_zone_type)
 
-    async def run(self):
-        while await self._event_aware_wait(Background.WAKEUP_TIMEOUT):
-            async for zone_doc in self._load_zones_for_refresh():
-                zone = Zone(**zone_doc)
-                logging.info(f"Refreshing weather for zone {zone.name} - {str(zone.id)}")
-                payload: AutoGroupPayload = zone.payload
-                await self._refresh_zone_weather(payload.zones)
-                # self._evaluate_weather_thresholds(payload.zones, payload.threshold)
-                payload.next_refresh = datetime.datetime.now() + datetime.timedelta(seconds=payload.refresh_rate)
-                await mongo_db.update_zone(zone)
-
-    async def _refresh_zone_weather(self, zones: list[Zone]):
-        for zone in zones:
-            weather = await get_weather_by_bbox(zone.bbox)
-            zone.set_weather_payload(weather)
+        if payload.threshold:
+            predicate = RestrictionPredicate(thresholds_to_restrictions(payload.threshold))
+            grid.active = predicate.evaluate(grid.metric_columns(), grid.cell_count).tolist()
+        elif len(grid.active) != grid.cell_count:
+            grid.active = previous_active
+
+        logger.debug("Fetched %d weather samples for %d grid cells", len(samples), grid.cell_count)
+
+        # only cells whose weather or active flag changed count as changed
+        changed = {position for position, flags in enumerate(zip(grid.active, previous_active)) if flags[0] != flags[1]}
+        for name, values in grid.metrics.items():
+            previous_values = previous_metrics.get(name) or [None] * grid.cell_count
+            changed.update(position for position, pair in enumerate(zip(values, previous_values)) if pair[0] != pair[1])
+        return (
+            sorted(changed),
+            len(samples),
+            min((fetched_at for _, fetched_at in weathers), default=weather_timestamp()),
+        )
+
+    async def _refresh_zone_weather(self, zones: list[Zone]) -> tuple[int, datetime.datetime]:
+        # sub-zones sharing an upstream sample point get the same response
+        samples = group_by_sample_point(zones, WEATHER_SAMPLE_RESOLUTION)
+        weathers = await asyncio.gather(*(get_weather_by_coordinates(lat, lon) for lat, lon in samples))
+        for sample_zones, (weather, fetched_at) in zip(samples.values(), weathers):
+            for zone in sample_zones:
+                zone.set_weather_payload(weather, fetched_at)
+
+        logger.debug("Fetched %d weather samples for %d sub-zones", len(samples), len(zones))
+        return len(samples), min((fetched_at for _, fetched_at in weathers), default=weather_timestamp())
 
     def _evaluate_weather_thresholds(self, zones: list[Zone], thresholds: dict[str, Threshold]):
-        for zone in zones:
-            zone.active = False  # inactivate before evaluation
+        """
+        A sub-zone becomes active when any of the thresholds is exceeded by its weather.
+        """
+        predicate = RestrictionPredicate(thresholds_to_restrictions(thresholds))
+        active = predicate.evaluate(payload_columns(zones, predicate.fields), len(zones))
+        for zone, zone_active in zip(zones, active.tolist()):
+            zone.active = zone_active
 
-            for field, threshold in thresholds.items():
-                if not getattr(zone.payload, field):
-                    continue
 
-                active = False
-                if threshold.condition == ">":
-                    active = getattr(zone.payload, field) > threshold.limit
-                elif threshold.condition == ">=":
-                    active = getattr(zone.payload, field) >= threshold.limit
-                elif threshold.condition == "<":
-                    active = getattr(zone.payload, field) < threshold.limit
-                elif threshold.condition == "<=":
-                    active = getattr(zone.payload, field) <= threshold.limit
-
-                if active is True:
-                    zone.active = True
-                    break  # don't evaluate other thresholds
+def group_by_sample_point(zones: list[Zone], resolution: float) -> dict[tuple[float, float], list[Zone]]:
+    """
+    Groups zones by the upstream sample point their center maps to at the given resolution (meters).
+    """
+    center_lat = [(zone.bbox.south_west.lat + zone.bbox.north_east.lat) / 2 for zone in zones]
+    center_lon = [(zone.bbox.south_west.lon + zone.bbox.north_east.lon) / 2 for zone in zones]
+    return {
+        point: [zones[position] for position in positions]
+        for point, positions in group_positions_by_sample_point(center_lat, center_lon, resolution).items()
+    }
+
+
+def group_positions_by_sample_point(center_lat, center_lon, resolution: float) -> dict[tuple[float, float], list[int]]:
+    """
+    Groups positions of zone centers by the upstream sample point they map to at the given resolution (meters).
+    """
+    samples: dict[tuple[float, float], list[int]] = {}
+    for position, (lat, lon) in enumerate(zip(center_lat, center_lon)):
+        lat, lon = float(lat), float(lon)
+        point = snap_to_grid(lat, lon, resolution) if resolution > 0 else (lat, lon)
+        samples.setdefault(point, []).append(position)
+
+    return samples
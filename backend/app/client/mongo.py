@@ -1,49 +1,545 @@
+import asyncio
+import bson
+import datetime
 import logging
 import os
-from typing import Optional
+from typing import AsyncIterator, Optional
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorClient
-from app.types.zone_types import Zone
+from pymongo import ASCENDING, GEOSPHERE, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+from app.metrics import MONGO_OPERATION_DURATION, timed
+from app.types.zone_types import Zone, ZoneBBox, ZoneType
 
 logger = logging.getLogger(__name__)
 
 MONGODB_CONNECTION_STRING = os.getenv("MONGODB_CONNECTION_STRING")
 
+# "embedded" keeps auto group sub-zones inside the parent document,
+# "collection" stores every sub-zone as its own geo-indexed document in the sub_zones collection
+SUB_ZONE_STORAGE = os.getenv("SUB_ZONE_STORAGE", "embedded")
+SUB_ZONE_STORAGE_MODES = {"embedded", "collection"}
+
+# maximum number of sub-zones written by one update of an auto group refresh
+REFRESH_WRITE_BATCH = int(os.getenv("REFRESH_WRITE_BATCH", "1000"))
+# number of zone documents read from the cursor at once when zones are iterated
+ZONE_READ_BATCH = int(os.getenv("ZONE_READ_BATCH", "100"))
+
+
+class LeaseLostError(Exception):
+    """The auto group being refreshed is no longer leased by the worker, it was deleted or its lease expired."""
+
 
 class MongoDB(object):
     def __init__(self) -> None:
         if not MONGODB_CONNECTION_STRING:
             raise ValueError("MONGODB_CONNECTION_STRING is not set. Please set it in your environment variables.")
 
+        if SUB_ZONE_STORAGE not in SUB_ZONE_STORAGE_MODES:
+            raise ValueError(f"SUB_ZONE_STORAGE must be one of {sorted(SUB_ZONE_STORAGE_MODES)}.")
+
         self._client = AsyncIOMotorClient(MONGODB_CONNECTION_STRING, uuidRepresentation="standard")
         self._db = self._client["gaof-db"]
         self._zones = self._db["zones"]
+        self._sub_zones = self._db["sub_zones"]
+        self.sub_zone_storage = SUB_ZONE_STORAGE
+
+    @property
+    def uses_sub_zone_collection(self) -> bool:
+        return self.sub_zone_storage == "collection"
+
+    async def init(self):
+        """
+        Prepares the database for the configured storage mode.
+        In the collection mode it creates the geo indexes and moves sub-zones out of
+        auto groups which were stored in the embedded mode.
+        """
+        if not self.uses_sub_zone_collection:
+            return
+
+        await self._zones.create_index([("geometry", GEOSPHERE)])
+        await self._sub_zones.create_index([("geometry", GEOSPHERE)])
+        await self._sub_zones.create_index([("parent_id", ASCENDING), ("position", ASCENDING)])
+        await self.migrate_embedded_sub_zones()
+
+    async def migrate_embedded_sub_zones(self) -> int:
+        """
+        Moves sub-zones embedded in auto group documents into the sub_zones collection
+        and adds geometry to zones stored without it. Safe to run repeatedly.
+
+        Returns:
+            int: The number of migrated auto groups.
+        """
+        migrated = 0
+        async for zone_doc in self._zones.find({"geometry": {"$exists": False}}):
+            zone = Zone(**zone_doc)
+            update = {"$set": {"geometry": bbox_to_geometry(zone.bbox)}}
+
+            if zone.zone_type == ZoneType.AUTO_GROUP and zone.payload and (zone.payload.zones or zone.payload.grid):
+                zone.payload.expand_grid(zone.name)
+                await self._sub_zones.delete_many({"parent_id": zone_doc["_id"]})
+                await self._insert_sub_zones([zone])
+                update["$unset"] = {"payload.zones": "", "payload.grid": ""}
+                migrated += 1
 
+            await self._zones.update_one({"_id": zone_doc["_id"]}, update)
+
+        if migrated:
+            logger.info(f"Migrated sub-zones of {migrated} auto groups into the sub_zones collection")
+
+        return migrated
+
+    @timed(MONGO_OPERATION_DURATION)
     async def get_zone(self, zone_id: str) -> Optional[Zone]:
         zone_doc = await self._zones.find_one({"_id": ObjectId(zone_id)})
         if zone_doc:
+            await self._load_sub_zones([zone_doc])
             return Zone(**zone_doc)
 
         return None
 
+    @timed(MONGO_OPERATION_DURATION)
     async def insert_zone(self, zone: Zone) -> Zone:
-        zone_dict = zone.model_dump(exclude_none=True, exclude={"id"}, by_alias=True)
+        if self._stores_sub_zones(zone):
+            # sub-zones are stored as documents with their geometry, a compact grid has none
+            await asyncio.to_thread(zone.payload.expand_grid, zone.name)
+
+        zone_dict = self._zone_document(zone)
+        zone_dict.pop("_id", None)
         result = await self._zones.insert_one(zone_dict)
         zone.id = str(result.inserted_id)
+
+        if self._stores_sub_zones(zone):
+            await self._insert_sub_zones([zone])
+
         return zone
 
+    @timed(MONGO_OPERATION_DURATION)
+    async def insert_zones(self, zones: list[Zone]) -> list[Optional[str]]:
+        """
+        Inserts many zones with one unordered insert_many, a failed zone doesn't stop the others.
+        IDs are assigned to the zones before the insert.
+
+        Returns:
+            list[Optional[str]]: For each zone None when it was inserted, otherwise the error message.
+        """
+        if not zones:
+            return []
+
+        for zone in zones:
+            zone.id = str(ObjectId())
+            if self._stores_sub_zones(zone):
+                await asyncio.to_thread(zone.payload.expand_grid, zone.name)
+
+        errors: list[Optional[str]] = [None] * len(zones)
+        zone_docs = [self._zone_document(zone) for zone in zones]
+        for zone_doc in zone_docs:
+            zone_doc["_id"] = ObjectId(zone_doc["_id"])
+
+        try:
+            await self._zones.insert_many(zone_docs, ordered=False)
+        except BulkWriteError as e:
+            for write_error in e.details.get("writeErrors", []):
+                errors[write_error["index"]] = write_error.get("errmsg", "Insert failed")
+                zones[write_error["index"]].id = None
+
+        await self._insert_sub_zones(
+            [zone for zone, error in zip(zones, errors) if error is None and self._stores_sub_zones(zone)]
+        )
+        return errors
+
+    @timed(MONGO_OPERATION_DURATION)
     async def update_zone(self, zone: Zone) -> bool:
-        zone_dict = zone.model_dump(exclude_none=True, by_alias=True)
+        if self._stores_sub_zones(zone):
+            await asyncio.to_thread(zone.payload.expand_grid, zone.name)
+
+        zone_dict = self._zone_document(zone)
         zone_id = zone_dict.pop("_id")
         result = await self._zones.update_one({"_id": ObjectId(zone_id)}, {"$set": zone_dict})
+
+        if result.matched_count > 0 and self._stores_sub_zones(zone):
+            await self._update_sub_zones(zone)
+
+        return result.matched_count > 0
+
+    @timed(MONGO_OPERATION_DURATION)
+    async def update_refreshed_sub_zones(
+        self, zone: Zone, changed: list[int], lease_owner: Optional[str] = None
+    ) -> int:
+        """
+        Writes the result of an auto group refresh: weather payload with the active flag of the changed
+        sub-zones only (positions in payload.zones) and finally next_refresh of the group.
+        A compact grid is written as a whole when any of its cells changed.
+        weather_updated_at of the group and of all its sub-zones is set to that of the group.
+        With `lease_owner` the group is written only while the lease is held and the lease is released.
+
+        Returns:
+            int: The number of BSON bytes sent in the update documents.
+
+        Raises:
+            LeaseLostError: With `lease_owner`, when the lease is not held, nothing of the group is written then.
+        """
+        group_filter = {"_id": ObjectId(zone.id)}
+        if lease_owner is not None:
+            group_filter["lease.owner"] = lease_owner
+
+        next_refresh = {
+            "$set": {"payload.next_refresh": zone.payload.next_refresh, "weather_updated_at": zone.weather_updated_at},
+            "$unset": {"lease": ""},
+        }
+        bytes_written = len(bson.encode(next_refresh))
+
+        if (grid := zone.payload.grid) is not None:
+            next_refresh["$set"]["payload.grid.updated_at"] = grid.updated_at
+            bytes_written = len(bson.encode(next_refresh))
+            if changed:
+                next_refresh["$set"]["payload.grid.active"] = grid.active
+                next_refresh["$set"]["payload.grid.metrics"] = grid.metrics
+                bytes_written = len(bson.encode(next_refresh))
+            result = await self._zones.update_one(group_filter, next_refresh)
+            self._check_lease(zone, lease_owner, result.matched_count == 1)
+            return bytes_written
+
+        if self.uses_sub_zone_collection:
+            # sub-zones are written before the group, a worker which lost the lease must not overwrite them
+            if lease_owner is not None:
+                held = await self._zones.find_one(group_filter, {"_id": 1}) is not None
+                self._check_lease(zone, lease_owner, held)
+
+            operations = []
+            for position in changed:
+                sub_zone = zone.payload.zones[position]
+                update = sub_zone_refresh_update(sub_zone, "")
+                bytes_written += len(bson.encode(update))
+                operations.append(UpdateOne({"_id": ObjectId(sub_zone.id)}, update))
+
+            for batch_start in range(0, len(operations), REFRESH_WRITE_BATCH):
+                await self._sub_zones.bulk_write(
+                    operations[batch_start : batch_start + REFRESH_WRITE_BATCH], ordered=False
+                )
+            await self._sub_zones.update_many(
+                {"parent_id": ObjectId(zone.id)}, {"$set": {"weather_updated_at": zone.weather_updated_at}}
+            )
+            result = await self._zones.update_one(group_filter, next_refresh)
+            self._check_lease(zone, lease_owner, result.matched_count == 1)
+            return bytes_written
+
+        # embedded sub-zones are updated in place by their position in the array
+        if zone.payload.zones:
+            next_refresh["$set"]["payload.zones.$[].weather_updated_at"] = zone.weather_updated_at
+            bytes_written = len(bson.encode(next_refresh))
+        operations = []
+        for batch_start in range(0, len(changed), REFRESH_WRITE_BATCH):
+            update = {"$set": {}, "$unset": {}}
+            for position in changed[batch_start : batch_start + REFRESH_WRITE_BATCH]:
+                sub_zone_update = sub_zone_refresh_update(zone.payload.zones[position], f"payload.zones.{position}.")
+                for operator, fields in sub_zone_update.items():
+                    update[operator].update(fields)
+
+            update = {operator: fields for operator, fields in update.items() if fields}
+            bytes_written += len(bson.encode(update))
+            operations.append(UpdateOne(group_filter, update))
+
+        operations.append(UpdateOne(group_filter, next_refresh))
+        result = await self._zones.bulk_write(operations, ordered=True)
+        # every update matches the group while the lease is held
+        self._check_lease(zone, lease_owner, result.matched_count == len(operations))
+        return bytes_written
+
+    @staticmethod
+    def _check_lease(zone: Zone, lease_owner: Optional[str], held: bool):
+        if lease_owner is not None and not held:
+            raise LeaseLostError(f"Zone {zone.id} is no longer leased by {lease_owner}")
+
+    @timed(MONGO_OPERATION_DURATION)
+    async def claim_zone_for_refresh(
+        self, zone_id: str, now: datetime.datetime, owner: str, lease_seconds: float
+    ) -> Optional[Zone]:
+        """
+        Atomically leases a due auto group for refreshing. The lease moves next_refresh to the lease
+        expiry, so other workers don't see the group as due, and when the owner dies without
+        releasing it the group becomes due again after the expiry.
+
+        Returns:
+            Optional[Zone]: The leased group, or None when it is not due or leased by another worker.
+        """
+        expires = now + datetime.timedelta(seconds=lease_seconds)
+        zone_doc = await self._zones.find_one_and_update(
+            {
+                "_id": ObjectId(zone_id),
+                "zone_type": ZoneType.AUTO_GROUP,
+                "payload.next_refresh": {"$lte": now},
+            },
+            {"$set": {"payload.next_refresh": expires, "lease": {"owner": owner, "expires": expires}}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if zone_doc is None:
+            return None
+
+        await self._load_sub_zones([zone_doc])
+        return Zone(**zone_doc)
+
+    @timed(MONGO_OPERATION_DURATION)
+    async def renew_zone_lease(self, zone_id: str, owner: str, lease_seconds: float) -> bool:
+        """Extends a held lease to `lease_seconds` from now, returns False when the lease is not held."""
+        expires = datetime.datetime.now() + datetime.timedelta(seconds=lease_seconds)
+        result = await self._zones.update_one(
+            {"_id": ObjectId(zone_id), "lease.owner": owner},
+            {"$set": {"payload.next_refresh": expires, "lease.expires": expires}},
+        )
         return result.matched_count > 0
 
+    @timed(MONGO_OPERATION_DURATION)
+    async def release_zone_lease(self, zone_id: str, owner: str, next_refresh: datetime.datetime) -> bool:
+        """Releases a lease without storing a refresh, the group becomes due at next_refresh."""
+        result = await self._zones.update_one(
+            {"_id": ObjectId(zone_id), "lease.owner": owner},
+            {"$set": {"payload.next_refresh": next_refresh}, "$unset": {"lease": ""}},
+        )
+        return result.matched_count > 0
+
+    @timed(MONGO_OPERATION_DURATION)
+    async def request_refresh(self, zone_id: str, now: datetime.datetime) -> bool:
+        """
+        Makes an auto group due at `now` unless it is due earlier or leased by a worker,
+        the background tasks pick it up after their schedule is reloaded.
+
+        Returns:
+            bool: True when next_refresh of the group was moved.
+        """
+        result = await self._zones.update_one(
+            {
+                "_id": ObjectId(zone_id),
+                "zone_type": ZoneType.AUTO_GROUP,
+                "lease": {"$exists": False},
+                "payload.next_refresh": {"$gt": now},
+            },
+            {"$set": {"payload.next_refresh": now}},
+        )
+        return result.modified_count > 0
+
+    @timed(MONGO_OPERATION_DURATION)
     async def get_all_zones(self) -> list[Zone]:
-        return [Zone(**zone_doc) for zone_doc in await self._zones.find().to_list()]
+        zone_docs = await self._zones.find().to_list()
+        await self._load_sub_zones(zone_docs)
+        return [Zone(**zone_doc) for zone_doc in zone_docs]
+
+    async def iter_zone_documents(
+        self, after: Optional[str] = None, limit: Optional[int] = None, include_sub_zones: bool = True
+    ) -> AsyncIterator[dict]:
+        """
+        Iterates raw zone documents ordered by _id, reading the cursor in batches so only
+        one batch is held in memory.
+
+        Args:
+            after (Optional[str]): Only zones with _id greater than this id are returned.
+            limit (Optional[int]): The maximum number of returned zones.
+            include_sub_zones (bool): When False payload.zones and payload.grid of auto groups are not read.
+        """
+        query = {"_id": {"$gt": ObjectId(after)}} if after is not None else {}
+        projection = {"geometry": 0, "lease": 0} if self.uses_sub_zone_collection else {"lease": 0}
+        if not include_sub_zones:
+            projection["payload.zones"] = 0
+            projection["payload.grid"] = 0
+
+        cursor = self._zones.find(query, projection).sort("_id", ASCENDING).batch_size(ZONE_READ_BATCH)
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        batch = []
+        async for zone_doc in cursor:
+            batch.append(zone_doc)
+            if len(batch) >= ZONE_READ_BATCH:
+                if include_sub_zones:
+                    await self._load_sub_zones(batch)
+                for batch_doc in batch:
+                    yield batch_doc
+                batch = []
+
+        if include_sub_zones:
+            await self._load_sub_zones(batch)
+        for batch_doc in batch:
+            yield batch_doc
+
+    def watch_zones(self, resume_after: Optional[dict] = None):
+        """
+        Change stream of the zone collection, updates carry the whole zone document.
+        Raises OperationFailure on the first iteration when the server doesn't support change streams.
+        """
+        return self._zones.watch(full_document="updateLookup", resume_after=resume_after)
+
+    @timed(MONGO_OPERATION_DURATION)
+    async def get_refresh_schedule(self, zone_ids: Optional[list[str]] = None) -> list[tuple[datetime.datetime, str]]:
+        """
+        Returns (next_refresh, zone id) of all auto groups or of the given ones.
+        """
+        query = {"zone_type": ZoneType.AUTO_GROUP}
+        if zone_ids is not None:
+            query["_id"] = {"$in": [ObjectId(zone_id) for zone_id in zone_ids]}
+
+        return [
+            (zone_doc["payload"].get("next_refresh", datetime.datetime.min), str(zone_doc["_id"]))
+            async for zone_doc in self._zones.find(query, {"payload.next_refresh": 1})
+        ]
+
+    @timed(MONGO_OPERATION_DURATION)
+    async def find_zone_documents_near(self, lat: float, lon: float, radius: float) -> list[dict]:
+        """
+        Finds zones and sub-zones whose geometry is within radius (meters) of the point
+        using the 2dsphere indexes. Available only in the collection storage mode.
+
+        Returns:
+            list[dict]: Raw zone documents ordered by the distance from the point.
+        """
+        geo_near = {
+            "near": {"type": "Point", "coordinates": [lon, lat]},
+            "distanceField": "distance",
+            "maxDistance": radius,
+            "spherical": True,
+            "key": "geometry",
+        }
+
+        zone_docs = await self._zones.aggregate(
+            [{"$geoNear": {**geo_near, "query": {"zone_type": {"$ne": ZoneType.AUTO_GROUP}}}}]
+        ).to_list()
+        sub_zone_docs = await self._sub_zones.aggregate([{"$geoNear": geo_near}]).to_list()
+
+        return sorted(zone_docs + sub_zone_docs, key=lambda doc: doc["distance"])
+
+    @timed(MONGO_OPERATION_DURATION)
+    async def find_zone_documents_in_boxes(self, boxes: list[tuple[float, float, float, float]]) -> list[dict]:
+        """
+        Finds zones and sub-zones whose geometry intersects any of the (lat_min, lat_max, lon_min, lon_max)
+        boxes using the 2dsphere indexes. Available only in the collection storage mode.
+
+        Returns:
+            list[dict]: Raw zone documents, zones first and then sub-zones.
+        """
+        area = {
+            "type": "MultiPolygon",
+            "coordinates": [
+                [[[lon_min, lat_min], [lon_max, lat_min], [lon_max, lat_max], [lon_min, lat_max], [lon_min, lat_min]]]
+                for lat_min, lat_max, lon_min, lon_max in boxes
+            ],
+        }
+        query = {"geometry": {"$geoIntersects": {"$geometry": area}}}
+        projection = {"geometry": 0, "lease": 0}
+
+        zone_docs = await self._zones.find({**query, "zone_type": {"$ne": ZoneType.AUTO_GROUP}}, projection).to_list()
+        sub_zone_docs = await self._sub_zones.find(query, projection).to_list()
+        return zone_docs + sub_zone_docs
+
+    @timed(MONGO_OPERATION_DURATION)
+    async def delete_zones(self, zone_ids: list[str]) -> set[str]:
+        """
+        Deletes many zones with one delete_many.
+
+        Returns:
+            set[str]: IDs of the zones which existed and were deleted.
+        """
+        object_ids = [ObjectId(zone_id) for zone_id in zone_ids]
+        existing = [zone_doc["_id"] async for zone_doc in self._zones.find({"_id": {"$in": object_ids}}, {"_id": 1})]
+        if not existing:
+            return set()
 
+        await self._zones.delete_many({"_id": {"$in": existing}})
+        if self.uses_sub_zone_collection:
+            await self._sub_zones.delete_many({"parent_id": {"$in": existing}})
+
+        return {str(zone_id) for zone_id in existing}
+
+    @timed(MONGO_OPERATION_DURATION)
     async def delete_zone(self, zone_id: str) -> bool:
         result = await self._zones.delete_one({"_id": ObjectId(zone_id)})
+        if result.deleted_count > 0 and self.uses_sub_zone_collection:
+            await self._sub_zones.delete_many({"parent_id": ObjectId(zone_id)})
+
         return result.deleted_count > 0
 
+    def _stores_sub_zones(self, zone: Zone) -> bool:
+        return self.uses_sub_zone_collection and zone.zone_type == ZoneType.AUTO_GROUP and zone.payload is not None
+
+    def _zone_document(self, zone: Zone) -> dict:
+        if not self.uses_sub_zone_collection:
+            return zone.model_dump(exclude_none=True, by_alias=True)
+
+        exclude = {"payload": {"zones"}} if self._stores_sub_zones(zone) else None
+        zone_dict = zone.model_dump(exclude_none=True, by_alias=True, exclude=exclude)
+        zone_dict["geometry"] = bbox_to_geometry(zone.bbox)
+        return zone_dict
+
+    async def _insert_sub_zones(self, zones: list[Zone]):
+        sub_zone_docs = []
+        for zone in zones:
+            for position, sub_zone in enumerate(zone.payload.zones):
+                if sub_zone.id is None:
+                    sub_zone.id = str(ObjectId())
+
+                sub_zone_docs.append(self._sub_zone_document(zone, position, sub_zone))
+
+        if sub_zone_docs:
+            await self._sub_zones.insert_many(sub_zone_docs)
+
+    async def _update_sub_zones(self, zone: Zone):
+        operations = []
+        for position, sub_zone in enumerate(zone.payload.zones):
+            if sub_zone.id is None:
+                sub_zone.id = str(ObjectId())
+
+            sub_zone_doc = self._sub_zone_document(zone, position, sub_zone)
+            operations.append(UpdateOne({"_id": sub_zone_doc.pop("_id")}, {"$set": sub_zone_doc}, upsert=True))
+
+        if operations:
+            await self._sub_zones.bulk_write(operations, ordered=False)
+
+    def _sub_zone_document(self, zone: Zone, position: int, sub_zone: Zone) -> dict:
+        sub_zone_dict = sub_zone.model_dump(exclude_none=True, by_alias=True)
+        sub_zone_dict["_id"] = ObjectId(sub_zone.id)
+        sub_zone_dict["parent_id"] = ObjectId(zone.id)
+        sub_zone_dict["position"] = position
+        sub_zone_dict["geometry"] = bbox_to_geometry(sub_zone.bbox)
+        return sub_zone_dict
+
+    async def _load_sub_zones(self, zone_docs: list[dict]):
+        """Fills payload.zones of auto group documents from the sub_zones collection."""
+        if not self.uses_sub_zone_collection:
+            return
+
+        groups = {
+            zone_doc["_id"]: zone_doc
+            for zone_doc in zone_docs
+            if zone_doc.get("zone_type") == ZoneType.AUTO_GROUP and "payload" in zone_doc
+        }
+        if not groups:
+            return
+
+        for zone_doc in groups.values():
+            zone_doc["payload"]["zones"] = []
+
+        cursor = self._sub_zones.find({"parent_id": {"$in": list(groups)}}).sort(
+            [("parent_id", ASCENDING), ("position", ASCENDING)]
+        )
+        async for sub_zone_doc in cursor:
+            groups[sub_zone_doc["parent_id"]]["payload"]["zones"].append(sub_zone_doc)
+
+
+def sub_zone_refresh_update(sub_zone: Zone, prefix: str) -> dict:
+    """Update operators for the refreshed fields of a sub-zone, paths are prefixed with `prefix`."""
+    update = {"$set": {f"{prefix}active": sub_zone.active}}
+    if sub_zone.payload is None:
+        update["$unset"] = {f"{prefix}payload": ""}
+    else:
+        update["$set"][f"{prefix}payload"] = sub_zone.payload.model_dump(exclude_none=True)
+    return update
+
+
+def bbox_to_geometry(bbox: ZoneBBox) -> dict:
+    """GeoJSON polygon of the zone bounding box."""
+    sw, ne = bbox.south_west, bbox.north_east
+    return {
+        "type": "Polygon",
+        "coordinates": [[[sw.lon, sw.lat], [ne.lon, sw.lat], [ne.lon, ne.lat], [sw.lon, ne.lat], [sw.lon, sw.lat]]],
+    }
+
 
 mongo_db = MongoDB()
@@ -1,32 +1,197 @@
+import asyncio
+import datetime
+import importlib.util
 import os
+import random
+import time
 import httpx
 import logging
+from contextlib import asynccontextmanager
+from typing import Optional
 from fastapi import HTTPException
-from app.types.zone_types import ZoneBBox
+from app.metrics import OPENWEATHER_REQUEST_DURATION, OPENWEATHER_RESPONSES
+from app.client.weather_cache import WEATHER_CACHE_GRID, snap_to_grid, weather_cache
+from app.types.zone_types import ZoneBBox, weather_timestamp
 
 logger = logging.getLogger(__name__)
 
 OPEN_WEATHER_API_KEY = os.getenv("OPEN_WEATHER_API_KEY")
+OPEN_WEATHER_URL = os.getenv("OPEN_WEATHER_URL", "https://api.openweathermap.org/data/2.5")
 
+# connection pool of the shared OpenWeather client
+WEATHER_MAX_CONNECTIONS = int(os.getenv("WEATHER_MAX_CONNECTIONS", "20"))
+WEATHER_MAX_KEEPALIVE = int(os.getenv("WEATHER_MAX_KEEPALIVE", "10"))
+WEATHER_KEEPALIVE_EXPIRY = float(os.getenv("WEATHER_KEEPALIVE_EXPIRY", "30"))
+WEATHER_TIMEOUT = float(os.getenv("WEATHER_TIMEOUT", "10"))
+WEATHER_CONNECT_TIMEOUT = float(os.getenv("WEATHER_CONNECT_TIMEOUT", "5"))
+# retries of requests failed with 429, 5xx or a transport error
+WEATHER_RETRIES = int(os.getenv("WEATHER_RETRIES", "3"))
+WEATHER_BACKOFF = float(os.getenv("WEATHER_BACKOFF", "0.5"))  # seconds, doubled with every retry
+# seconds, upper bound of a backoff including `Retry-After`, so a retry never holds a refresh for long
+WEATHER_MAX_BACKOFF = float(os.getenv("WEATHER_MAX_BACKOFF", "30"))
 
-async def get_weather_by_bbox(bbox: ZoneBBox):
-    mid_lat = (bbox.south_west.lat + bbox.north_east.lat) / 2
-    mid_lon = (bbox.south_west.lon + bbox.north_east.lon) / 2
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# maximum number of concurrent OpenWeather requests per process
+WEATHER_MAX_IN_FLIGHT = int(os.getenv("WEATHER_MAX_IN_FLIGHT", "10"))
+# calls per minute allowed by the OpenWeather plan (60 for the free plan)
+WEATHER_CALLS_PER_MINUTE = int(os.getenv("WEATHER_CALLS_PER_MINUTE", "60"))
+
+
+class RateLimiter:
+    """
+    Limits concurrent requests with a semaphore and spaces their starts with a token bucket
+    refilled at `calls_per_minute` (virtual scheduling, at most `burst` calls at once).
+
+    Acquire it with `async with limiter:` around each call.
+    """
+
+    def __init__(self, max_in_flight: int, calls_per_minute: int, burst: int = 1):
+        self._max_in_flight = max_in_flight
+        self._interval = 60 / calls_per_minute if calls_per_minute > 0 else 0
+        self._burst = burst
+        self._next_call = 0.0  # theoretical time of the next call without burst
+        self._loop = None
+        self._semaphore: asyncio.Semaphore = None
+
+    async def __aenter__(self):
+        await self._get_semaphore().acquire()
+        try:
+            await self._acquire_token()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        return self
+
+    async def __aexit__(self, _exc_type, _exc, _tb):
+        self._semaphore.release()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # asyncio primitives are bound to a loop, the test client runs each request in a new one
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self._max_in_flight)
+        return self._semaphore
+
+    async def _acquire_token(self):
+        now = time.monotonic()
+        self._next_call = max(self._next_call, now)
+        wait = self._next_call - now - (self._burst - 1) * self._interval
+        self._next_call += self._interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+weather_limiter = RateLimiter(WEATHER_MAX_IN_FLIGHT, WEATHER_CALLS_PER_MINUTE)
+
+
+_http_client: Optional[httpx.AsyncClient] = None
+_http_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Returns the shared connection-pooled client for OpenWeather calls.
+    It is opened by `weather_client` in the app lifespan, or lazily when used without it.
+    """
+    global _http_client, _http_client_loop
+
+    # pooled connections are bound to a loop, the test client runs each request in a new one
+    loop = asyncio.get_running_loop()
+    if _http_client is None or _http_client_loop is not loop:
+        _http_client = httpx.AsyncClient(
+            http2=importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=WEATHER_MAX_CONNECTIONS,
+                max_keepalive_connections=WEATHER_MAX_KEEPALIVE,
+                keepalive_expiry=WEATHER_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(WEATHER_TIMEOUT, connect=WEATHER_CONNECT_TIMEOUT),
+        )
+        _http_client_loop = loop
 
-    return await get_weather_by_coordinates(mid_lat, mid_lon)
+    return _http_client
 
 
-async def get_weather_by_coordinates(lat: float, lon: float):
+@asynccontextmanager
+async def weather_client():
+    """Owns the shared OpenWeather client for the lifetime of the app."""
+    global _http_client
+
+    client = get_http_client()
+    try:
+        yield client
+    finally:
+        await client.aclose()
+        if _http_client is client:
+            _http_client = None
+
+
+async def open_weather_get(path: str, params: dict) -> httpx.Response:
+    """
+    GET request to the OpenWeather API through the shared client and the rate limiter.
+    Requests failed with 429, 5xx or a transport error are retried with exponential backoff,
+    `Retry-After` of the response is respected up to WEATHER_MAX_BACKOFF.
+    """
     if not OPEN_WEATHER_API_KEY:
         raise HTTPException(status_code=500, detail="OpenWeather API key not found")
 
-    url = (
-        f"http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&units=metric&appid={OPEN_WEATHER_API_KEY}"
-    )
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-        logging.info(f"GET {url} - {response.status_code}")
+    url = f"{OPEN_WEATHER_URL}/{path}"
+    params = {**params, "appid": OPEN_WEATHER_API_KEY}
+
+    for attempt in range(WEATHER_RETRIES + 1):
+        try:
+            async with weather_limiter:
+                with OPENWEATHER_REQUEST_DURATION.time(path=path):
+                    response = await get_http_client().get(url, params=params)
+            OPENWEATHER_RESPONSES.inc(path=path, status=response.status_code)
+            logger.debug("GET %s %s %s - %d", url, params.get("lat", ""), params.get("lon", ""), response.status_code)
+        except httpx.TransportError as e:
+            OPENWEATHER_RESPONSES.inc(path=path, status="error")
+            if attempt == WEATHER_RETRIES:
+                raise
+            logger.warning(f"GET {url} failed: {e!r}, retrying")
+            await asyncio.sleep(_backoff(attempt))
+            continue
+
+        if response.status_code not in RETRY_STATUS_CODES or attempt == WEATHER_RETRIES:
+            return response
+
+        await asyncio.sleep(_backoff(attempt, response.headers.get("Retry-After")))
+
+    return response
+
+
+def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+    if retry_after and retry_after.isdigit():
+        return min(float(retry_after), WEATHER_MAX_BACKOFF)
+    return min(WEATHER_BACKOFF * 2**attempt * random.uniform(0.5, 1.5), WEATHER_MAX_BACKOFF)
+
+
+async def get_weather_by_bbox(bbox: ZoneBBox, max_age: float = None) -> tuple[dict, datetime.datetime]:
+    mid_lat = (bbox.south_west.lat + bbox.north_east.lat) / 2
+    mid_lon = (bbox.south_west.lon + bbox.north_east.lon) / 2
+
+    return await get_weather_by_coordinates(mid_lat, mid_lon, max_age)
+
+
+async def get_weather_by_coordinates(lat: float, lon: float, max_age: float = None) -> tuple[dict, datetime.datetime]:
+    """
+    Current weather at the coordinates and the time it was fetched from OpenWeather. Coordinates are
+    snapped to the WEATHER_CACHE_GRID, so near points share one cached upstream response. With max_age
+    (seconds), a response cached longer ago is fetched again, 0 always calls OpenWeather.
+    """
+    if WEATHER_CACHE_GRID <= 0:
+        return await fetch_weather(lat, lon)
+
+    lat, lon = snap_to_grid(lat, lon, WEATHER_CACHE_GRID)
+    return await weather_cache.get_or_fetch((lat, lon), lambda: fetch_weather(lat, lon), max_age)
+
 
+async def fetch_weather(lat: float, lon: float) -> tuple[dict, datetime.datetime]:
+    response = await open_weather_get("weather", {"lat": lat, "lon": lon, "units": "metric"})
     response.raise_for_status()
 
-    return response.json()
+    # the fetch time is cached with the response, so zones served from the cache are not stamped as fresh
+    return response.json(), weather_timestamp()
@@ -0,0 +1,112 @@
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+# cell size in meters of the grid the coordinates are snapped to, 0 disables the cache
+WEATHER_CACHE_GRID = float(os.getenv("WEATHER_CACHE_GRID", "1000"))
+WEATHER_CACHE_TTL = float(os.getenv("WEATHER_CACHE_TTL", "300"))  # seconds
+WEATHER_CACHE_SIZE = int(os.getenv("WEATHER_CACHE_SIZE", "10000"))  # entries
+
+METERS_PER_DEGREE = 111320
+
+
+def snap_to_grid(lat: float, lon: float, grid: float) -> tuple[float, float]:
+    """
+    Snaps coordinates to the center of a grid cell roughly `grid` meters wide,
+    so near points share the same coordinates.
+    """
+    lat_step = grid / METERS_PER_DEGREE
+    snapped_lat = max(-90.0, min(90.0, round(lat / lat_step) * lat_step))
+
+    lon_step = grid / (METERS_PER_DEGREE * max(math.cos(math.radians(snapped_lat)), 0.01))
+    snapped_lon = round(lon / lon_step) * lon_step
+    snapped_lon = (snapped_lon + 180) % 360 - 180
+
+    return round(snapped_lat, 6), round(snapped_lon, 6)
+
+
+class WeatherCache:
+    """
+    TTL cache with LRU eviction for upstream weather responses.
+
+    Concurrent misses of the same key are coalesced into one fetch, which runs as its own task,
+    so a cancelled caller neither cancels the fetch nor fails the other callers waiting for it.
+    Cached values are shared, callers must not modify them.
+    """
+
+    def __init__(self, ttl: float = WEATHER_CACHE_TTL, max_size: int = WEATHER_CACHE_SIZE):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()  # (stored at, value)
+        self._in_flight: dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]], max_age: float = None) -> Any:
+        """
+        Returns the cached value of the key or fetches it. With max_age (seconds), a value cached longer ago
+        is fetched again and replaces the cached one, 0 always fetches.
+        """
+        if (entry := self._entries.get(key)) is not None:
+            stored, value = entry
+            age = time.monotonic() - stored
+            if age < self._ttl and (max_age is None or age < max_age):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return value
+            if age >= self._ttl:
+                del self._entries[key]
+
+        loop = asyncio.get_running_loop()
+        if (in_flight := self._in_flight.get(key)) is not None and in_flight.get_loop() is loop:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            in_flight = self._in_flight[key] = loop.create_task(self._fetch(key, fetch))
+            in_flight.add_done_callback(_retrieve_exception)
+
+        return await asyncio.shield(in_flight)
+
+    async def _fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            value = await fetch()
+        finally:
+            if self._in_flight.get(key) is asyncio.current_task():
+                del self._in_flight[key]
+
+        self._store(key, value)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses + self.coalesced
+        return {
+            "size": len(self._entries),
+            "max_size": self._max_size,
+            "ttl": self._ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "hit_ratio": (self.hits + self.coalesced) / requests if requests else 0.0,
+        }
+
+    def _store(self, key: Hashable, value: Any):
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_size:
+            self._entries.popitem(last=False)
+
+
+def _retrieve_exception(task: asyncio.Task):
+    # the exception is raised to the callers, it is not logged when all of them were cancelled
+    if not task.cancelled():
+        task.exception()
+
+
+weather_cache = WeatherCache()
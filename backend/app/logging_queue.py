@@ -0,0 +1,58 @@
+import logging
+import os
+import queue
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# records waiting for the listener thread, records are dropped instead of blocking when it is full
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler which drops records when the queue is full, so logging never blocks the caller."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+@contextmanager
+def queued_logging(level: str = LOG_LEVEL, queue_size: int = LOG_QUEUE_SIZE):
+    """
+    Routes records of the root logger through a bounded queue to its handlers, which run in
+    a QueueListener thread, so writing records never stalls the event loop. Without configured
+    root handlers records are written to stderr. The original handlers are restored on exit.
+    """
+    root = logging.getLogger()
+    previous_handlers, previous_level = root.handlers[:], root.level
+    handlers = previous_handlers
+    if not handlers:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+        handlers = [stream_handler]
+
+    log_queue = queue.Queue(queue_size)
+    queue_handler = DroppingQueueHandler(log_queue)
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+
+    root.handlers = [queue_handler]
+    root.setLevel(level)
+    listener.start()
+    try:
+        yield queue_handler
+    finally:
+        listener.stop()
+        root.handlers = previous_handlers
+        root.setLevel(previous_level)
+        if queue_handler.dropped:
+            logging.getLogger(__name__).warning(
+                "%d log records were dropped, the log queue was full", queue_handler.dropped
+            )
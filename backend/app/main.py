@@ -1,15 +1,30 @@
-from fastapi import FastAPI
+import time
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
-from app.routers import zones
+from contextlib import AsyncExitStack, asynccontextmanager
+from app.routers import monitoring, zones
 
 from app.background import Background
+from app.client.mongo import mongo_db
+from app.client.weather import weather_client
+from app.logging_queue import queued_logging
+from app.metrics import HTTP_REQUEST_DURATION
+from app.zone_sync import ZoneSync
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    await mongo_db.init()
+
+    # the shared OpenWeather client is closed after the background task finishes
     # create a background asyncio task which will periodically process the zones
-    async with Background():
+    async with AsyncExitStack() as stack:
+        stack.enter_context(queued_logging())
+        await stack.enter_async_context(weather_client())
+        if not mongo_db.uses_sub_zone_collection:
+            # zones are read from memory, the collection mode queries MongoDB instead
+            await stack.enter_async_context(ZoneSync())
+        await stack.enter_async_context(Background())
         yield
 
 
@@ -18,7 +33,24 @@ async def lifespan(app: FastAPI):
 
 app = FastAPI(lifespan=lifespan)
 
+
+@app.middleware("http")
+async def observe_request_duration(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    # the route template keeps the number of label values bounded
+    route = request.scope.get("route")
+    HTTP_REQUEST_DURATION.observe(
+        time.perf_counter() - started,
+        method=request.method,
+        path=route.path if route is not None else "unmatched",
+        status=response.status_code,
+    )
+    return response
+
+
 app.include_router(zones.router)
+app.include_router(monitoring.router)
 
 origins = [
     "http://localhost:8000",  # React frontend running on this port
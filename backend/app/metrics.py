@@ -0,0 +1,175 @@
+import bisect
+import functools
+import time
+from contextlib import contextmanager
+from typing import Iterable
+
+# seconds, from a cached in-memory query to a slow upstream call
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# numbers of zones
+COUNT_BUCKETS = (0, 1, 10, 100, 1000, 10_000, 100_000, 1_000_000)
+# bytes, from a next_refresh update to a large grid written as a whole
+BYTES_BUCKETS = (100, 1000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+class Counter:
+    """A monotonically increasing value per combination of label values."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_values(self.labelnames, labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [
+            f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram:
+    """
+    Observations counted into cumulative buckets per combination of label values,
+    with their sum and count, as Prometheus histograms are exposed.
+    """
+
+    type_name = "histogram"
+
+    def __init__(
+        self, name: str, documentation: str, labelnames: Iterable[str] = (), buckets: tuple = DURATION_BUCKETS
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}  # labels -> (bucket counts, [sum])
+
+    def observe(self, value: float, **labels):
+        key = _label_values(self.labelnames, labels)
+        if (entry := self._values.get(key)) is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+
+        counts, total = entry
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the seconds spent in the block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> list[str]:
+        lines = []
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                labels = _format_labels((*self.labelnames, "le"), (*key, _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total[0])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Metrics of this process rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._metrics: dict[str, Counter | Histogram] = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Iterable[str] = (), **kwargs) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, **kwargs))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+def timed(histogram: Histogram, label: str = "operation"):
+    """Decorator observing the duration of a coroutine function, labelled with the function name."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**{label: func.__name__}):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _label_values(labelnames: tuple, labels: dict) -> tuple:
+    if set(labels) != set(labelnames):
+        raise ValueError(f"Expected labels {labelnames}, got {tuple(labels)}")
+    return tuple(str(labels[name]) for name in labelnames)
+
+
+def _format_labels(labelnames: tuple, values: tuple) -> str:
+    if not labelnames:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labelnames, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+HTTP_REQUEST_DURATION = registry.histogram(
+    "http_request_duration_seconds", "Latency of API requests until the response starts.", ("method", "path", "status")
+)
+MONGO_OPERATION_DURATION = registry.histogram(
+    "mongodb_operation_duration_seconds", "Latency of MongoDB operations of the zone store.", ("operation",)
+)
+OPENWEATHER_REQUEST_DURATION = registry.histogram(
+    "openweather_request_duration_seconds", "Latency of single OpenWeather API requests.", ("path",)
+)
+OPENWEATHER_RESPONSES = registry.counter(
+    "openweather_responses", "OpenWeather API responses by status code, transport errors as error.", ("path", "status")
+)
+ZONE_REFRESH_DURATION = registry.histogram(
+    "zone_refresh_duration_seconds", "Duration of auto group refreshes by the background task.", ("result",)
+)
+ZONE_REFRESH_WRITTEN_BYTES = registry.histogram(
+    "zone_refresh_written_bytes", "BSON bytes of the updates written by an auto group refresh.", buckets=BYTES_BUCKETS
+)
+ZONE_REFRESH_LAG = registry.histogram(
+    "zone_refresh_lag_seconds", "Delay between next_refresh of an auto group and the start of its refresh."
+)
+NEAR_ZONES_SCANNED = registry.histogram(
+    "near_zones_scanned_zones", "Zones and sub-zones a /near_zones query evaluated.", buckets=COUNT_BUCKETS
+)
+NEAR_ZONES_RETURNED = registry.histogram(
+    "near_zones_returned_zones", "Zones and sub-zones a /near_zones query returned.", buckets=COUNT_BUCKETS
+)
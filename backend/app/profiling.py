@@ -0,0 +1,128 @@
+import cProfile
+import collections
+import datetime
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import time
+from contextlib import contextmanager
+from typing import Optional
+from fastapi import Request
+from fastapi.routing import APIRoute
+
+logger = logging.getLogger(__name__)
+
+# share of requests and background refresh cycles profiled, 0 disables sampling
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# requests carrying this header are profiled (e.g. X-Profile), empty disables it
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "")
+# directory the profiles are written to, they can be opened with pstats or snakeviz
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# number of the most recent profiles kept, older ones are deleted
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "50"))
+
+
+class Profiler:
+    """
+    Opt-in cProfile of request handlers and background refresh cycles.
+
+    A block is profiled when it is sampled (`sample_rate`) or requested by the `header`.
+    cProfile observes the whole event loop thread, so a profile also contains work of tasks
+    interleaved with the profiled one, and only one block is profiled at a time.
+    When profiling is disabled, `maybe_profile` costs a couple of attribute lookups.
+    """
+
+    def __init__(self, sample_rate: float, header: str, directory: str, keep: int):
+        self.sample_rate = sample_rate
+        self.header = header
+        self.directory = directory
+        self._active = False
+        self._profiles: collections.deque[dict] = collections.deque(maxlen=max(keep, 1))
+
+    @property
+    def enabled(self) -> bool:
+        return self.sample_rate > 0 or bool(self.header)
+
+    def requested(self, request: Request) -> bool:
+        return bool(self.header) and self.header in request.headers
+
+    @contextmanager
+    def maybe_profile(self, label: str, force: bool = False):
+        """Profiles the block when it is forced or sampled and no other block is being profiled."""
+        if self._active or not (force or (self.sample_rate > 0 and random.random() < self.sample_rate)):
+            yield
+            return
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # another profiler is active in this thread
+            yield
+            return
+
+        self._active = True
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._active = False
+            self._save(label, profile, time.perf_counter() - started)
+
+    def profiles(self) -> list[dict]:
+        """The kept profiles, the most recent first."""
+        return list(reversed(self._profiles))
+
+    def report(self, name: str, limit: int = 40) -> Optional[str]:
+        """pstats report of a kept profile sorted by the cumulative time, None for an unknown profile."""
+        if not any(entry["name"] == name for entry in self._profiles):
+            return None
+
+        stream = io.StringIO()
+        pstats.Stats(os.path.join(self.directory, name), stream=stream).sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
+
+    def _save(self, label: str, profile: cProfile.Profile, duration: float):
+        created = datetime.datetime.now()
+        name = f"{created:%Y%m%dT%H%M%S%f}-{re.sub(r'[^A-Za-z0-9]+', '_', label).strip('_')}.prof"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            profile.dump_stats(os.path.join(self.directory, name))
+        except OSError as e:
+            logger.warning(f"Writing profile {name} failed: {e!r}")
+            return
+
+        if len(self._profiles) == self._profiles.maxlen:
+            self._remove(self._profiles[0]["name"])
+        self._profiles.append({"name": name, "label": label, "created": created, "duration": duration})
+        logger.info(f"Profiled {label} in {duration:.3f} s: {name}")
+
+    def _remove(self, name: str):
+        try:
+            os.remove(os.path.join(self.directory, name))
+        except OSError:
+            pass
+
+
+profiler = Profiler(PROFILE_SAMPLE_RATE, PROFILE_HEADER, PROFILE_DIR, PROFILE_KEEP)
+
+
+class ProfiledRoute(APIRoute):
+    """Route whose handler, with request parsing and response serialization, is profiled when sampled."""
+
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        label = f"{'_'.join(sorted(self.methods))} {self.path}"
+
+        async def profiled_handler(request: Request):
+            if not profiler.enabled:
+                return await handler(request)
+
+            with profiler.maybe_profile(label, force=profiler.requested(request)):
+                return await handler(request)
+
+        return profiled_handler
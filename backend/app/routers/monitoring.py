@@ -0,0 +1,51 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+from app.client.weather_cache import weather_cache
+from app.metrics import registry
+from app.profiling import profiler
+
+router = APIRouter()
+
+
+@router.get("/weather_cache")
+def weather_cache_stats():
+    """
+    Statistics of the weather response cache.
+
+    Returns:
+        dict: Cache size, hit/miss/coalesced request counts and the hit ratio.
+    """
+    return weather_cache.stats()
+
+
+@router.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    """
+    Metrics of this process in the Prometheus text format: latency of endpoints, MongoDB operations
+    and OpenWeather requests, duration and lag of auto group refreshes and zones scanned by /near_zones.
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@router.get("/debug/profiles")
+def list_profiles():
+    """
+    Profiles of sampled requests and background refresh cycles, the most recent first.
+    Available when profiling is enabled by PROFILE_SAMPLE_RATE or PROFILE_HEADER.
+
+    Returns:
+        list: Name, label, creation time and duration in seconds of each kept profile.
+    """
+    if not profiler.enabled:
+        raise HTTPException(status_code=404, detail={"status": "error", "message": "Profiling is disabled"})
+    return profiler.profiles()
+
+
+@router.get("/debug/profiles/{name}", response_class=PlainTextResponse)
+def profile_report(name: str, limit: int = 40):
+    """
+    Report of a profile with the `limit` functions of the highest cumulative time.
+    """
+    if not profiler.enabled or (report := profiler.report(name, limit)) is None:
+        raise HTTPException(status_code=404, detail={"status": "error", "message": "Profile not found"})
+    return PlainTextResponse(report)
@@ -1,23 +1,14 @@
-import os
-import requests
 from fastapi import APIRouter, HTTPException
+from app.client.weather import open_weather_get
 
 router = APIRouter()
 
-OPEN_WEATHER_API_KEY = os.getenv("OPEN_WEATHER_API_KEY")
-
 
 # example
 # http://127.0.0.1:8001/weather?lat=40.4774&lon=-74.2591
 @router.get("/weather")
-def get_weather(lat: float, lon: float):
-    if not OPEN_WEATHER_API_KEY:
-        raise HTTPException(status_code=500, detail="OpenWeather API key not found")
-
-    url = (
-        f"http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&units=metric&appid={OPEN_WEATHER_API_KEY}"
-    )
-    response = requests.get(url)
+async def get_weather(lat: float, lon: float):
+    response = await open_weather_get("weather", {"lat": lat, "lon": lon, "units": "metric"})
 
     if response.status_code != 200:
         raise HTTPException(status_code=response.status_code, detail=response.json())
@@ -28,15 +19,11 @@ def get_weather(lat: float, lon: float):
 # example
 # http://127.0.0.1:8001/weather_zone?lon_left=-74.2591&lat_bottom=40.4774&lon_right=-73.7002&lat_top=40.9176
 @router.get("/weather_zone")
-def get_weather_zone(lon_left: float, lat_bottom: float, lon_right: float, lat_top: float):
-    if not OPEN_WEATHER_API_KEY:
-        raise HTTPException(status_code=500, detail="OpenWeather API key not found")
-
+async def get_weather_zone(lon_left: float, lat_bottom: float, lon_right: float, lat_top: float):
     zoom = 10
     bbox = f"{lon_left},{lat_bottom},{lon_right},{lat_top},{zoom}"
 
-    url = f"https://api.openweathermap.org/data/2.5/box/city?bbox={bbox}&appid={OPEN_WEATHER_API_KEY}"
-    response = requests.get(url)
+    response = await open_weather_get("box/city", {"bbox": bbox})
 
     if response.status_code != 200:
         raise HTTPException(status_code=response.status_code, detail=response.json())
@@ -1,6 +1,12 @@
+import asyncio
+import datetime
 import math
 import logging
-from fastapi import APIRouter, HTTPException
+import os
+import numpy as np
+from typing import Optional
+from fastapi import APIRouter, BackgroundTasks, Body, HTTPException, Query
+from fastapi.responses import StreamingResponse
 from geopy.distance import geodesic
 from bson import ObjectId
 
@@ -8,24 +14,50 @@ from app.types.zone_types import (
     AutoGroupPayload,
     AutoGroupRequest,
     CreateZoneRequest,
+    GeoPoint,
     LocalSituationRequest,
     Restriction,
+    RouteRequest,
+    SubZoneGrid,
     Zone,
     ZoneType,
     create_zone_bbox,
+    single_weather_types,
+    weather_types,
+    with_expanded_grid,
 )
 from app.client.weather import get_weather_by_bbox
 from app.client.mongo import mongo_db
-from app.zone_filters import filter_by_radius, filter_by_restrictions
+from app.metrics import NEAR_ZONES_RETURNED, NEAR_ZONES_SCANNED
+from app.profiling import ProfiledRoute
+from app.zone_filters import RestrictionPredicate, filter_by_restrictions, route_boxes, route_positions
+from app.zone_index import zone_index
+from app.zone_json import dumps_zone_document, json_array_response
 from app.background import Background
 
-
 logger = logging.getLogger(__name__)
-router = APIRouter()
+router = APIRouter(route_class=ProfiledRoute)
+
+# the largest number of sub-zones an auto group may have
+MAX_SUB_ZONES = int(os.getenv("MAX_SUB_ZONES", "100000"))
+# auto groups with more sub-zones are expanded for the response in a worker thread
+SUB_ZONE_THREAD_THRESHOLD = int(os.getenv("SUB_ZONE_THREAD_THRESHOLD", "5000"))
+# the largest number of zones created or deleted by one bulk request
+MAX_BULK_ZONES = int(os.getenv("MAX_BULK_ZONES", "1000"))
+
+# IDs of zones whose weather is being refreshed after a /near_zones response, each is refreshed once at a time
+_revalidating: set[str] = set()
 
 
 @router.post("/near_zones")
-async def near_zones(lat: float, lon: float, radius: float, restrictions: list[Restriction] = []):
+async def near_zones(
+    lat: float,
+    lon: float,
+    radius: float,
+    background_tasks: BackgroundTasks,
+    restrictions: list[Restriction] = [],
+    stale_after: Optional[float] = Query(default=None, gt=0),
+):
     """
     Find zones within a specified radius of a given latitude and longitude.
 
@@ -34,42 +66,230 @@ async def near_zones(lat: float, lon: float, radius: float, restrictions: list[R
         lon (float): The longitude of the point to search around.
         radius (float): The radius within which to search for zones in meters.
         restrictions (list[Restriction]): A list of restrictions to filter the zones.
+        stale_after (Optional[float]): When set, weather older than this many seconds is returned as it is
+            and refreshed in the background after the response: plain zones are refreshed from OpenWeather,
+            auto groups are made due for the background refresh.
 
     Returns:
         list: A list of zones that are within the specified radius of the given point,
               optionally filtered by the provided restrictions.
     """
 
-    zones = await mongo_db.get_all_zones()
-    expanded_zones: list[Zone] = []
-    for zone in zones:
-        if zone.zone_type == ZoneType.AUTO_GROUP:
-            expanded_zones.extend(zone.payload.zones)
-        else:
-            expanded_zones.append(zone)
-
-    zones_in_radius = filter_by_radius(expanded_zones, lat, lon, radius)
+    # zones are read-only here, they are serialized without validating them again
+    if mongo_db.uses_sub_zone_collection:
+        zone_docs = await mongo_db.find_zone_documents_near(lat, lon, radius)
+        NEAR_ZONES_SCANNED.observe(len(zone_docs))
+        if restrictions:
+            predicate = RestrictionPredicate(restrictions)
+            zone_docs = [zone_doc for zone_doc in zone_docs if predicate(zone_doc.get("payload"))]
+        NEAR_ZONES_RETURNED.observe(len(zone_docs))
+
+        if stale_after is not None:
+            cutoff = datetime.datetime.now() - datetime.timedelta(seconds=stale_after)
+            group_ids, zone_ids = set(), set()
+            for zone_doc in zone_docs:
+                if is_stale(zone_doc.get("zone_type"), zone_doc.get("weather_updated_at"), cutoff):
+                    if (parent_id := zone_doc.get("parent_id")) is not None:
+                        group_ids.add(str(parent_id))
+                    else:
+                        zone_ids.add(str(zone_doc["_id"]))
+            if group_ids or zone_ids:
+                background_tasks.add_task(revalidate_zones, group_ids, zone_ids)
+
+        return json_array_response([dumps_zone_document(zone_doc, by_alias=True) for zone_doc in zone_docs])
+
+    await zone_index.ensure_loaded()
+    zones_in_radius = zone_index.query_radius(lat, lon, radius)
     if restrictions:
-        return filter_by_restrictions(zones_in_radius, restrictions)
-    else:
-        return zones_in_radius
+        zones_in_radius = filter_by_restrictions(zones_in_radius, restrictions)
+    NEAR_ZONES_RETURNED.observe(len(zones_in_radius))
+
+    if stale_after is not None:
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=stale_after)
+        group_ids, zone_ids = set(), set()
+        for zone in zones_in_radius:
+            if not is_stale(zone.zone_type, zone.weather_updated_at, cutoff):
+                continue
+            if (owner := zone_index.owner(zone)) is not None and owner.zone_type == ZoneType.AUTO_GROUP:
+                group_ids.add(owner.id)
+            elif owner is not None:
+                zone_ids.add(owner.id)
+        if group_ids or zone_ids:
+            background_tasks.add_task(revalidate_zones, group_ids, zone_ids)
+
+    return json_array_response(zone_index.dumps(zones_in_radius))
+
+
+def is_stale(zone_type: str, weather_updated_at: Optional[datetime.datetime], cutoff: datetime.datetime) -> bool:
+    """Weather of a weather zone is stale when it was never fetched or fetched before the cutoff."""
+    return zone_type in weather_types and (weather_updated_at is None or weather_updated_at < cutoff)
+
+
+async def revalidate_zones(group_ids: set[str], zone_ids: set[str]):
+    """
+    Refreshes weather of zones returned stale by /near_zones. Auto groups are made due, so one of
+    the background tasks refreshes them, other zones are refreshed unless a refresh is in progress.
+    """
+    requested = await asyncio.gather(
+        *(mongo_db.request_refresh(group_id, datetime.datetime.now()) for group_id in group_ids),
+        return_exceptions=True,
+    )
+    for group_id, result in zip(group_ids, requested):
+        if isinstance(result, Exception):
+            logger.warning("Requesting a refresh of zone %s failed", group_id, exc_info=result)
+    if any(result is True for result in requested):
+        Background.refresh_zones()
+
+    zone_ids = zone_ids - _revalidating
+    _revalidating.update(zone_ids)
+    try:
+        await asyncio.gather(*(revalidate_zone(zone_id) for zone_id in zone_ids))
+    finally:
+        _revalidating.difference_update(zone_ids)
+
+
+async def revalidate_zone(zone_id: str):
+    try:
+        if (zone := await mongo_db.get_zone(zone_id)) is not None:
+            await refresh_zone_weather(zone)
+    except Exception as e:
+        logger.warning("Refreshing stale weather of zone %s failed", zone_id, exc_info=e)
+
+
+async def refresh_zone_weather(zone: Zone, max_age: float = None) -> bool:
+    """
+    Fetches weather of the zone and stores it, returns False when the zone no longer exists.
+    With max_age (seconds), a cached response at most that old is used, 0 calls OpenWeather.
+    """
+    weather, fetched_at = await get_weather_by_bbox(zone.bbox, max_age)
+    zone.set_weather_payload(weather, fetched_at)
+
+    if await mongo_db.update_zone(zone) is False:
+        return False
+    zone_index.upsert(zone)
+    return True
+
+
+@router.post("/route_zones")
+async def route_zones(request: RouteRequest):
+    """
+    Find active zones along a planned flight path in one query.
+
+    Args:
+        request (RouteRequest): Waypoints of the path, width of the corridor around it in meters
+            and optional restrictions to filter the zones.
+
+    Returns:
+        list: Active zones intersecting the corridor, ordered by the distance along the path at which
+              they are reached, optionally filtered by the provided restrictions.
+    """
+    if len(request.waypoints) < 2:
+        raise HTTPException(
+            status_code=400, detail={"status": "error", "message": "At least two waypoints are required."}
+        )
+    if request.width <= 0:
+        raise HTTPException(status_code=400, detail={"status": "error", "message": "Width must be positive."})
+
+    if mongo_db.uses_sub_zone_collection:
+        return await _route_zone_documents(request)
+
+    await zone_index.ensure_loaded()
+    zones_on_route = [zone for zone in zone_index.query_route(request.waypoints, request.width) if zone.active]
+    if request.restrictions:
+        zones_on_route = filter_by_restrictions(zones_on_route, request.restrictions)
+    return json_array_response(zone_index.dumps(zones_on_route))
+
+
+async def _route_zone_documents(request: RouteRequest):
+    """Finds zones along the route in MongoDB, used in the collection storage mode."""
+    waypoints, half_width = request.waypoints, request.width / 2
+    boxes = route_boxes(waypoints, half_width)
+    zone_docs = [zone_doc for zone_doc in await mongo_db.find_zone_documents_in_boxes(boxes) if zone_doc.get("active")]
+    if request.restrictions:
+        predicate = RestrictionPredicate(request.restrictions)
+        zone_docs = [zone_doc for zone_doc in zone_docs if predicate(zone_doc.get("payload"))]
+
+    # the geo query pre-selects by the boxes around segments, the corridor itself is checked here
+    corners = [
+        np.array([zone_doc["bbox"][corner][axis] for zone_doc in zone_docs], dtype=np.float64)
+        for corner, axis in (("south_west", "lat"), ("south_west", "lon"), ("north_east", "lat"), ("north_east", "lon"))
+    ]
+    positions = route_positions(*corners, waypoints, half_width)
+    order = [i for i in np.argsort(positions, kind="stable").tolist() if not np.isnan(positions[i])]
+    return json_array_response([dumps_zone_document(zone_docs[i], by_alias=True) for i in order])
 
 
 @router.get("/list_zones")
-async def list_zones():
+async def list_zones(
+    stream: bool = False,
+    after: Optional[str] = None,
+    limit: Optional[int] = Query(default=None, ge=1),
+    include_sub_zones: bool = True,
+    compact_grid: bool = False,
+):
     """
     Retrieve a list of all zones.
 
+    Zones are ordered by their ID and can be paged by passing the ID of the last received zone
+    as `after`. When a page is full, the ID to continue from is returned in the X-Next-Cursor header.
+
+    Args:
+        stream (bool): Stream the zones as newline delimited JSON, one zone per line,
+            instead of building one JSON array.
+        after (Optional[str]): Return only zones following the zone with this ID.
+        limit (Optional[int]): The maximum number of returned zones.
+        include_sub_zones (bool): Whether sub-zones of auto groups are returned.
+        compact_grid (bool): Return sub-zones of auto groups stored as a grid in the compact
+            form (payload.grid with per cell columns) instead of listing them in payload.zones.
+
     Returns:
         list: A list of all zones from the database.
     """
 
+    if after is not None and not ObjectId.is_valid(after):
+        raise HTTPException(status_code=400, detail={"status": "error", "message": "Invalid cursor"})
+
+    if mongo_db.uses_sub_zone_collection:
+        return await _list_zone_documents(stream, after, limit, include_sub_zones)
+
+    await zone_index.ensure_loaded()
+    listed_zones = zone_index.list_zones(after=after, limit=limit)
+    zone_jsons = zone_index.dumps_listed(listed_zones, include_sub_zones, compact_grid)
+
+    if stream:
+        return StreamingResponse((zone_json + b"\n" for zone_json in zone_jsons), media_type="application/x-ndjson")
+
+    headers = None
+    if limit is not None and len(listed_zones) == limit:
+        headers = {"X-Next-Cursor": listed_zones[-1].id}
+
+    return json_array_response(zone_jsons, headers)
+
+
+async def _list_zone_documents(stream: bool, after: Optional[str], limit: Optional[int], include_sub_zones: bool):
+    """Lists zones read from MongoDB in batches, used in the collection storage mode."""
+    # zones are read-only here, documents are serialized without validating them as Zone
+    zone_docs = mongo_db.iter_zone_documents(after=after, limit=limit, include_sub_zones=include_sub_zones)
+
+    if stream:
+
+        async def ndjson_lines():
+            async for zone_doc in zone_docs:
+                yield dumps_zone_document(zone_doc) + b"\n"
+
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
     out_zones = list()
-    zones = await mongo_db.get_all_zones()
-    for zone in zones:
-        out_zones.append(zone.model_dump(exclude_none=True))
+    last_id = None
+    async for zone_doc in zone_docs:
+        out_zones.append(dumps_zone_document(zone_doc))
+        last_id = zone_doc["_id"]
 
-    return out_zones
+    headers = None
+    if limit is not None and len(out_zones) == limit:
+        headers = {"X-Next-Cursor": str(last_id)}
+
+    return json_array_response(out_zones, headers)
 
 
 @router.delete("/delete_zone")
@@ -88,6 +308,7 @@ async def delete_zone(zone_id: str):
     try:
         if await mongo_db.delete_zone(zone_id) is False:
             raise HTTPException(status_code=404, detail={"status": "error", "message": "Zone not found"})
+        zone_index.remove(zone_id)
     except Exception as e:
         logger.error("Error creating zone", exc_info=e)
         raise HTTPException(status_code=500, detail={"status": "error", "message": str(e)})
@@ -113,10 +334,10 @@ async def create_zone(request: CreateZoneRequest):
     """
 
     try:
-        weather = None
+        weather, fetched_at = None, None
         zone_bbox = create_zone_bbox(request.zone_rect)
         if request.zone_type != ZoneType.EMPTY:
-            weather = await get_weather_by_bbox(zone_bbox)
+            weather, fetched_at = await get_weather_by_bbox(zone_bbox)
 
         zone = Zone(
             name=request.zone_name,
@@ -124,9 +345,10 @@ async def create_zone(request: CreateZoneRequest):
             bbox=zone_bbox,
         )
 
-        zone.set_weather_payload(weather)
+        zone.set_weather_payload(weather, fetched_at)
 
         new_zone = await mongo_db.insert_zone(zone)
+        zone_index.upsert(new_zone)
         return new_zone.model_dump(exclude_none=True)
 
     except Exception as e:
@@ -134,47 +356,217 @@ async def create_zone(request: CreateZoneRequest):
         raise HTTPException(status_code=500, detail={"status": "error", "message": str(e)})
 
 
-@router.post("/create_auto_group_zone")
-async def create_auto_group_zone(request: AutoGroupRequest):
-    try:
-        if request.sampling_size < 1000:
-            raise HTTPException(
-                status_code=400,
-                detail={"status": "error", "message": "Sampling size must be greater than 1000."},
-            )
+@router.post("/create_zones_bulk")
+async def create_zones_bulk(requests: list[CreateZoneRequest]):
+    """
+    Create many zones at once. Weather of all zones is fetched concurrently and the zones
+    are inserted with one database write.
 
-        if request.refresh_rate < 600:
-            raise HTTPException(
-                status_code=400,
-                detail={"status": "error", "message": "Refresh rate must be greater than 600."},
-            )
+    Args:
+        requests (list[CreateZoneRequest]): The zones to create, as for /create_zone.
 
-        zone = Zone(
-            name=request.name,
-            zone_type=ZoneType.AUTO_GROUP,
-            bbox=create_zone_bbox(request.rect),
+    Returns:
+        dict: The overall status ("success", "partial" or "error") and a result for each requested
+              zone in the same order, {"status": "success", "zone": zone} or {"status": "error", "message": str}.
+    """
+    if len(requests) > MAX_BULK_ZONES:
+        raise HTTPException(
+            status_code=400,
+            detail={"status": "error", "message": f"At most {MAX_BULK_ZONES} zones can be created at once."},
         )
 
-        payload = AutoGroupPayload(
-            sampling_size=request.sampling_size,
-            refresh_rate=request.refresh_rate,
-            sub_zone_type=request.sub_zone_type,
-            zones=create_sub_zones(request.name, request.sub_zone_type, request.rect, request.sampling_size),
+    async def fetch_weather(request: CreateZoneRequest):
+        if request.zone_type == ZoneType.EMPTY:
+            return None, None
+        return await get_weather_by_bbox(create_zone_bbox(request.zone_rect))
+
+    weathers = await asyncio.gather(*(fetch_weather(request) for request in requests), return_exceptions=True)
+
+    results: list[dict] = [None] * len(requests)
+    zones, positions = [], []
+    for position, (request, weather) in enumerate(zip(requests, weathers)):
+        try:
+            if isinstance(weather, Exception):
+                raise weather
+
+            zone = Zone(name=request.zone_name, zone_type=request.zone_type, bbox=create_zone_bbox(request.zone_rect))
+            zone.set_weather_payload(*weather)
+        except Exception as e:
+            logger.error("Error creating zone", exc_info=e)
+            results[position] = {"status": "error", "message": str(e)}
+            continue
+
+        zones.append(zone)
+        positions.append(position)
+
+    try:
+        errors = await mongo_db.insert_zones(zones)
+    except Exception as e:
+        logger.error("Error creating zones", exc_info=e)
+        raise HTTPException(status_code=500, detail={"status": "error", "message": str(e)})
+
+    for position, zone, error in zip(positions, zones, errors):
+        if error is None:
+            zone_index.upsert(zone)
+            results[position] = {"status": "success", "zone": zone.model_dump(exclude_none=True)}
+        else:
+            results[position] = {"status": "error", "message": error}
+
+    return {"status": bulk_status(results), "results": results}
+
+
+@router.post("/delete_zones_bulk")
+async def delete_zones_bulk(zone_ids: list[str] = Body()):
+    """
+    Delete many zones by their IDs with one database write.
+
+    Args:
+        zone_ids (list[str]): The IDs of the zones to delete.
+
+    Returns:
+        dict: The overall status ("success", "partial" or "error") and a result for each zone ID
+              in the same order, {"status": "success"} or {"status": "error", "message": str}.
+    """
+    if len(zone_ids) > MAX_BULK_ZONES:
+        raise HTTPException(
+            status_code=400,
+            detail={"status": "error", "message": f"At most {MAX_BULK_ZONES} zones can be deleted at once."},
         )
 
-        zone.payload = payload
+    valid_ids = [zone_id for zone_id in zone_ids if ObjectId.is_valid(zone_id)]
+    try:
+        deleted = await mongo_db.delete_zones(valid_ids)
+    except Exception as e:
+        logger.error("Error deleting zones", exc_info=e)
+        raise HTTPException(status_code=500, detail={"status": "error", "message": str(e)})
+
+    results = []
+    for zone_id in zone_ids:
+        if zone_id in deleted:
+            zone_index.remove(zone_id)
+            results.append({"status": "success"})
+        elif ObjectId.is_valid(zone_id):
+            results.append({"status": "error", "message": "Zone not found"})
+        else:
+            results.append({"status": "error", "message": "Invalid zone ID"})
+
+    return {"status": bulk_status(results), "results": results}
+
+
+def bulk_status(results: list[dict]) -> str:
+    succeeded = sum(result["status"] == "success" for result in results)
+    if succeeded == len(results):
+        return "success"
+    return "partial" if succeeded else "error"
+
+
+@router.post("/create_auto_group_zone")
+async def create_auto_group_zone(request: AutoGroupRequest):
+    validate_auto_group(request.rect, request.sampling_size, request.refresh_rate)
+
+    try:
+        zone = auto_group_zone(request, create_sub_zone_grid(request.rect, request.sampling_size))
         await mongo_db.insert_zone(zone)
+        zone_index.upsert(zone)
 
         Background.refresh_zones()
 
-        return zone
+        return await expand_grid_for_response(zone)
 
     except Exception as e:
         logger.error("Error creating zone", exc_info=e)
         raise HTTPException(status_code=500, detail={"status": "error", "message": str(e)})
 
 
-def create_sub_zones(zone_name: str, zone_type: ZoneType, rect: list[float], sampling_size: int) -> list[Zone]:
+def validate_auto_group(rect: list[float], sampling_size: int, refresh_rate: int):
+    """
+    Raises HTTPException when an auto group with these parameters can't be created.
+    Call it before the handler's `except Exception`, which would turn the 400 into a 500.
+    """
+    if sampling_size < 1000:
+        raise HTTPException(
+            status_code=400,
+            detail={"status": "error", "message": "Sampling size must be greater than 1000."},
+        )
+
+    if refresh_rate < 600:
+        raise HTTPException(
+            status_code=400,
+            detail={"status": "error", "message": "Refresh rate must be greater than 600."},
+        )
+
+    columns, rows, _, _ = sub_zone_grid_dimensions(rect, sampling_size)
+    if columns * rows > MAX_SUB_ZONES:
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "status": "error",
+                "message": f"The zone would have {columns * rows} sub-zones, at most {MAX_SUB_ZONES} are allowed.",
+            },
+        )
+
+
+def auto_group_zone(request: AutoGroupRequest, grid: SubZoneGrid) -> Zone:
+    """New auto group zone whose sub-zones are the cells of the grid."""
+    zone = Zone(
+        name=request.name,
+        zone_type=ZoneType.AUTO_GROUP,
+        bbox=create_zone_bbox(request.rect),
+    )
+
+    zone.payload = AutoGroupPayload(
+        sampling_size=request.sampling_size,
+        refresh_rate=request.refresh_rate,
+        sub_zone_type=request.sub_zone_type,
+        threshold=request.threshold,
+        grid=grid,
+    )
+    return zone
+
+
+@router.get("/estimate_sub_zones")
+async def estimate_sub_zones(sampling_size: int = Query(gt=0), rect: list[float] = Query()):
+    """
+    Estimate the sub-zones of an auto group before it is created.
+
+    Args:
+        sampling_size (int): The size of a sub-zone in meters.
+        rect (list[float]): The bounding box of the auto group as four `rect` parameters
+            [south_west_lat, south_west_lon, north_east_lat, north_east_lon].
+
+    Returns:
+        dict: The number of sub-zones (with columns and rows of the grid), size of a sub-zone
+              in meters and the maximum number of sub-zones an auto group may have.
+    """
+    if len(rect) != 4:
+        raise HTTPException(status_code=400, detail={"status": "error", "message": "rect must have four values."})
+
+    columns, rows, cell_width, cell_height = sub_zone_grid_dimensions(rect, sampling_size)
+    return {
+        "sub_zones": columns * rows,
+        "columns": columns,
+        "rows": rows,
+        "cell_width": cell_width,
+        "cell_height": cell_height,
+        "max_sub_zones": MAX_SUB_ZONES,
+    }
+
+
+async def expand_grid_for_response(zone: Zone) -> Zone:
+    """`with_expanded_grid` which builds sub-zones of large grids outside of the event loop."""
+    payload = zone.payload
+    if isinstance(payload, AutoGroupPayload) and payload.grid and payload.grid.cell_count > SUB_ZONE_THREAD_THRESHOLD:
+        return await asyncio.to_thread(with_expanded_grid, zone)
+    return with_expanded_grid(zone)
+
+
+def sub_zone_grid_dimensions(rect: list[float], sampling_size: int) -> tuple[int, int, float, float]:
+    """
+    Dimensions of the sub-zone grid covering the rectangle.
+
+    Returns:
+        tuple: Number of columns and rows, width and height of a cell in meters.
+    """
     # Calculate the width and height of the zone in meters
     width = geodesic((rect[0], rect[1]), (rect[0], rect[3])).meters
     height = geodesic((rect[0], rect[1]), (rect[2], rect[1])).meters
@@ -183,28 +575,24 @@ def create_sub_zones(zone_name: str, zone_type: ZoneType, rect: list[float], sam
     num_rects_width = int(width / sampling_size) if width >= sampling_size else 1
     num_rects_height = int(height / sampling_size) if height >= sampling_size else 1
 
-    # Create the set of rectangles
-    rect_width = width / num_rects_width
-    rect_height = height / num_rects_height
-
-    zones = list()
-    for i in range(num_rects_width):
-        for j in range(num_rects_height):
-            sw_lat = rect[0] + (j * rect_height / 111320)  # Convert meters to degrees
-            sw_lon = rect[1] + (i * rect_width / (111320 * math.cos(math.radians(rect[0]))))
-            ne_lat = sw_lat + (rect_height / 111320)
-            ne_lon = sw_lon + (rect_width / (111320 * math.cos(math.radians(sw_lat))))
-            zones.append(
-                Zone(
-                    _id=ObjectId(),
-                    name=f"{zone_name}_{i}_{j}",
-                    zone_type=zone_type,
-                    bbox=create_zone_bbox([sw_lat, sw_lon, ne_lat, ne_lon]),
-                    active=False,  # sub-zones are inactive by default
-                )
-            )
+    return num_rects_width, num_rects_height, width / num_rects_width, height / num_rects_height
 
-    return zones
+
+def create_sub_zone_grid(rect: list[float], sampling_size: int) -> SubZoneGrid:
+    """Compact grid of the sub-zones `create_sub_zones` creates for the same rectangle."""
+    columns, rows, cell_width, cell_height = sub_zone_grid_dimensions(rect, sampling_size)
+    return SubZoneGrid(
+        south_west=GeoPoint(lat=rect[0], lon=rect[1]),
+        cell_width=cell_width,
+        cell_height=cell_height,
+        columns=columns,
+        rows=rows,
+        active=[False] * (columns * rows),  # sub-zones are inactive by default
+    )
+
+
+def create_sub_zones(zone_name: str, zone_type: ZoneType, rect: list[float], sampling_size: int) -> list[Zone]:
+    return create_sub_zone_grid(rect, sampling_size).to_zones(zone_name, zone_type, with_ids=True)
 
 
 @router.put("/edit_zone")
@@ -233,28 +621,32 @@ async def edit_zone(zone_id: str, zone_type: ZoneType, zone_name: str = ""):
 
         if zone.zone_type != zone_type:
             zone.zone_type = zone_type
-            if zone.zone_type in {ZoneType.WIND, ZoneType.RAIN, ZoneType.VISIBILITY, ZoneType.TEMPERATURE}:
-                weather = await get_weather_by_bbox(zone.bbox)
-                zone.set_weather_payload(weather)
+            if zone.zone_type in weather_types:
+                weather, fetched_at = await get_weather_by_bbox(zone.bbox)
+                zone.set_weather_payload(weather, fetched_at)
             update = True
 
         if update:
             if await mongo_db.update_zone(zone) is False:
                 raise HTTPException(status_code=404, detail={"status": "error", "message": "Zone not found"})
+            zone_index.upsert(zone)
     except Exception as e:
         logger.error("Error creating zone", exc_info=e)
         raise HTTPException(status_code=500, detail={"status": "error", "message": str(e)})
 
-    return zone.model_dump(exclude_none=True)
+    return (await expand_grid_for_response(zone)).model_dump(exclude_none=True)
 
 
 @router.put("/refresh_zone")
-async def refresh_zone(zone_id: str):
+async def refresh_zone(zone_id: str, max_age: Optional[float] = Query(default=None, ge=0)):
     """
     Refresh weather data for a zone by its ID.
 
     Args:
         zone_id (str): The ID of the zone to refresh.
+        max_age (Optional[float]): When set, weather fetched at most this many seconds ago is returned
+            without calling OpenWeather. Without it, the weather is always fetched from OpenWeather,
+            bypassing the weather cache.
 
     Returns:
         dict: A dictionary with the status of the operation and updated zone data.
@@ -265,55 +657,76 @@ async def refresh_zone(zone_id: str):
         if (zone := await mongo_db.get_zone(zone_id)) is None:
             return {"status": "error", "message": "Zone not found"}
 
-        weather = await get_weather_by_bbox(zone.bbox)
-        zone.set_weather_payload(weather)
-
-        if await mongo_db.update_zone(zone) is False:
-            return {"status": "error", "message": "Failed to update zone"}
+        fresh_after = None if max_age is None else datetime.datetime.now() - datetime.timedelta(seconds=max_age)
+        if fresh_after is None or zone.weather_updated_at is None or zone.weather_updated_at < fresh_after:
+            # an explicit refresh without max_age always calls OpenWeather
+            if not await refresh_zone_weather(zone, max_age=0 if max_age is None else max_age):
+                return {"status": "error", "message": "Failed to update zone"}
 
     except Exception as e:
         logger.error("Error creating zone", exc_info=e)
         raise HTTPException(status_code=500, detail={"status": "error", "message": str(e)})
 
-    return zone
+    return await expand_grid_for_response(zone)
 
 
 @router.post("/local_situation")
 async def local_situation(request: LocalSituationRequest):
+    # Calculate rectangle bounds
+    half_width_deg = (request.width / 2) / (111320 * math.cos(math.radians(request.lat)))
+    half_height_deg = (request.height / 2) / 111320
+    rect = [
+        request.lat - half_height_deg,
+        request.lon - half_width_deg,
+        request.lat + half_height_deg,
+        request.lon + half_width_deg,
+    ]
+
+    validate_auto_group(rect, request.sampling_size, request.refresh_rate)
+
     try:
         # Validate weather types
-        valid_weather_types = {ZoneType.WIND, ZoneType.RAIN, ZoneType.VISIBILITY, ZoneType.TEMPERATURE}
-        if not set(request.weather_types).issubset(valid_weather_types):
+        if not set(request.weather_types).issubset(single_weather_types):
             raise HTTPException(
                 status_code=400,
                 detail={"status": "error", "message": "Invalid weather types provided."},
             )
 
-        # Calculate rectangle bounds
-        half_width_deg = (request.width / 2) / (111320 * math.cos(math.radians(request.lat)))
-        half_height_deg = (request.height / 2) / 111320
-        rect = [
-            request.lat - half_height_deg,
-            request.lon - half_width_deg,
-            request.lat + half_height_deg,
-            request.lon + half_width_deg,
+        # all groups cover the same rectangle, the grid is computed once and each group gets its own copy
+        grid = create_sub_zone_grid(rect, request.sampling_size)
+        # a combined group fetches the weather of all types with one upstream call per sample point
+        group_types = [ZoneType.WEATHER] if request.combined else request.weather_types
+        zones = [
+            auto_group_zone(
+                AutoGroupRequest(
+                    name=f"local_{weather_type.value}",
+                    rect=rect,
+                    sampling_size=request.sampling_size,
+                    refresh_rate=request.refresh_rate,
+                    sub_zone_type=weather_type,
+                ),
+                grid.model_copy(deep=True),
+            )
+            for weather_type in group_types
         ]
 
-        created_zones = []
-        for weather_type in request.weather_types:
-            zone_name = f"local_{weather_type.value}"
-            request = AutoGroupRequest(
-                name=zone_name,
-                rect=rect,
-                sampling_size=request.sampling_size,
-                refresh_rate=request.refresh_rate,
-                sub_zone_type=weather_type,
-            )
-            created_zone = await create_auto_group_zone(request)
-            created_zones.append(created_zone)
+        errors = await mongo_db.insert_zones(zones)
+        if failed := [error for error in errors if error is not None]:
+            # the situation is created as a whole, groups inserted before the failure are removed again
+            await mongo_db.delete_zones([zone.id for zone, error in zip(zones, errors) if error is None])
+            raise ValueError(f"Failed to create {len(failed)} of {len(zones)} zones: {failed[0]}")
+
+        for zone in zones:
+            zone_index.upsert(zone)
+
+        # one refresh batch for all new groups
+        Background.refresh_zones()
 
+        created_zones = [await expand_grid_for_response(zone) for zone in zones]
         return created_zones
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error("Error creating local situation zones", exc_info=e)
         raise HTTPException(status_code=500, detail={"status": "error", "message": str(e)})
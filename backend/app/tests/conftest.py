@@ -7,6 +7,7 @@ from fastapi.testclient import TestClient
 from app.main import app
 from app.types.zone_types import AutoGroupPayload, GeoPoint, Threshold, Zone, ZoneBBox, ZoneType
 from app.client.mongo import mongo_db
+from app.zone_index import zone_index
 from .zone_client import ZoneClient
 
 MONGODB_CONNECTION_STRING = os.getenv("MONGODB_CONNECTION_STRING")
@@ -17,6 +18,8 @@ MONGODB_CONNECTION_STRING = os.getenv("MONGODB_CONNECTION_STRING")
 def update_app_database():
     mongo_db._db = mongo_db._client["gaof-db-test"]
     mongo_db._zones = mongo_db._db["zones"]
+    mongo_db._sub_zones = mongo_db._db["sub_zones"]
+    zone_index.invalidate()
     yield
 
 
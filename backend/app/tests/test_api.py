@@ -1,14 +1,24 @@
+import asyncio
+import datetime
+import json
+import pytest
 from bson import ObjectId
 from pymongo.collection import Collection
+from app.client.mongo import mongo_db
+from app.client.weather_cache import weather_cache
 from app.tests.zone_client import ZoneClient
 from app.types.zone_types import (
     AutoGroupPayload,
     AutoGroupRequest,
     CreateZoneRequest,
+    GeoPoint,
+    LocalSituationRequest,
     Restriction,
+    RouteRequest,
     Threshold,
     Zone,
     ZoneType,
+    create_zone_bbox,
     type_mapping,
 )
 
@@ -96,6 +106,46 @@ def test_refresh_zone(zone_client: ZoneClient, default_zones: list[Zone], zone_c
     assert Zone(**zone_doc) == zone
 
 
+def test_refresh_zone_max_age(zone_client: ZoneClient, default_zones: list[Zone], zone_collection: Collection):
+    refreshed = zone_client.refresh(zone_id=default_zones[0].id)
+    assert refreshed.weather_updated_at is not None
+
+    # an explicit refresh fetches the weather again instead of taking it from the weather cache
+    misses = weather_cache.stats()["misses"]
+    refreshed = zone_client.refresh(zone_id=default_zones[0].id)
+    assert weather_cache.stats()["misses"] == misses + 1
+
+    # fresh enough, returned without fetching the weather again
+    zone = zone_client.refresh(zone_id=default_zones[0].id, max_age=3600)
+    assert zone == refreshed
+
+    zone = zone_client.refresh(zone_id=default_zones[0].id, max_age=0)
+    assert zone.weather_updated_at >= refreshed.weather_updated_at
+    zone_doc = zone_collection.find_one({"_id": ObjectId(zone.id)})
+    assert Zone(**zone_doc) == zone
+
+
+def test_near_zones_stale_after(zone_client: ZoneClient, default_zones: list[Zone], zone_collection: Collection):
+    updated_at = datetime.datetime(2025, 3, 11, 19, 54, 26)
+    zone_collection.update_many(
+        {}, {"$set": {"zone_type": ZoneType.RAIN, "payload": {"precipitation": 0.0}, "weather_updated_at": updated_at}}
+    )
+
+    response = zone_client.client.post(
+        "/near_zones", params={"lat": 0.5, "lon": 0.5, "radius": 1000, "stale_after": 60}
+    )
+    response.raise_for_status()
+    # the stale weather is returned, it is refreshed after the response
+    assert [zone["weather_updated_at"] for zone in response.json()] == [updated_at.isoformat()] * len(default_zones)
+    for zone_doc in zone_collection.find():
+        assert zone_doc["weather_updated_at"] > updated_at
+
+    response = zone_client.client.post(
+        "/near_zones", params={"lat": 0.5, "lon": 0.5, "radius": 1000, "stale_after": 60}
+    )
+    assert all(zone["weather_updated_at"] != updated_at.isoformat() for zone in response.json())
+
+
 def test_create_auto_group_zone(zone_client: ZoneClient, zone_collection: Collection):
     request_data = AutoGroupRequest(
         name="autozone",
@@ -114,3 +164,198 @@ def test_create_auto_group_zone(zone_client: ZoneClient, zone_collection: Collec
     payload: AutoGroupPayload = zone.payload
     assert payload.sub_zone_type is ZoneType.RAIN
     assert len(payload.zones) == 3
+
+
+@pytest.mark.parametrize(
+    "path, request_data",
+    [
+        (
+            "/create_auto_group_zone",
+            AutoGroupRequest(
+                name="autozone",
+                rect=[0, 0, 10, 10],
+                sampling_size=1000,
+                refresh_rate=600,
+                threshold={},
+                sub_zone_type=ZoneType.RAIN,
+            ),
+        ),
+        (
+            "/local_situation",
+            LocalSituationRequest(
+                lat=51.47,
+                lon=0.38,
+                width=400000,
+                height=400000,
+                sampling_size=1000,
+                refresh_rate=600,
+                weather_types=[ZoneType.WIND],
+            ),
+        ),
+    ],
+    ids=["auto_group", "local_situation"],
+)
+def test_too_many_sub_zones(zone_client: ZoneClient, zone_collection: Collection, path: str, request_data):
+    response = zone_client.client.post(path, json=request_data.model_dump())
+    assert response.status_code == 400
+    assert "sub-zones" in response.json()["detail"]["message"]
+    assert zone_collection.count_documents({}) == 0
+
+
+def test_list_zones_pages(zone_client: ZoneClient, default_zones: list[Zone]):
+    response = zone_client.client.get("/list_zones", params={"limit": 2})
+    response.raise_for_status()
+    first_page = response.json()
+    assert len(first_page) == 2
+
+    response = zone_client.client.get("/list_zones", params={"limit": 2, "after": response.headers["X-Next-Cursor"]})
+    response.raise_for_status()
+    second_page = response.json()
+    assert "X-Next-Cursor" not in response.headers
+
+    ids = [zone["id"] for zone in first_page + second_page]
+    assert ids == sorted(zone.id for zone in default_zones)
+
+
+def test_list_zones_stream(zone_client: ZoneClient, default_zones: list[Zone], auto_group_zone: Zone):
+    response = zone_client.client.get("/list_zones", params={"stream": True, "include_sub_zones": False})
+    response.raise_for_status()
+    assert response.headers["content-type"] == "application/x-ndjson"
+
+    zones = [json.loads(line) for line in response.text.splitlines()]
+    assert len(zones) == len(default_zones) + 1
+    group = next(zone for zone in zones if zone["zone_type"] == ZoneType.AUTO_GROUP)
+    assert "zones" not in group["payload"]
+
+
+def test_estimate_sub_zones(zone_client: ZoneClient):
+    rect = [51.43603249210615, 0.2943841187722374, 51.49912573429843, 0.4798380110186385]
+    response = zone_client.client.get("/estimate_sub_zones", params={"rect": rect, "sampling_size": 4000})
+    response.raise_for_status()
+    estimate = response.json()
+    assert estimate["sub_zones"] == estimate["columns"] * estimate["rows"] == 3 * 1
+    assert estimate["sub_zones"] <= estimate["max_sub_zones"]
+
+
+def test_create_and_delete_zones_bulk(zone_client: ZoneClient, zone_collection: Collection):
+    zone_rect = [51.43603249210615, 0.2943841187722374, 51.49912573429843, 0.4798380110186385]
+    requests = [
+        CreateZoneRequest(zone_rect=zone_rect, zone_name=f"bulk_{i}", zone_type=zone_type)
+        for i, zone_type in enumerate([ZoneType.RAIN, ZoneType.WIND, ZoneType.EMPTY])
+    ]
+    response = zone_client.client.post("/create_zones_bulk", json=[request.model_dump() for request in requests])
+    response.raise_for_status()
+    created = response.json()
+    assert created["status"] == "success"
+    created_zones = [result["zone"] for result in created["results"]]
+    assert [zone["name"] for zone in created_zones] == ["bulk_0", "bulk_1", "bulk_2"]
+    assert zone_collection.count_documents({}) == 3
+
+    zone_ids = [created_zones[0]["id"], created_zones[2]["id"], str(ObjectId()), "invalid"]
+    response = zone_client.client.post("/delete_zones_bulk", json=zone_ids)
+    response.raise_for_status()
+    deleted = response.json()
+    assert deleted["status"] == "partial"
+    assert [result["status"] for result in deleted["results"]] == ["success", "success", "error", "error"]
+    assert [zone["_id"] for zone in zone_collection.find()] == [ObjectId(created_zones[1]["id"])]
+
+
+def test_local_situation(zone_client: ZoneClient, zone_collection: Collection):
+    request = LocalSituationRequest(
+        lat=51.47,
+        lon=0.38,
+        width=12500,
+        height=8500,
+        sampling_size=4000,
+        refresh_rate=600,
+        weather_types=[ZoneType.WIND, ZoneType.RAIN],
+    )
+    response = zone_client.client.post("/local_situation", json=request.model_dump())
+    response.raise_for_status()
+    zones = response.json()
+    assert [zone["name"] for zone in zones] == ["local_wind", "local_rain"]
+    assert [zone["payload"]["sub_zone_type"] for zone in zones] == ["wind", "rain"]
+    assert len(zones[0]["payload"]["zones"]) == len(zones[1]["payload"]["zones"]) == 3 * 2
+    assert zone_collection.count_documents({"zone_type": ZoneType.AUTO_GROUP}) == 2
+
+
+def test_local_situation_combined(zone_client: ZoneClient, zone_collection: Collection):
+    request = LocalSituationRequest(
+        lat=51.47,
+        lon=0.38,
+        width=12500,
+        height=8500,
+        sampling_size=4000,
+        refresh_rate=600,
+        weather_types=[ZoneType.WIND, ZoneType.RAIN],
+        combined=True,
+    )
+    response = zone_client.client.post("/local_situation", json=request.model_dump())
+    response.raise_for_status()
+    zones = response.json()
+    assert [zone["name"] for zone in zones] == ["local_weather"]
+    assert zones[0]["payload"]["sub_zone_type"] == ZoneType.WEATHER
+    assert zone_collection.count_documents({"zone_type": ZoneType.AUTO_GROUP}) == 1
+
+
+def test_local_situation_invalid_weather_types(zone_client: ZoneClient):
+    request = LocalSituationRequest(
+        lat=51.47,
+        lon=0.38,
+        width=12500,
+        height=8500,
+        sampling_size=4000,
+        refresh_rate=600,
+        weather_types=[ZoneType.AUTO_GROUP],
+    )
+    response = zone_client.client.post("/local_situation", json=request.model_dump())
+    assert response.status_code == 400
+
+
+def test_local_situation_partial_failure(zone_client: ZoneClient, zone_collection: Collection, monkeypatch):
+    insert_zones = mongo_db.insert_zones
+
+    async def insert_first_zone(zones: list[Zone]):
+        # the second group fails as with a write error of the unordered insert_many
+        errors = await insert_zones(zones[:1])
+        zones[1].id = None
+        return errors + ["E11000 duplicate key error"]
+
+    monkeypatch.setattr(mongo_db, "insert_zones", insert_first_zone)
+    request = LocalSituationRequest(
+        lat=51.47,
+        lon=0.38,
+        width=12500,
+        height=8500,
+        sampling_size=4000,
+        refresh_rate=600,
+        weather_types=[ZoneType.WIND, ZoneType.RAIN],
+    )
+    response = zone_client.client.post("/local_situation", json=request.model_dump())
+    assert response.status_code == 500
+    assert zone_collection.count_documents({}) == 0
+
+
+def test_route_zones(zone_client: ZoneClient, default_zones: list[Zone]):
+    route = RouteRequest(waypoints=[GeoPoint(lat=-0.5, lon=0.5), GeoPoint(lat=1.5, lon=0.5)], width=100)
+    response = zone_client.client.post("/route_zones", json=route.model_dump())
+    response.raise_for_status()
+    assert sorted(zone["name"] for zone in response.json()) == [zone.name for zone in default_zones]
+
+    route.waypoints = [GeoPoint(lat=2.0, lon=2.0), GeoPoint(lat=3.0, lon=3.0)]
+    response = zone_client.client.post("/route_zones", json=route.model_dump())
+    response.raise_for_status()
+    assert response.json() == []
+
+
+def test_route_zones_across_antimeridian(zone_client: ZoneClient, zone_collection: Collection):
+    zones = [
+        Zone(name="west", zone_type=ZoneType.EMPTY, bbox=create_zone_bbox([-33.8, 179.8, -33.7, 179.95])),
+        Zone(name="east", zone_type=ZoneType.EMPTY, bbox=create_zone_bbox([-33.8, -179.95, -33.7, -179.8])),
+    ]
+    asyncio.run(mongo_db.insert_zones(zones))
+
+    route = RouteRequest(waypoints=[GeoPoint(lat=-33.75, lon=179.7), GeoPoint(lat=-33.75, lon=-179.7)], width=2000)
+    response = zone_client.client.post("/route_zones", json=route.model_dump())
+    response.raise_for_status()
+    assert [zone["name"] for zone in response.json()] == ["west", "east"]
@@ -0,0 +1,271 @@
+import asyncio
+import datetime
+import pytest
+from bson import ObjectId
+from pymongo.collection import Collection
+from pymongo.errors import AutoReconnect
+from app import background
+from app.background import Background
+from app.client.mongo import LeaseLostError, mongo_db
+from app.routers.zones import create_sub_zone_grid, create_sub_zones
+from app.types.zone_types import AutoGroupPayload, RainPayload, Zone, ZoneType, create_zone_bbox
+
+GROUP_RECT = [51.0, 0.0, 51.1, 0.1]
+WEATHER = {"rain": {"1h": 1.5}, "main": {"temp": 7.5}}
+FETCHED_AT = datetime.datetime(2026, 3, 11, 19, 54, 26)
+
+
+def auto_group(grid: bool = False, next_refresh: datetime.datetime = None) -> Zone:
+    return Zone(
+        name="group",
+        zone_type=ZoneType.AUTO_GROUP,
+        bbox=create_zone_bbox(GROUP_RECT),
+        payload=AutoGroupPayload(
+            sampling_size=4000,
+            refresh_rate=60,
+            next_refresh=next_refresh or datetime.datetime.now() + datetime.timedelta(hours=1),
+            sub_zone_type=ZoneType.RAIN,
+            zones=[] if grid else create_sub_zones("group", ZoneType.RAIN, GROUP_RECT, 4000),
+            grid=create_sub_zone_grid(GROUP_RECT, 4000) if grid else None,
+        ),
+    )
+
+
+@pytest.fixture(params=["embedded", "collection"])
+def storage(request, monkeypatch, zone_collection: Collection) -> str:
+    monkeypatch.setattr(mongo_db, "sub_zone_storage", request.param)
+    zone_collection.database.drop_collection("sub_zones")
+    return request.param
+
+
+@pytest.fixture
+def fake_weather(monkeypatch) -> list[tuple[float, float]]:
+    calls = []
+
+    async def get_weather_by_coordinates(lat: float, lon: float):
+        calls.append((lat, lon))
+        return WEATHER, FETCHED_AT
+
+    monkeypatch.setattr(background, "get_weather_by_coordinates", get_weather_by_coordinates)
+    return calls
+
+
+def test_refresh_reports_changed_positions(fake_weather: list):
+    worker = Background()
+    payload = auto_group().payload
+    changed, samples, fetched_at = asyncio.run(worker._refresh_sub_zones(payload))
+    assert changed == list(range(len(payload.zones)))
+    assert samples == len(fake_weather)
+    assert fetched_at == FETCHED_AT
+
+    # the same weather again, nothing changed
+    changed, _, _ = asyncio.run(worker._refresh_sub_zones(payload))
+    assert changed == []
+
+    payload.zones[1].payload = RainPayload(precipitation=0.0)
+    changed, _, _ = asyncio.run(worker._refresh_sub_zones(payload))
+    assert changed == [1]
+
+    grid_payload = auto_group(grid=True).payload
+    changed, _, _ = asyncio.run(worker._refresh_grid(grid_payload))
+    assert changed == list(range(grid_payload.grid.cell_count))
+    changed, _, _ = asyncio.run(worker._refresh_grid(grid_payload))
+    assert changed == []
+
+
+def test_update_refreshed_sub_zones_writes_changed_positions(storage: str, zone_collection: Collection):
+    async def run():
+        group = await mongo_db.insert_zone(auto_group())
+        # stored by someone else, an unchanged sub-zone must not be overwritten
+        marker = {"precipitation": 99.0}
+        if storage == "collection":
+            await mongo_db._sub_zones.update_one(
+                {"parent_id": ObjectId(group.id), "position": 0}, {"$set": {"payload": marker}}
+            )
+        else:
+            await mongo_db._zones.update_one({"_id": ObjectId(group.id)}, {"$set": {"payload.zones.0.payload": marker}})
+
+        group.payload.zones[1].payload = RainPayload(precipitation=5.0)
+        group.payload.zones[1].active = False
+        group.weather_updated_at = datetime.datetime(2026, 1, 1, 12, 0)
+        changed_bytes = await mongo_db.update_refreshed_sub_zones(group, [1])
+        unchanged_bytes = await mongo_db.update_refreshed_sub_zones(group, [])
+        return group, changed_bytes, unchanged_bytes, await mongo_db.get_zone(group.id)
+
+    group, changed_bytes, unchanged_bytes, stored = asyncio.run(run())
+    assert changed_bytes > unchanged_bytes > 0
+
+    sub_zones = stored.payload.zones
+    assert len(sub_zones) == len(group.payload.zones)
+    assert sub_zones[0].payload == RainPayload(precipitation=99.0)
+    assert sub_zones[1].payload == RainPayload(precipitation=5.0)
+    assert sub_zones[1].active is False
+    assert all(sub_zone.payload is None for sub_zone in sub_zones[2:])
+    assert stored.weather_updated_at == group.weather_updated_at
+    assert all(sub_zone.weather_updated_at == group.weather_updated_at for sub_zone in sub_zones)
+
+
+async def wait_for_refresh(zone_id: str, timeout: float = 2) -> Zone:
+    for _ in range(int(timeout / 0.02)):
+        if (stored := await mongo_db.get_zone(zone_id)).weather_updated_at is not None:
+            return stored
+        await asyncio.sleep(0.02)
+    return stored
+
+
+def test_pop_due_in_next_refresh_order():
+    worker = Background()
+    now = datetime.datetime.now()
+    for offset, zone_id in [(30, "c"), (-10, "a"), (-20, "b"), (-5, "a"), (-1, "d")]:
+        worker._schedule_refresh(now + datetime.timedelta(seconds=offset), zone_id)
+    worker._refreshing["d"] = None
+
+    due = worker._pop_due(now)
+    assert list(due) == ["b", "a"]
+    assert due["a"] == now - datetime.timedelta(seconds=10)
+    assert worker._schedule == [(now + datetime.timedelta(seconds=30), "c")]
+
+
+def test_background_wakes_up_on_refresh_zones(fake_weather: list, zone_collection: Collection):
+    async def run():
+        async with Background() as worker:
+            await asyncio.sleep(0.05)  # the empty schedule is loaded, the task sleeps until the next reload
+            group = await mongo_db.insert_zone(auto_group(next_refresh=datetime.datetime.now()))
+            Background.refresh_zones()
+            stored = await wait_for_refresh(group.id)
+            assert not worker._background_task.done()
+        return stored
+
+    stored = asyncio.run(run())
+    assert stored.weather_updated_at is not None
+    assert stored.payload.next_refresh > datetime.datetime.now()
+    assert fake_weather
+
+
+def test_background_survives_database_errors(monkeypatch, fake_weather: list, zone_collection: Collection):
+    monkeypatch.setattr(Background, "ERROR_BACKOFF", 0.01)
+    get_refresh_schedule, claim_zone_for_refresh = mongo_db.get_refresh_schedule, mongo_db.claim_zone_for_refresh
+    failures = {"schedule": 1, "claim": 1}
+
+    async def failing_get_refresh_schedule(*args):
+        if failures["schedule"]:
+            failures["schedule"] -= 1
+            raise AutoReconnect("connection lost")
+        return await get_refresh_schedule(*args)
+
+    async def failing_claim_zone_for_refresh(*args):
+        if failures["claim"]:
+            failures["claim"] -= 1
+            raise AutoReconnect("connection lost")
+        return await claim_zone_for_refresh(*args)
+
+    monkeypatch.setattr(mongo_db, "get_refresh_schedule", failing_get_refresh_schedule)
+    monkeypatch.setattr(mongo_db, "claim_zone_for_refresh", failing_claim_zone_for_refresh)
+
+    async def run():
+        group = await mongo_db.insert_zone(auto_group(next_refresh=datetime.datetime.now()))
+        async with Background() as worker:
+            stored = await wait_for_refresh(group.id)
+            assert not worker._background_task.done()
+        return stored
+
+    # stamped with the fetch time of the weather, not with the time of the refresh
+    assert asyncio.run(run()).weather_updated_at == FETCHED_AT
+    assert failures == {"schedule": 0, "claim": 0}
+
+
+def test_claim_and_release_lease(zone_collection: Collection):
+    async def run():
+        now = datetime.datetime.now()
+        group = await mongo_db.insert_zone(auto_group(next_refresh=now))
+
+        assert await mongo_db.claim_zone_for_refresh(group.id, now, "a", 60) is not None
+        assert await mongo_db.claim_zone_for_refresh(group.id, now, "b", 60) is None
+        assert await mongo_db.release_zone_lease(group.id, "b", now) is False
+
+        assert await mongo_db.release_zone_lease(group.id, "a", now) is True
+        assert await mongo_db.claim_zone_for_refresh(group.id, now, "b", 60) is not None
+
+    asyncio.run(run())
+
+
+def test_expired_lease_is_claimed_again(storage: str, zone_collection: Collection):
+    async def run():
+        now = datetime.datetime.now()
+        group = await mongo_db.insert_zone(auto_group(next_refresh=now))
+        lost = await mongo_db.claim_zone_for_refresh(group.id, now, "a", 1)
+
+        # "a" did not renew the lease in time
+        later = now + datetime.timedelta(seconds=2)
+        claimed = await mongo_db.claim_zone_for_refresh(group.id, later, "b", 60)
+        assert claimed is not None
+        assert await mongo_db.renew_zone_lease(group.id, "a", 60) is False
+        assert await mongo_db.renew_zone_lease(group.id, "b", 60) is True
+
+        # the write of the worker which lost the lease is refused and doesn't touch the sub-zones
+        lost.payload.zones[0].payload = RainPayload(precipitation=5.0)
+        with pytest.raises(LeaseLostError):
+            await mongo_db.update_refreshed_sub_zones(lost, [0], "a")
+        assert (await mongo_db.get_zone(group.id)).payload.zones[0].payload is None
+
+        claimed.payload.next_refresh = later + datetime.timedelta(minutes=1)
+        await mongo_db.update_refreshed_sub_zones(claimed, [], "b")
+        assert "lease" not in zone_collection.find_one({"_id": ObjectId(group.id)})
+
+    asyncio.run(run())
+
+
+def test_lease_is_renewed_during_refresh(monkeypatch, zone_collection: Collection):
+    monkeypatch.setattr(Background, "LEASE_TIME", 0.09)
+
+    async def slow_weather(lat: float, lon: float):
+        await asyncio.sleep(0.2)
+        return WEATHER, FETCHED_AT
+
+    monkeypatch.setattr(background, "get_weather_by_coordinates", slow_weather)
+
+    async def run():
+        now = datetime.datetime.now()
+        group = await mongo_db.insert_zone(auto_group(next_refresh=now))
+        worker = Background()
+        zone = await mongo_db.claim_zone_for_refresh(group.id, now, worker._worker_id, Background.LEASE_TIME)
+
+        async def competing_claim():
+            # the lease would have expired by now without the renewal
+            await asyncio.sleep(0.15)
+            return await mongo_db.claim_zone_for_refresh(group.id, datetime.datetime.now(), "b", 60)
+
+        refreshed, competing = await asyncio.gather(worker._refresh_group(zone), competing_claim())
+        assert refreshed is True
+        assert competing is None
+        return await mongo_db.get_zone(group.id)
+
+    # stamped with the fetch time of the weather, not with the time of the refresh
+    assert asyncio.run(run()).weather_updated_at == FETCHED_AT
+
+
+def test_refresh_stops_when_lease_is_lost(monkeypatch, zone_collection: Collection):
+    monkeypatch.setattr(Background, "LEASE_TIME", 0.09)
+    calls = []
+
+    async def slow_weather(lat: float, lon: float):
+        await asyncio.sleep(0.2)
+        calls.append((lat, lon))
+        return WEATHER, FETCHED_AT
+
+    monkeypatch.setattr(background, "get_weather_by_coordinates", slow_weather)
+
+    async def run():
+        now = datetime.datetime.now()
+        group = await mongo_db.insert_zone(auto_group(next_refresh=now))
+        worker = Background()
+        zone = await mongo_db.claim_zone_for_refresh(group.id, now, worker._worker_id, Background.LEASE_TIME)
+        await mongo_db._zones.update_one({"_id": ObjectId(group.id)}, {"$set": {"lease.owner": "other"}})
+
+        assert await worker._refresh_group(zone) is False
+        return await mongo_db.get_zone(group.id)
+
+    stored = asyncio.run(run())
+    assert calls == []  # the weather requests were cancelled
+    assert stored.weather_updated_at is None
+    assert zone_collection.find_one({"_id": ObjectId(stored.id)})["lease"]["owner"] == "other"
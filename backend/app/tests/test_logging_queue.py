@@ -0,0 +1,44 @@
+import logging
+import queue
+from app.logging_queue import DroppingQueueHandler, queued_logging
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+
+
+def test_queued_logging_hands_records_to_root_handlers():
+    root = logging.getLogger()
+    handler = ListHandler()
+    root.addHandler(handler)
+    try:
+        with queued_logging(level="INFO") as queue_handler:
+            assert root.handlers == [queue_handler]
+            logging.getLogger("app.test").info("refreshed %d sub-zones", 12, extra={"refresh": {"changed": 12}})
+            logging.getLogger("app.test").debug("filtered %s", "out")
+
+        assert handler in root.handlers
+        assert [record.getMessage() for record in handler.records] == ["refreshed 12 sub-zones"]
+        assert handler.records[0].refresh == {"changed": 12}
+    finally:
+        root.removeHandler(handler)
+
+
+def test_full_queue_drops_records():
+    queue_handler = DroppingQueueHandler(queue.Queue(1))
+    logger = logging.getLogger("app.test.dropping")
+    logger.propagate = False
+    logger.addHandler(queue_handler)
+    try:
+        for i in range(3):
+            logger.warning("record %d", i)
+    finally:
+        logger.removeHandler(queue_handler)
+
+    assert queue_handler.queue.qsize() == 1
+    assert queue_handler.dropped == 2
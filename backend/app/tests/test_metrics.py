@@ -0,0 +1,41 @@
+import pytest
+from app.metrics import Registry
+from app.tests.zone_client import ZoneClient
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    requests = registry.counter("requests", "Handled requests.", ("status",))
+    latency = registry.histogram("latency_seconds", "Request latency.", ("path",), buckets=(0.1, 1))
+
+    requests.inc(status=200)
+    requests.inc(2, status=200)
+    latency.observe(0.05, path="/a")
+    latency.observe(0.1, path="/a")
+    latency.observe(5, path="/a")
+
+    assert registry.render().splitlines() == [
+        "# HELP requests Handled requests.",
+        "# TYPE requests counter",
+        'requests_total{status="200"} 3',
+        "# HELP latency_seconds Request latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{path="/a",le="0.1"} 2',
+        'latency_seconds_bucket{path="/a",le="1"} 2',
+        'latency_seconds_bucket{path="/a",le="+Inf"} 3',
+        'latency_seconds_sum{path="/a"} 5.15',
+        'latency_seconds_count{path="/a"} 3',
+    ]
+
+    with pytest.raises(ValueError):
+        requests.inc(path="/a")
+
+
+def test_metrics_endpoint(zone_client: ZoneClient):
+    zone_client.get_near_zones(51.47, 0.38, 1000)
+
+    response = zone_client.client.get("/metrics")
+    response.raise_for_status()
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'http_request_duration_seconds_count{method="POST",path="/near_zones",status="200"}' in response.text
+    assert "near_zones_scanned_zones_count" in response.text
@@ -0,0 +1,32 @@
+from app.profiling import Profiler
+
+
+def busy(count: int) -> int:
+    return sum(i * i for i in range(count))
+
+
+def test_profiler_keeps_recent_profiles(tmp_path):
+    profiler = Profiler(sample_rate=1, header="", directory=str(tmp_path), keep=2)
+    for label in ("first", "second", "third"):
+        with profiler.maybe_profile(f"GET /{label}"):
+            busy(10_000)
+
+    profiles = profiler.profiles()
+    assert [profile["label"] for profile in profiles] == ["GET /third", "GET /second"]
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(profile["name"] for profile in profiles)
+    assert "busy" in profiler.report(profiles[0]["name"])
+    assert profiler.report("../unknown.prof") is None
+
+
+def test_profiler_disabled(tmp_path):
+    profiler = Profiler(sample_rate=0, header="", directory=str(tmp_path), keep=2)
+    assert not profiler.enabled
+
+    with profiler.maybe_profile("GET /zones"):
+        busy(1000)
+    assert profiler.profiles() == []
+    assert not tmp_path.exists() or not any(tmp_path.iterdir())
+
+    with profiler.maybe_profile("GET /zones", force=True):
+        busy(1000)
+    assert len(profiler.profiles()) == 1
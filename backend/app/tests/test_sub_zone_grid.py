@@ -0,0 +1,119 @@
+import numpy as np
+import pytest
+import random
+from bson import ObjectId
+from app.routers.zones import create_sub_zone_grid, create_sub_zones
+from app.types.zone_types import (
+    AutoGroupPayload,
+    GeoPoint,
+    TemperaturePayload,
+    WindPayload,
+    Zone,
+    ZoneType,
+    create_zone_bbox,
+    weather_payload,
+)
+from app.zone_index import GridEntry, ZoneIndex
+
+RECT = [51.43603249210615, 0.2943841187722374, 51.69912573429843, 0.6798380110186385]
+
+
+def test_grid_expands_to_created_sub_zones():
+    grid = create_sub_zone_grid(RECT, 2000)
+    sub_zones = create_sub_zones("group", ZoneType.TEMPERATURE, RECT, 2000)
+
+    grid.set_payload(
+        [0], TemperaturePayload(temp=7.5, temp_min=6.1, temp_max=8.0, pressure=1012, humidity=70), ZoneType.TEMPERATURE
+    )
+    expanded = grid.to_zones("group", ZoneType.TEMPERATURE)
+
+    assert len(expanded) == len(sub_zones) == grid.cell_count
+    for cell, sub_zone in zip(expanded, sub_zones):
+        assert cell.name == sub_zone.name
+        assert cell.active is False
+        for corner in ("south_west", "north_east"):
+            assert getattr(cell.bbox, corner).lat == pytest.approx(getattr(sub_zone.bbox, corner).lat, abs=1e-12)
+            assert getattr(cell.bbox, corner).lon == pytest.approx(getattr(sub_zone.bbox, corner).lon, abs=1e-12)
+    assert expanded[0].payload.temp == 7.5
+    assert expanded[1].payload is None
+
+
+def test_index_finds_grid_cells_like_sub_zones():
+    def auto_group(**payload) -> Zone:
+        return Zone(
+            _id=str(ObjectId()),
+            name="group",
+            zone_type=ZoneType.AUTO_GROUP,
+            bbox=create_zone_bbox(RECT),
+            payload=AutoGroupPayload(sampling_size=2000, refresh_rate=600, sub_zone_type=ZoneType.WIND, **payload),
+        )
+
+    grid_index, zones_index = ZoneIndex(), ZoneIndex()
+    grid_index._loaded = zones_index._loaded = True
+    grid_index.upsert(auto_group(grid=create_sub_zone_grid(RECT, 2000)))
+    zones_index.upsert(auto_group(zones=create_sub_zones("group", ZoneType.WIND, RECT, 2000)))
+
+    rng = random.Random(7)
+    for _ in range(100):
+        lat, lon, radius = rng.uniform(51.3, 51.8), rng.uniform(0.2, 0.8), rng.uniform(100, 20000)
+        found = [zone.name for zone in grid_index.query_radius(lat, lon, radius)]
+        assert found == [zone.name for zone in zones_index.query_radius(lat, lon, radius)]
+
+    for _ in range(50):
+        waypoints = [GeoPoint(lat=rng.uniform(51.3, 51.8), lon=rng.uniform(0.2, 0.8)) for _ in range(rng.randint(2, 4))]
+        width = rng.uniform(10, 5000)
+        found = [zone.name for zone in grid_index.query_route(waypoints, width)]
+        assert found == [zone.name for zone in zones_index.query_route(waypoints, width)]
+
+
+@pytest.mark.parametrize(
+    "rect",
+    [RECT, [-33.9, 179.6, -33.6, 180.3], [69.5, -20.0, 70.5, -17.0]],
+    ids=["london", "antimeridian", "arctic"],
+)
+def test_grid_window_finds_cells_of_a_full_scan(rect: list[float]):
+    zone = Zone(
+        _id=str(ObjectId()),
+        name="group",
+        zone_type=ZoneType.AUTO_GROUP,
+        bbox=create_zone_bbox(rect),
+        payload=AutoGroupPayload(
+            sampling_size=3000, refresh_rate=600, sub_zone_type=ZoneType.WIND, grid=create_sub_zone_grid(rect, 3000)
+        ),
+    )
+    entry = GridEntry(zone, 0, {})
+
+    rng = random.Random(11)
+    for _ in range(200):
+        lat = rng.uniform(rect[0] - 0.3, rect[2] + 0.3)
+        lon = (rng.uniform(rect[1] - 0.5, rect[3] + 0.5) + 180) % 360 - 180
+        radius = rng.uniform(100, 30000)
+        keys, _, _ = entry.query_radius(lat, lon, radius)
+        assert keys.tolist() == np.flatnonzero(entry.batch.within_radius_mask(lat, lon, radius)).tolist()
+
+    for _ in range(50):
+        waypoints = [
+            GeoPoint(lat=rng.uniform(rect[0] - 0.3, rect[2] + 0.3), lon=rng.uniform(rect[1] - 0.5, rect[3] + 0.5))
+            for _ in range(rng.randint(2, 3))
+        ]
+        half_width = rng.uniform(10, 5000)
+        keys, _, _ = entry.query_route(waypoints, half_width)
+        expected = np.flatnonzero(~np.isnan(entry.batch.route_positions(waypoints, half_width)))
+        assert sorted(keys.tolist()) == expected.tolist()
+
+
+def test_combined_weather_payload_views():
+    weather = {
+        "wind": {"speed": 6.2, "deg": 250},
+        "visibility": 8000,
+        "main": {"temp": 7.5, "temp_min": 6.1, "temp_max": 8.0, "pressure": 1012, "humidity": 70},
+    }
+    payload = weather_payload(ZoneType.WEATHER, weather)
+    for zone_type in (ZoneType.WIND, ZoneType.RAIN, ZoneType.VISIBILITY, ZoneType.TEMPERATURE):
+        assert payload.view(zone_type) == weather_payload(zone_type, weather)
+
+    grid = create_sub_zone_grid(RECT, 2000)
+    grid.set_payload([0], payload, ZoneType.WEATHER)
+    cell = grid.cell_zone("group", ZoneType.WEATHER, 0)
+    assert cell.payload == payload
+    assert cell.payload.view(ZoneType.WIND) == WindPayload(wind_speed=6.2, wind_direction=250)
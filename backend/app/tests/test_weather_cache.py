@@ -0,0 +1,100 @@
+import asyncio
+from types import SimpleNamespace
+from app.client import weather_cache
+from app.client.weather_cache import WeatherCache, snap_to_grid
+
+
+def test_snap_to_grid():
+    assert snap_to_grid(51.5577, 0.3871, 1000) == snap_to_grid(51.5578, 0.3872, 1000)
+    assert snap_to_grid(51.5577, 0.3871, 1000) != snap_to_grid(51.5777, 0.3871, 1000)
+    assert -180 <= snap_to_grid(10.0, 179.999, 5000)[1] < 180
+
+
+def test_weather_cache_coalesces_and_expires(monkeypatch):
+    calls = []
+    now = [1000.0]
+    # only the clock of the cache is replaced, the event loop keeps using the real one
+    monkeypatch.setattr(weather_cache, "time", SimpleNamespace(monotonic=lambda: now[0]))
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return {"temp": 7.5}
+
+    async def run():
+        cache = WeatherCache(ttl=60, max_size=1)
+        results = await asyncio.gather(*(cache.get_or_fetch("a", fetch) for _ in range(5)))
+        assert results == [{"temp": 7.5}] * 5
+        assert await cache.get_or_fetch("a", fetch) == {"temp": 7.5}
+        await cache.get_or_fetch("b", fetch)  # evicts "a"
+        await cache.get_or_fetch("a", fetch)
+
+        now[0] += 59
+        await cache.get_or_fetch("a", fetch)
+        now[0] += 1  # the TTL has passed
+        await cache.get_or_fetch("a", fetch)
+        return cache.stats()
+
+    stats = asyncio.run(run())
+    assert len(calls) == 4
+    assert stats["misses"] == 4
+    assert stats["coalesced"] == 4
+    assert stats["hits"] == 2
+
+
+def test_weather_cache_max_age():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return len(calls)
+
+    async def run():
+        cache = WeatherCache(ttl=60, max_size=10)
+        assert await cache.get_or_fetch("a", fetch) == 1
+        assert await cache.get_or_fetch("a", fetch, max_age=60) == 1
+        # 0 always fetches, the fetched value replaces the cached one
+        assert await cache.get_or_fetch("a", fetch, max_age=0) == 2
+        assert await cache.get_or_fetch("a", fetch) == 2
+
+    asyncio.run(run())
+    assert len(calls) == 2
+
+
+def test_weather_cache_cancelled_caller_does_not_fail_waiters():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.02)
+        return {"temp": 7.5}
+
+    async def run():
+        cache = WeatherCache(ttl=60, max_size=10)
+        leader = asyncio.create_task(cache.get_or_fetch("a", fetch))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(cache.get_or_fetch("a", fetch))
+        await asyncio.sleep(0)
+
+        leader.cancel()
+        assert await waiter == {"temp": 7.5}
+        assert leader.cancelled()
+        # the fetch was completed and cached although the caller which started it was cancelled
+        assert await cache.get_or_fetch("a", fetch) == {"temp": 7.5}
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_weather_cache_fetch_error_reaches_all_callers():
+    async def fetch():
+        await asyncio.sleep(0.01)
+        raise ValueError("upstream failed")
+
+    async def run():
+        cache = WeatherCache(ttl=60, max_size=10)
+        results = await asyncio.gather(*(cache.get_or_fetch("a", fetch) for _ in range(3)), return_exceptions=True)
+        assert all(isinstance(result, ValueError) for result in results)
+        assert cache.stats()["size"] == 0
+
+    asyncio.run(run())
@@ -0,0 +1,101 @@
+import asyncio
+import time
+import httpx
+from app.client import weather
+from app.client.weather import RateLimiter
+
+
+class FakeClient:
+    """Returns the queued responses in order and records the requests."""
+
+    def __init__(self, responses: list[httpx.Response]):
+        self.responses = responses
+        self.requests = []
+
+    async def get(self, url: str, params: dict) -> httpx.Response:
+        self.requests.append((url, params))
+        return self.responses.pop(0)
+
+
+def use_fake_client(monkeypatch, responses: list[httpx.Response]) -> tuple[FakeClient, list[float]]:
+    client, sleeps = FakeClient(responses), []
+
+    async def sleep(delay: float):
+        sleeps.append(delay)
+
+    monkeypatch.setattr(weather, "OPEN_WEATHER_API_KEY", "test")
+    monkeypatch.setattr(weather, "weather_limiter", RateLimiter(10, 0))
+    monkeypatch.setattr(weather, "get_http_client", lambda: client)
+    monkeypatch.setattr(weather.asyncio, "sleep", sleep)
+    return client, sleeps
+
+
+def test_open_weather_get_retries_with_capped_retry_after(monkeypatch):
+    client, sleeps = use_fake_client(
+        monkeypatch,
+        [
+            httpx.Response(429, headers={"Retry-After": "3600"}),
+            httpx.Response(503),
+            httpx.Response(200, json={"main": {"temp": 7.5}}),
+        ],
+    )
+    monkeypatch.setattr(weather, "WEATHER_MAX_BACKOFF", 5.0)
+
+    response = asyncio.run(weather.open_weather_get("weather", {"lat": 51.5, "lon": 0.4}))
+    assert response.status_code == 200
+    assert len(client.requests) == 3
+    assert client.requests[0][1]["appid"] == "test"
+    assert sleeps[0] == 5.0
+    assert 0 < sleeps[1] <= 5.0
+
+
+def test_open_weather_get_gives_up_after_retries(monkeypatch):
+    client, sleeps = use_fake_client(monkeypatch, [httpx.Response(500)] * (weather.WEATHER_RETRIES + 1))
+
+    response = asyncio.run(weather.open_weather_get("weather", {}))
+    assert response.status_code == 500
+    assert len(client.requests) == weather.WEATHER_RETRIES + 1
+    assert len(sleeps) == weather.WEATHER_RETRIES
+
+
+def test_backoff_grows_and_is_capped(monkeypatch):
+    monkeypatch.setattr(weather, "WEATHER_BACKOFF", 1.0)
+    monkeypatch.setattr(weather, "WEATHER_MAX_BACKOFF", 10.0)
+
+    assert 0.5 <= weather._backoff(0) <= 1.5
+    assert 4 <= weather._backoff(3) <= 10
+    assert weather._backoff(10) == 10
+    assert weather._backoff(0, "2") == 2
+    assert weather._backoff(0, "600") == 10
+
+
+def test_rate_limiter_spaces_calls_and_limits_concurrency():
+    in_flight, max_in_flight, starts = 0, 0, []
+
+    async def call(limiter: RateLimiter):
+        nonlocal in_flight, max_in_flight
+        async with limiter:
+            starts.append(time.monotonic())
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await asyncio.sleep(0.03)
+            in_flight -= 1
+
+    async def run(limiter: RateLimiter, calls: int):
+        starts.clear()
+        await asyncio.gather(*(call(limiter) for _ in range(calls)))
+        return [start - starts[0] for start in starts]
+
+    # 1200 calls per minute, one call every 50 ms
+    offsets = asyncio.run(run(RateLimiter(max_in_flight=10, calls_per_minute=1200), 4))
+    assert offsets[-1] >= 0.14
+    assert all(later - earlier >= 0.04 for earlier, later in zip(offsets, offsets[1:]))
+
+    # a burst of 3 starts at once, the next call waits for a token
+    offsets = asyncio.run(run(RateLimiter(max_in_flight=10, calls_per_minute=1200, burst=3), 4))
+    assert offsets[2] < 0.02
+    assert offsets[3] >= 0.04
+
+    max_in_flight = 0
+    asyncio.run(run(RateLimiter(max_in_flight=2, calls_per_minute=0), 6))
+    assert max_in_flight == 2
@@ -0,0 +1,135 @@
+import numpy as np
+from app.types.zone_types import (
+    GeoPoint,
+    RainPayload,
+    Restriction,
+    TemperaturePayload,
+    Zone,
+    ZoneType,
+    create_zone_bbox,
+)
+from app.zone_filters import (
+    RestrictionPredicate,
+    ZoneBatch,
+    filter_by_radius,
+    filter_by_restrictions,
+    great_circle_box,
+    is_zone_in_radius,
+    payload_columns,
+    route_boxes,
+    route_positions,
+    split_box,
+)
+
+
+def grid_zones(lat: float, lon: float, size: float, count: int) -> list[Zone]:
+    return [
+        Zone(
+            name=f"grid_{i}_{j}",
+            zone_type=ZoneType.RAIN,
+            bbox=create_zone_bbox([lat + j * size, lon + i * size, lat + (j + 1) * size, lon + (i + 1) * size]),
+        )
+        for i in range(count)
+        for j in range(count)
+    ]
+
+
+def test_filter_by_radius_matches_geodesic():
+    zones = grid_zones(lat=51.4, lon=0.2, size=0.01, count=30)
+
+    for radius in [500, 3000, 10000, 25000]:
+        expected = [zone.name for zone in zones if is_zone_in_radius(zone, 51.5577, 0.3871, radius)]
+        assert [zone.name for zone in filter_by_radius(zones, 51.5577, 0.3871, radius)] == expected
+
+
+def test_zone_batch_concatenate():
+    zones = grid_zones(lat=-33.9, lon=18.4, size=0.02, count=10)
+    batch = ZoneBatch.concatenate([ZoneBatch(zones[:40]), ZoneBatch(zones[40:])])
+
+    assert len(batch) == len(zones)
+    assert batch.within_radius(-33.8, 18.5, 5000) == ZoneBatch(zones).within_radius(-33.8, 18.5, 5000)
+
+
+def test_route_positions():
+    zones = grid_zones(lat=51.4, lon=0.2, size=0.01, count=30)
+    batch = ZoneBatch(zones)
+
+    # east along the middle of the first row, then north along the middle of the last column
+    waypoints = [GeoPoint(lat=51.405, lon=0.2001), GeoPoint(lat=51.405, lon=0.495), GeoPoint(lat=51.695, lon=0.495)]
+    positions = batch.route_positions(waypoints, 10)
+    found = [zones[i].name for i in np.argsort(positions, kind="stable") if not np.isnan(positions[i])]
+    assert found == [f"grid_{i}_0" for i in range(30)] + [f"grid_29_{j}" for j in range(1, 30)]
+
+    # a wider corridor reaches the neighbouring row and column
+    positions = batch.route_positions(waypoints, 2 * 600)
+    assert {zones[i].name for i in np.flatnonzero(~np.isnan(positions))} >= {"grid_0_1", "grid_28_15"}
+
+    far = route_positions(*batch.bounds, [GeoPoint(lat=10, lon=10), GeoPoint(lat=10.1, lon=10.1)], 1000)
+    assert np.isnan(far).all()
+
+
+def test_great_circle_box_covers_box():
+    def peak_lat(lat: float, lon_min: float, lon_max: float) -> float:
+        # latitude of the midpoint of the great circle arc between (lat, lon_min) and (lat, lon_max)
+        x, y = np.cos(np.radians(lat)) * np.cos(np.radians([lon_min, lon_max])).mean(), np.sin(np.radians(lat))
+        z = np.cos(np.radians(lat)) * np.sin(np.radians([lon_min, lon_max])).mean()
+        return np.degrees(np.arctan2(y, np.hypot(x, z)))
+
+    # the southern edge of a northern box bows north, so the box is extended to the south
+    assert peak_lat(60.0, 10.0, 14.0) > 60.01
+    lat_min, lat_max, lon_min, lon_max = great_circle_box(60.0, 60.5, 10.0, 14.0)
+    assert (lat_max, lon_min, lon_max) == (60.5, 10.0, 14.0)
+    assert abs(peak_lat(lat_min, lon_min, lon_max) - 60.0) < 1e-9
+
+    lat_min, lat_max, _, _ = great_circle_box(-60.5, -60.0, 10.0, 14.0)
+    assert lat_min == -60.5
+    assert abs(peak_lat(lat_max, 10.0, 14.0) + 60.0) < 1e-9
+
+    # boxes across the equator bow outward on both sides
+    assert great_circle_box(-1.0, 1.0, 10.0, 14.0) == (-1.0, 1.0, 10.0, 14.0)
+
+
+def test_route_boxes_are_valid_polygons():
+    def assert_valid(boxes):
+        for lat_min, lat_max, lon_min, lon_max in boxes:
+            assert -90 < lat_min < lat_max < 90
+            assert -180 <= lon_min < lon_max <= 180
+            assert lon_max - lon_min <= 120
+
+    # across the antimeridian the box is split into both sides of it
+    waypoints = [GeoPoint(lat=-33.8, lon=179.9), GeoPoint(lat=-33.7, lon=-179.9)]
+    boxes = route_boxes(waypoints, 5000)
+    assert_valid(boxes)
+    assert [box[2:] for box in boxes] == [(boxes[0][2], 180.0), (-180.0, boxes[1][3])]
+    assert 179.8 < boxes[0][2] < 179.9 and -179.9 < boxes[1][3] < -179.8
+
+    # near a pole the whole band of latitudes is covered
+    boxes = route_boxes([GeoPoint(lat=89.95, lon=10), GeoPoint(lat=89.95, lon=100)], 1000)
+    assert_valid(boxes)
+    assert [box[2:] for box in boxes] == [(-180.0, -60.0), (-60.0, 60.0), (60.0, 180.0)]
+
+    assert split_box(10.0, 11.0, 170.0, 200.0) == [(10.0, 11.0, 170.0, 180.0), (10.0, 11.0, -180.0, -160.0)]
+    assert split_box(10.0, 11.0, 20.0, 30.0) == [(10.0, 11.0, 20.0, 30.0)]
+
+
+def test_restriction_predicate():
+    zones = [
+        Zone(name="warm", zone_type=ZoneType.TEMPERATURE, bbox=create_zone_bbox([0, 0, 1, 1])),
+        Zone(name="cold", zone_type=ZoneType.TEMPERATURE, bbox=create_zone_bbox([0, 0, 1, 1])),
+        Zone(name="rain", zone_type=ZoneType.RAIN, bbox=create_zone_bbox([0, 0, 1, 1])),
+        Zone(name="empty", zone_type=ZoneType.EMPTY, bbox=create_zone_bbox([0, 0, 1, 1])),
+    ]
+    zones[0].payload = TemperaturePayload(temp=12.5, temp_min=10, temp_max=14, pressure=1007, humidity=60)
+    zones[1].payload = TemperaturePayload(temp=1.5, temp_min=0, temp_max=3, pressure=1007, humidity=90)
+    zones[2].payload = RainPayload(precipitation=0.0)
+
+    restrictions = [
+        Restriction(name="temp", limit=10, condition=">"),
+        Restriction(name="precipitation", limit=0.0, condition="<="),
+    ]
+    predicate = RestrictionPredicate(restrictions)
+
+    assert [predicate(zone.payload) for zone in zones] == [True, False, True, False]
+    columns = payload_columns(zones, predicate.fields)
+    assert predicate.evaluate(columns, len(zones)).tolist() == [True, False, True, False]
+    assert [zone.name for zone in filter_by_restrictions(zones, restrictions)] == ["warm", "rain"]
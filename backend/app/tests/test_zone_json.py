@@ -0,0 +1,48 @@
+import datetime
+import json
+from bson import ObjectId
+from app.types.zone_types import AutoGroupPayload, TemperaturePayload, Threshold, Zone, ZoneType, create_zone_bbox
+from app.zone_json import dumps_zone, dumps_zone_document
+
+
+def test_dumps_zone_document_matches_validated_zone():
+    sub_zone = Zone(
+        name="group_0_0",
+        zone_type=ZoneType.TEMPERATURE,
+        bbox=create_zone_bbox([51.43, 0.29, 51.47, 0.35]),
+        active=False,
+        payload=TemperaturePayload(temp=7.5, temp_min=6.1, temp_max=8.0, pressure=1012, humidity=70),
+    )
+    zone = Zone(
+        name="group",
+        zone_type=ZoneType.AUTO_GROUP,
+        bbox=create_zone_bbox([51.43, 0.29, 51.49, 0.47]),
+        payload=AutoGroupPayload(
+            sampling_size=4000,
+            refresh_rate=60,
+            next_refresh=datetime.datetime(2025, 3, 11, 19, 54, 26, 260000),
+            threshold={"temp": Threshold(limit=10.2, condition=">")},
+            sub_zone_type=ZoneType.TEMPERATURE,
+            zones=[sub_zone],
+        ),
+    )
+    zone_doc = zone.model_dump(exclude_none=True, by_alias=True)
+    zone_doc["_id"] = ObjectId()
+    zone_doc["geometry"] = {"type": "Polygon", "coordinates": []}
+    zone_doc["lease"] = {"owner": "worker"}
+
+    assert json.loads(dumps_zone_document(zone_doc)) == Zone(**zone_doc).model_dump(mode="json", exclude_none=True)
+    assert json.loads(dumps_zone_document(zone_doc, by_alias=True))["_id"] == str(zone_doc["_id"])
+
+
+def test_dumps_zone_keeps_handler_output():
+    zone = Zone(name="empty", zone_type=ZoneType.EMPTY, bbox=create_zone_bbox([0, 0, 1, 1]))
+    assert json.loads(dumps_zone(zone)) == {
+        "_id": None,
+        "name": "empty",
+        "zone_type": "empty",
+        "bbox": {"south_west": {"lat": 0.0, "lon": 0.0}, "north_east": {"lat": 1.0, "lon": 1.0}},
+        "active": True,
+        "payload": None,
+        "weather_updated_at": None,
+    }
@@ -0,0 +1,78 @@
+import asyncio
+from bson import ObjectId
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+from app import zone_sync
+from app.client.mongo import mongo_db
+from app.types.zone_types import Zone, ZoneType, create_zone_bbox
+from app.zone_index import zone_index
+from app.zone_sync import ZoneSync
+
+
+class FakeChangeStream:
+    """Change stream returning the given changes, or raising the error when it is opened."""
+
+    def __init__(self, changes: list[dict] = (), error: Exception = None):
+        self.changes = list(changes)
+        self.error = error
+        self.alive = True
+        self.resume_token = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, _exc_type, _exc, _tb):
+        pass
+
+    async def try_next(self):
+        if self.error is not None:
+            raise self.error
+        if self.changes:
+            self.resume_token = {"_data": len(self.changes)}
+            return self.changes.pop(0)
+        await asyncio.sleep(0.01)
+        return None
+
+
+def zone_document(name: str) -> dict:
+    zone = Zone(name=name, zone_type=ZoneType.EMPTY, bbox=create_zone_bbox([51.0, 0.0, 51.1, 0.1]))
+    return {"_id": ObjectId(), **zone.model_dump(exclude_none=True)}
+
+
+async def run_sync(seconds: float = 0.1):
+    async with ZoneSync():
+        await asyncio.sleep(seconds)
+
+
+def test_zone_sync_follows_change_stream(monkeypatch, zone_collection: Collection):
+    kept, deleted = zone_document("kept"), zone_document("deleted")
+    invalid = {**zone_document("invalid"), "zone_type": "unknown"}
+    stream = FakeChangeStream(
+        [
+            {"operationType": "insert", "fullDocument": kept},
+            {"operationType": "insert", "fullDocument": deleted},
+            {"operationType": "update", "fullDocument": invalid},
+            {"operationType": "delete", "documentKey": {"_id": deleted["_id"]}},
+        ]
+    )
+    monkeypatch.setattr(mongo_db, "watch_zones", lambda resume_after=None: stream)
+
+    asyncio.run(run_sync())
+    # an invalid document is skipped, the changes after it are still applied
+    assert [zone.name for zone in zone_index.list_zones()] == ["kept"]
+    assert stream.resume_token is not None
+
+
+def test_zone_sync_polls_without_change_streams(monkeypatch, zone_collection: Collection):
+    error = OperationFailure("The $changeStream stage is only supported on replica sets")
+    monkeypatch.setattr(mongo_db, "watch_zones", lambda resume_after=None: FakeChangeStream(error=error))
+    monkeypatch.setattr(zone_sync, "ZONE_SYNC_POLL_INTERVAL", 0.02)
+
+    async def run():
+        async with ZoneSync():
+            await asyncio.sleep(0.05)
+            await mongo_db._zones.insert_one(zone_document("polled"))
+            await asyncio.sleep(0.1)
+
+    asyncio.run(run())
+    assert [zone.name for zone in zone_index.list_zones()] == ["polled"]
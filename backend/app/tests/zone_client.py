@@ -50,7 +50,8 @@ class ZoneClient:
         response.raise_for_status()
         return Zone(**response.json())
 
-    def refresh(self, zone_id: str) -> Zone:
-        response = self.client.put("/refresh_zone", params={"zone_id": zone_id})
+    def refresh(self, zone_id: str, max_age: float = None) -> Zone:
+        params = {"zone_id": zone_id} if max_age is None else {"zone_id": zone_id, "max_age": max_age}
+        response = self.client.put("/refresh_zone", params=params)
         response.raise_for_status()
         return Zone(**response.json())
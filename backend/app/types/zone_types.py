@@ -1,14 +1,18 @@
 import datetime
 import logging
+import math
+import numpy as np
 from enum import StrEnum
 from bson import ObjectId
-from pydantic import BaseModel, Field, ValidationInfo, field_validator
+from pydantic import BaseModel, Field, TypeAdapter, ValidationInfo, field_validator
 from typing import Any, Optional
 
 # from bson import ObjectId
 
 logger = logging.getLogger(__name__)
 
+METERS_PER_DEGREE = 111320
+
 
 class GeoPoint(BaseModel):
     lat: float
@@ -21,6 +25,7 @@ class ZoneType(StrEnum):
     RAIN = "rain"
     VISIBILITY = "visibility"
     TEMPERATURE = "temperature"
+    WEATHER = "weather"  # all weather types from one upstream response
     AUTO_GROUP = "auto_group"
     # SPEED_LIMIT = "speed_limit"
     # ALTITUDE_LIMIT = "altitude_limit"
@@ -39,6 +44,7 @@ class Zone(BaseModel):
     bbox: ZoneBBox
     active: bool = True
     payload: Optional[Any] = None
+    weather_updated_at: Optional[datetime.datetime] = None  # when the weather payload was fetched
 
     @field_validator("id", mode="before")
     def convert_objectid_to_str(cls, v):
@@ -55,32 +61,15 @@ class Zone(BaseModel):
                 return payload_class(**v) if isinstance(v, dict) else v
         return v
 
-    def set_weather_payload(self, payload: dict):
+    def set_weather_payload(self, payload: dict, updated_at: datetime.datetime = None):
         if self.zone_type == ZoneType.EMPTY or not payload:
             self.payload = None
-        elif self.zone_type == ZoneType.WIND:
-            self.payload = WindPayload(
-                wind_speed=payload["wind"]["speed"],
-                wind_direction=payload["wind"]["deg"],
-            )
-        elif self.zone_type == ZoneType.RAIN:
-            self.payload = RainPayload(
-                precipitation=payload["rain"]["1h"] if "rain" in payload else 0,
-            )
-        elif self.zone_type == ZoneType.VISIBILITY:
-            self.payload = VisibilityPayload(
-                distance=payload["visibility"],
-            )
-        elif self.zone_type == ZoneType.TEMPERATURE:
-            self.payload = TemperaturePayload(
-                temp=payload["main"]["temp"],
-                temp_min=payload["main"]["temp_min"],
-                temp_max=payload["main"]["temp_max"],
-                pressure=payload["main"]["pressure"],
-                humidity=payload["main"]["humidity"],
-            )
-
-        logging.info(f"Zone {self.name} updated with weather data: {self.payload}")
+            self.weather_updated_at = None
+        elif self.zone_type in weather_types:
+            self.payload = weather_payload(self.zone_type, payload)
+            self.weather_updated_at = updated_at or weather_timestamp()
+
+        logger.debug("Zone %s updated with weather data: %s", self.name, self.payload)
 
 
 class WindPayload(BaseModel):
@@ -104,6 +93,146 @@ class TemperaturePayload(BaseModel):
     humidity: int
 
 
+class WeatherPayload(BaseModel):
+    """
+    Values of all weather zone types taken from one upstream response, attributes have
+    the names they have in the payload of the single type, so restrictions apply to both.
+    """
+
+    wind_speed: float
+    wind_direction: float
+    precipitation: float
+    distance: int
+    temp: float
+    temp_min: float
+    temp_max: float
+    pressure: int
+    humidity: int
+
+    def view(self, zone_type: ZoneType) -> BaseModel:
+        """The payload a zone of the single weather type would have."""
+        payload_class = type_mapping[zone_type]
+        return payload_class(**self.model_dump(include=set(payload_class.model_fields)))
+
+
+def weather_payload(zone_type: ZoneType, payload: dict) -> Optional[BaseModel]:
+    """Payload of a weather zone type taken from an OpenWeather current weather response."""
+    if zone_type == ZoneType.WEATHER:
+        values = {}
+        for single_type in single_weather_types:
+            values.update(weather_payload(single_type, payload).model_dump())
+        return WeatherPayload(**values)
+    elif zone_type == ZoneType.WIND:
+        return WindPayload(
+            wind_speed=payload["wind"]["speed"],
+            wind_direction=payload["wind"]["deg"],
+        )
+    elif zone_type == ZoneType.RAIN:
+        return RainPayload(
+            precipitation=payload["rain"]["1h"] if "rain" in payload else 0,
+        )
+    elif zone_type == ZoneType.VISIBILITY:
+        return VisibilityPayload(
+            distance=payload["visibility"],
+        )
+    elif zone_type == ZoneType.TEMPERATURE:
+        return TemperaturePayload(
+            temp=payload["main"]["temp"],
+            temp_min=payload["main"]["temp_min"],
+            temp_max=payload["main"]["temp_max"],
+            pressure=payload["main"]["pressure"],
+            humidity=payload["main"]["humidity"],
+        )
+    return None
+
+
+class SubZoneGrid(BaseModel):
+    """
+    Sub-zones of an auto group stored as a regular grid instead of a list of zones.
+
+    Cells are `cell_width` x `cell_height` meters large, counted from the south west corner,
+    `columns` along the longitude and `rows` along the latitude. A cell is addressed by its
+    position `column * rows + row`, the order in which `create_sub_zones` creates sub-zones.
+    Per cell values are kept in columns: the active flag and one list per payload attribute
+    (`metrics`), None where a cell has no value. Cell geometry is derived when needed.
+    """
+
+    south_west: GeoPoint
+    cell_width: float  # meters
+    cell_height: float  # meters
+    columns: int
+    rows: int
+    active: list[bool] = []
+    metrics: dict[str, list[Optional[float]]] = {}
+    updated_at: Optional[datetime.datetime] = None  # when the weather of the cells was fetched
+
+    @property
+    def cell_count(self) -> int:
+        return self.columns * self.rows
+
+    def cell_bounds(self) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """South west and north east corners (sw_lat, sw_lon, ne_lat, ne_lon) of all cells by position."""
+        column, row = np.divmod(np.arange(self.cell_count), self.rows)
+        lat_step = self.cell_height / METERS_PER_DEGREE
+        sw_lat = self.south_west.lat + row * lat_step
+        sw_lon = self.south_west.lon + column * (
+            self.cell_width / (METERS_PER_DEGREE * math.cos(math.radians(self.south_west.lat)))
+        )
+        ne_lat = sw_lat + lat_step
+        ne_lon = sw_lon + self.cell_width / (METERS_PER_DEGREE * np.cos(np.radians(sw_lat)))
+        return sw_lat, sw_lon, ne_lat, ne_lon
+
+    def metric_columns(self) -> dict[str, np.ndarray]:
+        """Metric columns as float arrays with NaN for missing values."""
+        return {name: np.array(values, dtype=np.float64) for name, values in self.metrics.items()}
+
+    def cell_zone(self, group_name: str, zone_type: ZoneType, position: int, bounds=None) -> Zone:
+        """The cell at position as a sub-zone, as it would be listed in `AutoGroupPayload.zones`."""
+        bounds = [array[position : position + 1].tolist() for array in (bounds or self.cell_bounds())]
+        return Zone(**self._cell_document(group_name, zone_type, position, 0, bounds))
+
+    def to_zones(self, group_name: str, zone_type: ZoneType, with_ids: bool = False) -> list[Zone]:
+        """
+        All cells as sub-zones in the order of positions, optionally each with a new ObjectId.
+        Geometry is computed for all cells at once and the sub-zones are validated in one call.
+        """
+        bounds = [array.tolist() for array in self.cell_bounds()]
+        zone_docs = [
+            self._cell_document(group_name, zone_type, position, position, bounds)
+            for position in range(self.cell_count)
+        ]
+        if with_ids:
+            for zone_doc in zone_docs:
+                zone_doc["_id"] = str(ObjectId())
+
+        return zone_list_adapter.validate_python(zone_docs)
+
+    def _cell_document(self, group_name: str, zone_type: ZoneType, position: int, index: int, bounds) -> dict:
+        sw_lat, sw_lon, ne_lat, ne_lon = bounds
+        column, row = divmod(position, self.rows)
+        values = {name: values[position] for name, values in self.metrics.items()}
+        return {
+            "name": f"{group_name}_{column}_{row}",
+            "zone_type": zone_type,
+            "bbox": {
+                "south_west": {"lat": sw_lat[index], "lon": sw_lon[index]},
+                "north_east": {"lat": ne_lat[index], "lon": ne_lon[index]},
+            },
+            "active": self.active[position] if self.active else False,
+            "payload": values if values and None not in values.values() else None,
+            "weather_updated_at": self.updated_at,
+        }
+
+    def set_payload(self, positions: list[int], payload: Optional[BaseModel], zone_type: ZoneType):
+        """Stores the weather payload of the zone type into the metric columns of the cells at positions."""
+        values = payload.model_dump() if payload is not None else {}
+        for name in type_mapping[zone_type].model_fields:
+            column = self.metrics.setdefault(name, [None] * self.cell_count)
+            value = values.get(name)
+            for position in positions:
+                column[position] = value
+
+
 class Threshold(BaseModel):
     limit: float
     condition: str
@@ -113,9 +242,16 @@ class AutoGroupPayload(BaseModel):
     sampling_size: int
     refresh_rate: int
     next_refresh: datetime.datetime = Field(default_factory=lambda: datetime.datetime.now())
-    # threshold: dict[str, Threshold]
+    threshold: Optional[dict[str, Threshold]] = None
     sub_zone_type: ZoneType
-    zones: list[Zone]
+    zones: list[Zone] = []
+    grid: Optional[SubZoneGrid] = None  # compact sub-zones, used instead of zones
+
+    def expand_grid(self, group_name: str):
+        """Replaces the compact grid with the equivalent list of sub-zones."""
+        if self.grid is not None:
+            self.zones = self.grid.to_zones(group_name, self.sub_zone_type)
+            self.grid = None
 
 
 class CreateZoneRequest(BaseModel):
@@ -130,6 +266,7 @@ class AutoGroupRequest(BaseModel):
     sampling_size: int
     refresh_rate: int
     sub_zone_type: ZoneType
+    threshold: Optional[dict[str, Threshold]] = None
 
 
 class LocalSituationRequest(BaseModel):
@@ -140,6 +277,7 @@ class LocalSituationRequest(BaseModel):
     sampling_size: int
     refresh_rate: int
     weather_types: list[ZoneType]
+    combined: bool = False  # one auto group with the combined weather payload instead of one group per type
 
 
 class Restriction(BaseModel):
@@ -162,15 +300,42 @@ class Restriction(BaseModel):
     condition: str
 
 
+class RouteRequest(BaseModel):
+    """
+    A planned flight path for /route_zones.
+
+    Attributes:
+        waypoints (list[GeoPoint]): Points of the path in the order of the flight, at least two.
+        width (float): Width of the corridor along the path in meters.
+        restrictions (list[Restriction]): Restrictions the returned zones are filtered by.
+    """
+
+    waypoints: list[GeoPoint]
+    width: float
+    restrictions: list[Restriction] = []
+
+
+zone_list_adapter = TypeAdapter(list[Zone])
+
+single_weather_types = (ZoneType.WIND, ZoneType.RAIN, ZoneType.VISIBILITY, ZoneType.TEMPERATURE)
+weather_types = {*single_weather_types, ZoneType.WEATHER}
+
 type_mapping = {
     ZoneType.WIND: WindPayload,
     ZoneType.RAIN: RainPayload,
     ZoneType.VISIBILITY: VisibilityPayload,
     ZoneType.TEMPERATURE: TemperaturePayload,
+    ZoneType.WEATHER: WeatherPayload,
     ZoneType.AUTO_GROUP: AutoGroupPayload,
 }
 
 
+def weather_timestamp() -> datetime.datetime:
+    """The current time in the millisecond precision of BSON dates, so stored zones equal the returned ones."""
+    now = datetime.datetime.now()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
 def create_zone_bbox(zone_rect: list[float]) -> ZoneBBox:
     return ZoneBBox(
         south_west=GeoPoint(lat=zone_rect[0], lon=zone_rect[1]),
@@ -190,3 +355,18 @@ def zone_factory(zone_id: str, zone_name: str, zone_type: ZoneType, zone_bbox: Z
         zone.set_weather_payload(payload)
 
     return zone
+
+
+def with_expanded_grid(zone: Zone) -> Zone:
+    """
+    The zone as returned by the API, an auto group storing a compact grid is copied
+    with the grid replaced by its list of sub-zones.
+    """
+    payload = zone.payload
+    if zone.zone_type != ZoneType.AUTO_GROUP or not isinstance(payload, AutoGroupPayload) or payload.grid is None:
+        return zone
+
+    expanded = payload.model_copy(
+        update={"zones": payload.grid.to_zones(zone.name, payload.sub_zone_type), "grid": None}
+    )
+    return zone.model_copy(update={"payload": expanded})
@@ -1,47 +1,397 @@
-from typing import Callable
+import itertools
+import math
+import operator
+import numpy as np
+from typing import Any, Callable, Sequence
 from geopy.distance import geodesic
-from app.types.zone_types import Restriction, Zone
+from app.types.zone_types import METERS_PER_DEGREE, GeoPoint, Restriction, Threshold, Zone
+
+WGS84_A = 6378137.0  # equatorial radius in meters
+WGS84_F = 1 / 298.257223563
+
+# Lambert's formula differs from the exact WGS-84 geodesic by less than 0.001 % for distances
+# below 10 000 km. Zones closer than this error to the radius boundary are re-checked with the
+# exact geodesic, so the result is the same as with `is_zone_in_radius`.
+DISTANCE_ERROR = 1e-5
+DISTANCE_ERROR_MARGIN = 1.0  # meters, absorbs floating point noise
+FAR_DISTANCE = 10_000_000  # meters, beyond this the approximation is only used with a 1 % margin
+FAR_DISTANCE_ERROR = 0.01
+
+# conservative meters per degree, so computed degree spans never undershoot
+METERS_PER_DEGREE_LAT = 110574
+METERS_PER_DEGREE_LON = 111320
+
+# polygon corners at a pole coincide, boxes sent to 2dsphere queries stop just short of it
+MAX_POLYGON_LAT = 89.9999
+# degrees of longitude, polygon edges of 180 degrees or more don't define which way around they go
+MAX_POLYGON_SPAN = 120.0
+
+
+class ZoneBatch:
+    """
+    Zone centers and radii held in NumPy arrays, so a radius query over many zones
+    is evaluated at once instead of two geodesic calls per zone in a Python loop.
+    """
+
+    def __init__(self, zones: list[Zone]):
+        self.zones = zones
+        count = len(zones)
+        sw_lat = np.fromiter((zone.bbox.south_west.lat for zone in zones), dtype=np.float64, count=count)
+        sw_lon = np.fromiter((zone.bbox.south_west.lon for zone in zones), dtype=np.float64, count=count)
+        ne_lat = np.fromiter((zone.bbox.north_east.lat for zone in zones), dtype=np.float64, count=count)
+        ne_lon = np.fromiter((zone.bbox.north_east.lon for zone in zones), dtype=np.float64, count=count)
+        self._set_bounds(sw_lat, sw_lon, ne_lat, ne_lon)
+
+    @classmethod
+    def from_bounds(cls, sw_lat, sw_lon, ne_lat, ne_lon, zones: Sequence[Zone]) -> "ZoneBatch":
+        """
+        Batch of zones whose corners are already known as arrays. `zones` may create
+        the zones lazily, only zones near the radius boundary and found zones are accessed.
+        """
+        batch = cls.__new__(cls)
+        batch.zones = zones
+        batch._set_bounds(sw_lat, sw_lon, ne_lat, ne_lon)
+        return batch
+
+    def _set_bounds(self, sw_lat, sw_lon, ne_lat, ne_lon):
+        self.bounds = (sw_lat, sw_lon, ne_lat, ne_lon)
+        self.center_lat = (sw_lat + ne_lat) / 2
+        self.center_lon = (sw_lon + ne_lon) / 2
+        self.radius = ellipsoid_distance(sw_lat, sw_lon, ne_lat, ne_lon) / 2
+
+    def __len__(self):
+        return len(self.zones)
+
+    def take(self, indexes: np.ndarray) -> "ZoneBatch":
+        """Batch of the zones at indexes, the zones are not accessed until needed."""
+        batch = self.__class__.__new__(self.__class__)
+        batch.zones = _TakenZones(self.zones, indexes)
+        batch.bounds = tuple(corner[indexes] for corner in self.bounds)
+        batch.center_lat = self.center_lat[indexes]
+        batch.center_lon = self.center_lon[indexes]
+        batch.radius = self.radius[indexes]
+        return batch
+
+    @classmethod
+    def concatenate(cls, batches: list["ZoneBatch"]) -> "ZoneBatch":
+        batch = cls.__new__(cls)
+        batch.zones = list(itertools.chain.from_iterable(part.zones for part in batches))
+        batch.bounds = tuple(np.concatenate([part.bounds[i] for part in batches]) for i in range(4))
+        batch.center_lat = np.concatenate([part.center_lat for part in batches])
+        batch.center_lon = np.concatenate([part.center_lon for part in batches])
+        batch.radius = np.concatenate([part.radius for part in batches])
+        return batch
+
+    def within_radius_mask(self, lat: float, lon: float, radius: float) -> np.ndarray:
+        """
+        Returns a boolean mask of zones which are within radius (meters) of the point (lat, lon).
+        """
+        distance = ellipsoid_distance(lat, lon, self.center_lat, self.center_lon)
+        overshoot = distance - self.radius - radius
+        error = np.where(distance < FAR_DISTANCE, DISTANCE_ERROR, FAR_DISTANCE_ERROR)
+        margin = error * (distance + self.radius) + DISTANCE_ERROR_MARGIN
+
+        mask = overshoot <= -margin
+        for i in np.flatnonzero(np.abs(overshoot) < margin):
+            mask[i] = is_zone_in_radius(self.zones[i], lat, lon, radius)
+
+        return mask
+
+    def within_radius(self, lat: float, lon: float, radius: float) -> list[Zone]:
+        mask = self.within_radius_mask(lat, lon, radius)
+        return [self.zones[i] for i in np.flatnonzero(mask)]
+
+    def route_positions(self, waypoints: list[GeoPoint], half_width: float) -> np.ndarray:
+        """See `route_positions`."""
+        return route_positions(*self.bounds, waypoints, half_width)
+
+
+class _TakenZones:
+    def __init__(self, zones: Sequence[Zone], indexes: np.ndarray):
+        self._zones = zones
+        self._indexes = indexes
+
+    def __len__(self):
+        return len(self._indexes)
+
+    def __getitem__(self, i: int) -> Zone:
+        return self._zones[self._indexes[i]]
+
+
+def ellipsoid_distance(lat1, lon1, lat2, lon2):
+    """
+    Distance in meters on the WGS-84 ellipsoid by Lambert's formula, works element-wise on arrays
+    of coordinates in degrees.
+    """
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+
+    # reduced latitudes and the central angle between them
+    beta1 = np.arctan((1 - WGS84_F) * np.tan(lat1))
+    beta2 = np.arctan((1 - WGS84_F) * np.tan(lat2))
+    sin2_half = np.sin((beta2 - beta1) / 2) ** 2 + np.cos(beta1) * np.cos(beta2) * np.sin((lon2 - lon1) / 2) ** 2
+    sin2_half = np.clip(sin2_half, 0.0, 1.0)
+    cos2_half = 1 - sin2_half
+    sigma = 2 * np.arcsin(np.sqrt(sin2_half))
+
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = np.where(cos2_half > 0, (sigma - np.sin(sigma)) * np.sin(p) ** 2 * np.cos(q) ** 2 / cos2_half, 0.0)
+        y = np.where(sin2_half > 0, (sigma + np.sin(sigma)) * np.cos(p) ** 2 * np.sin(q) ** 2 / sin2_half, 0.0)
+
+    return WGS84_A * (sigma - WGS84_F / 2 * (x + y))
+
+
+def route_positions(sw_lat, sw_lon, ne_lat, ne_lon, waypoints: list[GeoPoint], half_width: float) -> np.ndarray:
+    """
+    Returns the distance in meters along the route through the waypoints at which each bounding box
+    first comes within half_width (meters) of the route, NaN for boxes outside of the corridor.
+    Works element-wise on arrays of the box corners in degrees.
+
+    Every segment of the route is tested against the boxes in an equirectangular projection
+    around its start, which is accurate for segments up to tens of kilometers.
+    """
+    position = np.full(np.shape(sw_lat), np.nan)
+    travelled = 0.0
+    for start, end in zip(waypoints, waypoints[1:]):
+        kx = METERS_PER_DEGREE * math.cos(math.radians((start.lat + end.lat) / 2))
+        ky = METERS_PER_DEGREE
+        end_x, end_y = _wrap_lon(end.lon - start.lon) * kx, (end.lat - start.lat) * ky
+
+        distance, along = _segment_box_distance(
+            _wrap_lon(sw_lon - start.lon) * kx,
+            (sw_lat - start.lat) * ky,
+            _wrap_lon(ne_lon - start.lon) * kx,
+            (ne_lat - start.lat) * ky,
+            end_x,
+            end_y,
+        )
+        hit = np.isnan(position) & (distance <= half_width)
+        position[hit] = travelled + along[hit]
+        travelled += math.hypot(end_x, end_y)
+
+    return position
+
+
+def segment_range(start: GeoPoint, end: GeoPoint, reach: float) -> tuple[float, float, float, float]:
+    """
+    Returns (lat_min, lat_max, lon_min, lon_max) of the segment extended by reach (meters) to all sides.
+    """
+    lat_min = min(start.lat, end.lat) - reach / METERS_PER_DEGREE_LAT
+    lat_max = max(start.lat, end.lat) + reach / METERS_PER_DEGREE_LAT
+
+    polar_lat = max(abs(lat_min), abs(lat_max))
+    if polar_lat >= 89.9:
+        return lat_min, lat_max, -180.0, 180.0
+
+    lon_reach = reach / (METERS_PER_DEGREE_LON * math.cos(math.radians(polar_lat)))
+    lon_min = min(start.lon, start.lon + _wrap_lon(end.lon - start.lon))
+    lon_max = max(start.lon, start.lon + _wrap_lon(end.lon - start.lon))
+    return lat_min, lat_max, lon_min - lon_reach, lon_max + lon_reach
+
+
+def great_circle_box(
+    lat_min: float, lat_max: float, lon_min: float, lon_max: float
+) -> tuple[float, float, float, float]:
+    """
+    Returns the box with its equatorward edge moved, so that a polygon through its corners covers the
+    (lat_min, lat_max, lon_min, lon_max) box on a sphere. 2dsphere queries connect the corners along
+    great circles, which bow toward the pole and would leave out a strip along the equatorward side.
+    """
+    half_span = math.radians(lon_max - lon_min) / 2
+    if not 0 < half_span < math.pi / 2:
+        return lat_min, lat_max, lon_min, lon_max
+
+    # the great circle through two points at latitude lat peaks at atan(tan(lat) / cos(half_span))
+    def base_lat(lat: float) -> float:
+        return math.degrees(math.atan(math.tan(math.radians(lat)) * math.cos(half_span)))
+
+    if lat_min > 0:
+        lat_min = base_lat(lat_min)
+    if lat_max < 0:
+        lat_max = base_lat(lat_max)
+    return lat_min, lat_max, lon_min, lon_max
+
+
+def route_boxes(waypoints: list[GeoPoint], half_width: float) -> list[tuple[float, float, float, float]]:
+    """
+    Returns (lat_min, lat_max, lon_min, lon_max) boxes around the segments of the route, half_width (meters)
+    to all sides, usable as 2dsphere polygons: see `split_box` and `great_circle_box`.
+    """
+    return [
+        great_circle_box(*box)
+        for start, end in zip(waypoints, waypoints[1:])
+        for box in split_box(*segment_range(start, end, half_width))
+    ]
+
+
+def split_box(
+    lat_min: float, lat_max: float, lon_min: float, lon_max: float
+) -> list[tuple[float, float, float, float]]:
+    """
+    Returns the box as boxes within the GeoJSON coordinate bounds. Latitudes are clamped to MAX_POLYGON_LAT,
+    a box wrapping around the antimeridian is split at it and a box wider than MAX_POLYGON_SPAN is split
+    into equal parts, the whole band of latitudes for a box of 360 degrees or more.
+    """
+    lat_min, lat_max = max(lat_min, -MAX_POLYGON_LAT), min(lat_max, MAX_POLYGON_LAT)
+    span = min(lon_max - lon_min, 360.0)
+    west = _wrap_lon(lon_min) if span < 360 else -180.0
+
+    parts = max(math.ceil(span / MAX_POLYGON_SPAN), 1)
+    step = span / parts
+    boxes = []
+    for part in range(parts):
+        part_west = _wrap_lon(west + part * step)
+        part_east = part_west + step
+        if part_east - 180 > 1e-9:
+            boxes.append((lat_min, lat_max, part_west, 180.0))
+            boxes.append((lat_min, lat_max, -180.0, part_east - 360))
+        else:
+            boxes.append((lat_min, lat_max, part_west, min(part_east, 180.0)))
+    return boxes
+
+
+def _wrap_lon(delta):
+    return (delta + 180) % 360 - 180
+
+
+def _segment_box_distance(x_min, y_min, x_max, y_max, end_x: float, end_y: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Distance between the segment from (0, 0) to (end_x, end_y) and axis aligned boxes in a plane,
+    with the distance along the segment to the point closest to the box center.
+    """
+    length2 = end_x * end_x + end_y * end_y
+
+    def closest_parameter(x, y):
+        if length2 == 0:
+            return np.zeros(np.shape(x))
+        return np.clip((x * end_x + y * end_y) / length2, 0.0, 1.0)
+
+    # Liang-Barsky clipping, the segment crosses a box when the clipped parameter range isn't empty
+    t_min, t_max = np.zeros(np.shape(x_min)), np.ones(np.shape(x_min))
+    crosses = np.ones(np.shape(x_min), dtype=bool)
+    for p, q in ((-end_x, -x_min), (end_x, x_max), (-end_y, -y_min), (end_y, y_max)):
+        if p == 0:
+            crosses &= q >= 0
+        elif p < 0:
+            t_min = np.maximum(t_min, q / p)
+        else:
+            t_max = np.minimum(t_max, q / p)
+    crosses &= t_min <= t_max
+
+    # otherwise the closest points are an end of the segment or a corner of the box
+    distances = [
+        np.hypot(np.maximum(np.maximum(x_min - x, x - x_max), 0), np.maximum(np.maximum(y_min - y, y - y_max), 0))
+        for x, y in ((0.0, 0.0), (end_x, end_y))
+    ]
+    for x, y in ((x_min, y_min), (x_min, y_max), (x_max, y_min), (x_max, y_max)):
+        t = closest_parameter(x, y)
+        distances.append(np.hypot(x - t * end_x, y - t * end_y))
+
+    distance = np.where(crosses, 0.0, np.minimum.reduce(distances))
+    along = closest_parameter((x_min + x_max) / 2, (y_min + y_max) / 2) * math.sqrt(length2)
+    return distance, along
 
 
 def filter_by_radius(zones: list[Zone], lat: float, lon: float, radius: float) -> list[Zone]:
     """
     Filters a list of zones by a given radius from a point (lat, lon).
     """
-    filtered_zones = []
-    for zone in zones:
-        if is_zone_in_radius(zone, lat, lon, radius):
-            filtered_zones.append(zone)
-    return filtered_zones
+    if not zones:
+        return []
+    return ZoneBatch(zones).within_radius(lat, lon, radius)
 
 
 def filter_by_restrictions(zones: list[Zone], restrictions: list[Restriction]) -> list[Zone]:
-    filtered_zones = []
+    """
+    Keeps zones for which at least one restriction holds.
+    """
+    if not zones:
+        return []
+
+    predicate = RestrictionPredicate(restrictions)
+    mask = predicate.evaluate(payload_columns(zones, predicate.fields), len(zones))
+    return [zones[i] for i in np.flatnonzero(mask)]
+
+
+class RestrictionPredicate:
+    """
+    A list of restrictions compiled once into a single predicate. The restrictions are combined
+    with OR, a missing payload attribute never matches.
+
+    The predicate is evaluated either for one payload by calling it, or for many zones at once
+    by `evaluate` over columns of payload values (see `payload_columns`).
+    """
+
+    def __init__(self, restrictions: list[Restriction]):
+        self._checks = [
+            (restriction.name, get_eval_function(restriction.condition), restriction.limit)
+            for restriction in restrictions
+        ]
+        self.fields = list(dict.fromkeys(name for name, _, _ in self._checks))
+
+    def __call__(self, payload) -> bool:
+        if payload is None:
+            return False
+
+        values = payload if isinstance(payload, dict) else payload.__dict__
+        for name, eval_func, limit in self._checks:
+            if (value := values.get(name)) is not None and eval_func(value, limit):
+                return True
+
+        return False
+
+    def evaluate(self, columns: dict[str, np.ndarray], size: int) -> np.ndarray:
+        """
+        Returns a boolean mask over columns (of the given size) of payload values, NaN stands for a missing value.
+        """
+        mask = np.zeros(size, dtype=bool)
+        for name, eval_func, limit in self._checks:
+            if (column := columns.get(name)) is not None:
+                mask |= eval_func(column, limit)
+
+        return mask
+
+
+def payload_columns(zones: list[Zone], fields: list[str]) -> dict[str, np.ndarray]:
+    """
+    Collects payload values of zones into one float array per field, NaN where a zone has no such value.
+    """
+    columns = {field: np.full(len(zones), np.nan) for field in fields}
+    for i, zone in enumerate(zones):
+        if zone.payload is None:
+            continue
+
+        values = zone.payload if isinstance(zone.payload, dict) else zone.payload.__dict__
+        for field, column in columns.items():
+            if isinstance(value := values.get(field), (int, float)):
+                column[i] = value
+
+    return columns
+
+
+def thresholds_to_restrictions(thresholds: dict[str, Threshold]) -> list[Restriction]:
+    return [
+        Restriction(name=name, limit=threshold.limit, condition=threshold.condition)
+        for name, threshold in thresholds.items()
+    ]
 
-    for zone in zones:
-        for restriction in restrictions:
-            eval_func = get_eval_function(restriction.condition)
-            if hasattr(zone.payload, restriction.name):
-                if eval_func(getattr(zone.payload, restriction.name), restriction.limit) is True:
-                    filtered_zones.append(zone)
-                    break
 
-    return filtered_zones
+CONDITIONS: dict[str, Callable[[Any, float], Any]] = {
+    ">": operator.gt,
+    ">=": operator.ge,
+    "<": operator.lt,
+    "<=": operator.le,
+}
 
 
-def get_eval_function(condition: str) -> Callable[[float, float], bool]:
+def get_eval_function(condition: str) -> Callable[[Any, float], Any]:
     """
-    Returns a function that evaluates a condition.
+    Returns a function that evaluates a condition, it works on numbers as well as on NumPy arrays.
     """
-    if condition == ">":
-        return lambda x, y: x > y
-    elif condition == ">=":
-        return lambda x, y: x >= y
-    elif condition == "<":
-        return lambda x, y: x < y
-    elif condition == "<=":
-        return lambda x, y: x <= y
-    else:
+    if condition not in CONDITIONS:
         raise ValueError(f"Unknown condition: {condition}")
+    return CONDITIONS[condition]
 
 
 def is_zone_in_radius(zone: Zone, lat: float, lon: float, radius: float):
@@ -0,0 +1,447 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import math
+import numpy as np
+from typing import Optional
+from app.client.mongo import mongo_db
+from app.metrics import NEAR_ZONES_SCANNED
+from app.types.zone_types import GeoPoint, Zone, ZoneType
+from app.zone_filters import METERS_PER_DEGREE_LAT, METERS_PER_DEGREE_LON, ZoneBatch, segment_range
+from app.zone_json import dumps_listed_zone, dumps_zone
+
+logger = logging.getLogger(__name__)
+
+# entry keys are `order << POSITION_BITS | position`, sorting them restores the collection order
+POSITION_BITS = 32
+
+
+class ZoneIndex:
+    """
+    In-process spatial index over zones and auto group sub-zones.
+
+    Every zone is flattened (auto groups are replaced by their sub-zones) and put into
+    a fixed lat/lon grid bucket by its center. A radius query only visits the buckets
+    covering the query circle, so its cost scales with the number of nearby zones
+    instead of the total number of zones. Zones of the visited buckets are filtered at
+    once by a `ZoneBatch`; the batch of a bucket is rebuilt lazily after the bucket changes.
+
+    The index also keeps the zones themselves ordered by ID, so zone listings are served
+    from memory as well.
+
+    The index is loaded lazily from MongoDB and kept in sync by calling `upsert` and
+    `remove` whenever a zone is written. Each process keeps its own index, writes of other
+    processes are applied by `ZoneSync`.
+    """
+
+    CELL_SIZE = 0.05  # degrees, ~5.5 km of latitude
+
+    def __init__(self, cell_size: float = CELL_SIZE):
+        self._cell_size = cell_size
+        self._lat_cells = math.ceil(180 / cell_size)
+        self._lon_cells = math.ceil(360 / cell_size)
+        self._lock = asyncio.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop all indexed zones, the next query reloads them from MongoDB."""
+        self._loaded = False
+        self._order: dict[str, int] = {}  # zone id -> position, keeps results in insertion order
+        self._next_order = itertools.count()
+        self._entries: dict[str, list[tuple[tuple[int, int], int]]] = {}  # zone id -> [(bucket, key)]
+        self._buckets: dict[tuple[int, int], dict[int, Zone]] = {}
+        self._batches: dict[tuple[int, int], tuple[np.ndarray, ZoneBatch]] = {}
+        self._serialized: dict[int, bytes] = {}  # id() of an indexed zone -> its JSON
+        self._owners: dict[int, str] = {}  # id() of an indexed zone or sub-zone -> id of the zone it belongs to
+        self._max_zone_radius = 0.0
+        self._zones: dict[str, Zone] = {}
+        self._sorted_ids: Optional[list[str]] = None  # zone ids in the ObjectId order, rebuilt lazily
+        self._listed: dict[tuple[str, bool, bool], bytes] = {}  # (zone id, listing options) -> JSON
+        self._grids: dict[str, GridEntry] = {}  # auto group id -> its compact sub-zone grid
+
+    async def ensure_loaded(self):
+        if self._loaded:
+            return
+
+        async with self._lock:
+            if self._loaded:
+                return
+
+            await self._load()
+
+    async def reload(self):
+        """Replaces all indexed zones with the zones currently stored in MongoDB."""
+        async with self._lock:
+            await self._load()
+
+    async def _load(self):
+        zones = await mongo_db.get_all_zones()
+        # no await from here on, queries never see a partially loaded index
+        self.invalidate()
+        self._loaded = True
+        for zone in zones:
+            self.upsert(zone)
+
+        logger.info(f"Zone index loaded with {len(self._entries)} zones")
+
+    def upsert(self, zone: Zone):
+        """Index a new zone or replace all entries of an already indexed one."""
+        if not self._loaded:
+            return
+
+        self._remove_entries(zone.id)
+        if (order := self._order.get(zone.id)) is None:
+            order = self._order[zone.id] = next(self._next_order)
+            self._sorted_ids = None
+        self._zones[zone.id] = zone
+
+        if zone.zone_type == ZoneType.AUTO_GROUP and zone.payload is not None and zone.payload.grid is not None:
+            # grid cells are searched directly, sub-zones are created only for found cells
+            self._grids[zone.id] = GridEntry(zone, order, self._owners)
+            self._entries[zone.id] = []
+            return
+
+        flat_zones = expand_zone(zone)
+        if not flat_zones:
+            self._entries[zone.id] = []
+            return
+
+        batch = ZoneBatch(flat_zones)
+        # 1 % covers the error of the approximated radius
+        self._max_zone_radius = max(self._max_zone_radius, float(batch.radius.max()) * 1.01)
+        lat_indexes, lon_indexes = self._bucket_indexes(batch.center_lat, batch.center_lon)
+
+        entries = []
+        for position, (flat_zone, lat_idx, lon_idx) in enumerate(
+            zip(flat_zones, lat_indexes.tolist(), lon_indexes.tolist())
+        ):
+            bucket = (lat_idx, lon_idx)
+            key = order << POSITION_BITS | position
+            self._buckets.setdefault(bucket, {})[key] = flat_zone
+            self._batches.pop(bucket, None)
+            self._owners[id(flat_zone)] = zone.id
+            entries.append((bucket, key))
+
+        self._entries[zone.id] = entries
+
+    def remove(self, zone_id: str):
+        if not self._loaded:
+            return
+
+        self._remove_entries(zone_id)
+        if self._order.pop(zone_id, None) is not None:
+            self._sorted_ids = None
+        self._zones.pop(zone_id, None)
+
+    def query_radius(self, lat: float, lon: float, radius: float) -> list[Zone]:
+        """
+        Returns zones within radius (meters) of the point in the order of the zone collection.
+        """
+        reach = radius + self._max_zone_radius
+        lat_min = lat - reach / METERS_PER_DEGREE_LAT
+        lat_max = lat + reach / METERS_PER_DEGREE_LAT
+
+        polar_lat = max(abs(lat_min), abs(lat_max))
+        if polar_lat >= 89.9:
+            lon_reach = 360.0
+        else:
+            lon_reach = reach / (METERS_PER_DEGREE_LON * math.cos(math.radians(polar_lat)))
+
+        buckets = self._buckets_in_range(lat_min, lat_max, lon - lon_reach, lon + lon_reach)
+        parts = [self._bucket_batch(bucket) for bucket in buckets if bucket in self._buckets]
+
+        found_keys, found_zones, scanned = [], [], 0
+        if parts:
+            keys = np.concatenate([part_keys for part_keys, _ in parts])
+            batch = ZoneBatch.concatenate([part_batch for _, part_batch in parts])
+            found = np.flatnonzero(batch.within_radius_mask(lat, lon, radius))
+            found_keys.append(keys[found])
+            found_zones.extend(batch.zones[i] for i in found)
+            scanned += len(batch)
+
+        for grid_entry in self._grids.values():
+            keys, zones, grid_scanned = grid_entry.query_radius(lat, lon, radius)
+            found_keys.append(keys)
+            found_zones.extend(zones)
+            scanned += grid_scanned
+
+        NEAR_ZONES_SCANNED.observe(scanned)
+        if not found_zones:
+            return []
+
+        order = np.argsort(np.concatenate(found_keys), kind="stable")
+        return [found_zones[i] for i in order]
+
+    def query_route(self, waypoints: list[GeoPoint], width: float) -> list[Zone]:
+        """
+        Returns zones whose bounding box is within the corridor of width (meters) along the route
+        through the waypoints, ordered by the distance along the route at which they are reached.
+        Only buckets near the route segments are visited.
+        """
+        half_width = width / 2
+        reach = half_width + self._max_zone_radius
+        buckets = dict.fromkeys(
+            bucket
+            for start, end in zip(waypoints, waypoints[1:])
+            for bucket in self._buckets_in_range(*segment_range(start, end, reach))
+        )
+        parts = [self._bucket_batch(bucket) for bucket in buckets if bucket in self._buckets]
+
+        found_keys, found_positions, found_zones = [], [], []
+        if parts:
+            keys = np.concatenate([part_keys for part_keys, _ in parts])
+            batch = ZoneBatch.concatenate([part_batch for _, part_batch in parts])
+            positions = batch.route_positions(waypoints, half_width)
+            found = np.flatnonzero(~np.isnan(positions))
+            found_keys.append(keys[found])
+            found_positions.append(positions[found])
+            found_zones.extend(batch.zones[i] for i in found)
+
+        for grid_entry in self._grids.values():
+            keys, positions, zones = grid_entry.query_route(waypoints, half_width)
+            found_keys.append(keys)
+            found_positions.append(positions)
+            found_zones.extend(zones)
+
+        if not found_zones:
+            return []
+
+        # zones reached at the same distance keep the collection order
+        order = np.lexsort((np.concatenate(found_keys), np.concatenate(found_positions)))
+        return [found_zones[i] for i in order]
+
+    def owner(self, zone: Zone) -> Optional[Zone]:
+        """The indexed zone a zone returned by a query belongs to, the auto group of a sub-zone."""
+        if (owner_id := self._owners.get(id(zone))) is None:
+            return None
+        return self._zones.get(owner_id)
+
+    def dumps(self, zones: list[Zone]) -> list[bytes]:
+        """
+        JSON of zones returned by `query_radius`. Zones are serialized once after they are
+        indexed and the JSON is reused until they are replaced or removed.
+        """
+        serialized = []
+        for zone in zones:
+            if (zone_json := self._serialized.get(id(zone))) is None:
+                zone_json = self._serialized[id(zone)] = dumps_zone(zone)
+            serialized.append(zone_json)
+        return serialized
+
+    def list_zones(self, after: Optional[str] = None, limit: Optional[int] = None) -> list[Zone]:
+        """Returns zones ordered by ID, optionally only those following the zone with ID `after`."""
+        if self._sorted_ids is None:
+            # hex strings of ObjectIds of the same length sort like the ObjectIds
+            self._sorted_ids = sorted(self._zones, key=lambda zone_id: (len(zone_id), zone_id))
+
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(
+                self._sorted_ids, (len(after), after), key=lambda zone_id: (len(zone_id), zone_id)
+            )
+        end = len(self._sorted_ids) if limit is None else start + limit
+        return [self._zones[zone_id] for zone_id in self._sorted_ids[start:end]]
+
+    def dumps_listed(
+        self, zones: list[Zone], include_sub_zones: bool = True, compact_grid: bool = False
+    ) -> list[bytes]:
+        """JSON of zones returned by `list_zones`, cached like in `dumps`."""
+        serialized = []
+        for zone in zones:
+            cache_key = (zone.id, include_sub_zones, compact_grid)
+            if (zone_json := self._listed.get(cache_key)) is None:
+                zone_json = self._listed[cache_key] = dumps_listed_zone(zone, include_sub_zones, compact_grid)
+            serialized.append(zone_json)
+        return serialized
+
+    def _bucket_batch(self, bucket: tuple[int, int]) -> tuple[np.ndarray, ZoneBatch]:
+        if (keys_batch := self._batches.get(bucket)) is None:
+            bucket_zones = self._buckets[bucket]
+            keys = np.fromiter(bucket_zones.keys(), dtype=np.int64, count=len(bucket_zones))
+            keys_batch = self._batches[bucket] = (keys, ZoneBatch(list(bucket_zones.values())))
+        return keys_batch
+
+    def _remove_entries(self, zone_id: str):
+        if (grid_entry := self._grids.pop(zone_id, None)) is not None:
+            for cell in grid_entry.cells.values():
+                self._serialized.pop(id(cell), None)
+                self._owners.pop(id(cell), None)
+        for include_sub_zones, compact_grid in itertools.product((True, False), repeat=2):
+            self._listed.pop((zone_id, include_sub_zones, compact_grid), None)
+        for bucket, key in self._entries.pop(zone_id, []):
+            bucket_zones = self._buckets[bucket]
+            flat_zone = bucket_zones.pop(key)
+            self._serialized.pop(id(flat_zone), None)
+            self._owners.pop(id(flat_zone), None)
+            self._batches.pop(bucket, None)
+            if not bucket_zones:
+                del self._buckets[bucket]
+
+    def _bucket_indexes(self, lat: np.ndarray, lon: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        lat_indexes = np.clip(((lat + 90) // self._cell_size).astype(np.int64), 0, self._lat_cells - 1)
+        lon_indexes = ((lon + 180) // self._cell_size).astype(np.int64) % self._lon_cells
+        return lat_indexes, lon_indexes
+
+    def _buckets_in_range(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float):
+        lat_lo = max(int((lat_min + 90) // self._cell_size), 0)
+        lat_hi = min(int((lat_max + 90) // self._cell_size), self._lat_cells - 1)
+
+        if lon_max - lon_min >= 360:
+            lon_indexes = range(self._lon_cells)
+        else:
+            lon_lo = int((lon_min + 180) // self._cell_size)
+            lon_hi = int((lon_max + 180) // self._cell_size)
+            lon_indexes = [i % self._lon_cells for i in range(lon_lo, lon_hi + 1)]
+
+        # for very large query areas it is cheaper to walk the occupied buckets
+        if (lat_hi - lat_lo + 1) * len(lon_indexes) > len(self._buckets):
+            lon_set = set(lon_indexes)
+            return [b for b in self._buckets if lat_lo <= b[0] <= lat_hi and b[1] in lon_set]
+
+        return [(lat_idx, lon_idx) for lat_idx in range(lat_lo, lat_hi + 1) for lon_idx in lon_indexes]
+
+
+class GridEntry:
+    """
+    A compact sub-zone grid of an indexed auto group. Cell geometry is computed once,
+    sub-zones are created lazily for the cells found by a query and kept for later queries.
+
+    Queries only evaluate the window of rows and columns that may hold cells near the query,
+    derived from the regular layout of the grid: cell centers of a row share the latitude and
+    columns are evenly spaced in longitude from the south west corner.
+    """
+
+    def __init__(self, zone: Zone, order: int, owners: dict[int, str]):
+        self.zone = zone
+        self.grid = zone.payload.grid
+        self.order = order
+        self.bounds = self.grid.cell_bounds()
+        self.cells: dict[int, Zone] = {}
+        self.owners = owners
+        self.batch = ZoneBatch.from_bounds(*self.bounds, zones=GridCells(self))
+
+        self.max_radius = float(self.batch.radius.max()) * 1.01 if len(self.batch) else 0.0
+        self.lat_range = (float(self.bounds[0].min(initial=90)), float(self.bounds[2].max(initial=-90)))
+
+        # cells of the first column, positions 0..rows-1, give the row latitudes and the column offsets
+        rows = self.grid.rows
+        first_column_lon = self.batch.center_lon[:rows]
+        self.row_center_lat = self.batch.center_lat[:rows]
+        self.lon_base = float(first_column_lon.min(initial=0))
+        self.lon_spread = float(first_column_lon.max(initial=0)) - self.lon_base
+        self.lon_step = self.grid.cell_width / (
+            METERS_PER_DEGREE_LON * math.cos(math.radians(self.grid.south_west.lat))
+        )
+        self.lon_extent = (self.grid.columns - 1) * self.lon_step + self.lon_spread  # of the cell centers
+
+    def cell(self, position: int) -> Zone:
+        if (cell := self.cells.get(position)) is None:
+            group_name, sub_zone_type = self.zone.name, self.zone.payload.sub_zone_type
+            cell = self.cells[position] = self.grid.cell_zone(group_name, sub_zone_type, position, self.bounds)
+            self.owners[id(cell)] = self.zone.id
+        return cell
+
+    def window(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float) -> np.ndarray:
+        """
+        Positions, in ascending order, of the cells whose center may lie within the range. The window is
+        a superset of one row and column at each side, the exact test is done on its cells.
+        """
+        empty = np.empty(0, dtype=np.int64)
+        if not len(self.batch) or lat_max < self.lat_range[0] or lat_min > self.lat_range[1]:
+            return empty
+
+        width = lon_max - lon_min
+        if width + self.lon_extent >= 360:
+            col_lo, col_hi = 0, self.grid.columns
+        else:
+            # start of the range east of the first column center, on the west side when beyond the grid
+            start = (lon_min - self.lon_base) % 360
+            if start > self.lon_extent:
+                start -= 360
+            col_lo = max(math.floor((start - self.lon_spread) / self.lon_step) - 1, 0)
+            col_hi = min(math.floor((start + width) / self.lon_step) + 2, self.grid.columns)
+            if col_lo >= col_hi:
+                return empty
+
+        row_lo = max(int(self.row_center_lat.searchsorted(lat_min, side="left")) - 1, 0)
+        row_hi = min(int(self.row_center_lat.searchsorted(lat_max, side="right")) + 1, self.grid.rows)
+        if row_lo >= row_hi:
+            return empty
+
+        columns = np.arange(col_lo, col_hi, dtype=np.int64)
+        rows = np.arange(row_lo, row_hi, dtype=np.int64)
+        return (columns[:, None] * self.grid.rows + rows[None, :]).ravel()
+
+    def query_radius(self, lat: float, lon: float, radius: float) -> tuple[np.ndarray, list[Zone], int]:
+        """Keys and sub-zones of the cells within radius of the point, with the number of evaluated cells."""
+        reach = (radius + self.max_radius) / METERS_PER_DEGREE_LAT
+        if lat + reach < self.lat_range[0] or lat - reach > self.lat_range[1]:
+            return np.empty(0, dtype=np.int64), [], 0
+
+        polar_lat = min(abs(lat) + reach, 90.0)
+        lon_reach = (radius + self.max_radius) / (METERS_PER_DEGREE_LON * max(math.cos(math.radians(polar_lat)), 1e-9))
+        lon_reach = min(lon_reach, 180.0)
+
+        window = self.window(lat - reach, lat + reach, lon - lon_reach, lon + lon_reach)
+        if not len(window):
+            return np.empty(0, dtype=np.int64), [], 0
+
+        # cheap pre-selection of cells near the point before the distance is computed
+        near = np.abs(self.batch.center_lat[window] - lat) <= reach
+        if lon_reach < 180:
+            near &= np.abs((self.batch.center_lon[window] - lon + 180) % 360 - 180) <= lon_reach
+        candidates = window[near]
+        if not len(candidates):
+            return np.empty(0, dtype=np.int64), [], 0
+
+        found = candidates[self.batch.take(candidates).within_radius_mask(lat, lon, radius)]
+        keys = (np.int64(self.order) << POSITION_BITS) | found.astype(np.int64)
+        return keys, [self.cell(position) for position in found.tolist()], len(candidates)
+
+    def query_route(self, waypoints: list[GeoPoint], half_width: float) -> tuple[np.ndarray, np.ndarray, list[Zone]]:
+        """Keys, distances along the route and sub-zones of the cells within half_width of the route."""
+        reach = half_width + self.max_radius
+        candidates = []
+        for start, end in zip(waypoints, waypoints[1:]):
+            lat_min, lat_max, lon_min, lon_max = segment_range(start, end, reach)
+            window = self.window(lat_min, lat_max, lon_min, lon_max)
+            if not len(window):
+                continue
+
+            segment_near = (self.batch.center_lat[window] >= lat_min) & (self.batch.center_lat[window] <= lat_max)
+            if lon_max - lon_min < 360:
+                segment_near &= (self.batch.center_lon[window] - lon_min) % 360 <= lon_max - lon_min
+            candidates.append(window[segment_near])
+
+        candidates = np.unique(np.concatenate(candidates)) if candidates else np.empty(0, dtype=np.int64)
+        if not len(candidates):
+            return np.empty(0, dtype=np.int64), np.empty(0), []
+
+        positions = self.batch.take(candidates).route_positions(waypoints, half_width)
+        found_mask = ~np.isnan(positions)
+        found = candidates[found_mask]
+        keys = (np.int64(self.order) << POSITION_BITS) | found.astype(np.int64)
+        return keys, positions[found_mask], [self.cell(position) for position in found.tolist()]
+
+
+class GridCells:
+    """Sequence of the sub-zones of a grid entry, a sub-zone is created on access."""
+
+    def __init__(self, grid_entry: GridEntry):
+        self._grid_entry = grid_entry
+
+    def __len__(self):
+        return self._grid_entry.grid.cell_count
+
+    def __getitem__(self, position: int) -> Zone:
+        return self._grid_entry.cell(int(position))
+
+
+def expand_zone(zone: Zone) -> list[Zone]:
+    if zone.zone_type == ZoneType.AUTO_GROUP:
+        return zone.payload.zones if zone.payload else []
+    return [zone]
+
+
+zone_index = ZoneIndex()
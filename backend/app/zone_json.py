@@ -0,0 +1,63 @@
+import orjson
+from bson import ObjectId
+from fastapi import Response
+from app.types.zone_types import Zone, ZoneType, with_expanded_grid
+
+# keys of a zone in the API output, other keys of stored documents (geometry, lease, ...) are dropped
+ZONE_FIELDS = ("name", "zone_type", "bbox", "active", "payload", "weather_updated_at")
+
+
+def zone_document_to_api(zone_doc: dict, by_alias: bool = False) -> dict:
+    """
+    Converts a raw zone document from MongoDB to the shape of a dumped `Zone`, including
+    its sub-zones, without validating it. The ID is stored under `_id` when `by_alias` is set.
+    """
+    api_doc = {}
+    if (zone_id := zone_doc.get("_id")) is not None:
+        api_doc["_id" if by_alias else "id"] = str(zone_id)
+
+    for field in ZONE_FIELDS:
+        if (value := zone_doc.get(field)) is not None:
+            api_doc[field] = value
+
+    payload = api_doc.get("payload")
+    if isinstance(payload, dict) and isinstance(payload.get("zones"), list):
+        api_doc["payload"] = {
+            **payload,
+            "zones": [zone_document_to_api(sub_zone_doc, by_alias) for sub_zone_doc in payload["zones"]],
+        }
+
+    return api_doc
+
+
+def dumps_zone_document(zone_doc: dict, by_alias: bool = False) -> bytes:
+    return orjson.dumps(zone_document_to_api(zone_doc, by_alias), default=_default)
+
+
+def dumps_zone(zone: Zone) -> bytes:
+    """JSON of a validated zone as FastAPI returns it from a handler."""
+    return zone.model_dump_json(by_alias=True).encode()
+
+
+def dumps_listed_zone(zone: Zone, include_sub_zones: bool = True, compact_grid: bool = False) -> bytes:
+    """
+    JSON of a validated zone as returned by /list_zones. A compact sub-zone grid is listed
+    as sub-zones unless `compact_grid` is set.
+    """
+    exclude = None
+    if not include_sub_zones and zone.zone_type == ZoneType.AUTO_GROUP and zone.payload is not None:
+        exclude = {"payload": {"zones", "grid"}}
+    elif not compact_grid:
+        zone = with_expanded_grid(zone)
+    return zone.model_dump_json(exclude_none=True, exclude=exclude).encode()
+
+
+def json_array_response(items: list[bytes], headers: dict = None) -> Response:
+    """Response with a JSON array of already serialized items."""
+    return Response(content=b"[" + b",".join(items) + b"]", media_type="application/json", headers=headers)
+
+
+def _default(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+from pydantic import ValidationError
+from pymongo.errors import OperationFailure, PyMongoError
+from app.client.mongo import mongo_db
+from app.types.zone_types import Zone
+from app.zone_index import zone_index
+
+logger = logging.getLogger(__name__)
+
+# seconds between full reloads of the zone index when change streams are not available
+ZONE_SYNC_POLL_INTERVAL = float(os.getenv("ZONE_SYNC_POLL_INTERVAL", "30"))
+
+
+class ZoneSync:
+    """
+    Keeps the in-memory zone index in sync with writes of all processes.
+
+    The index is loaded when the change stream of the zone collection is opened and then
+    follows the stream. Change streams need a replica set, on a standalone server the index is
+    reloaded every ZONE_SYNC_POLL_INTERVAL seconds instead, which bounds its staleness.
+    """
+
+    RETRY_DELAY = 5  # seconds until a broken change stream is reopened
+
+    def __init__(self):
+        self._shutdown_event = asyncio.Event()
+        self._sync_task: asyncio.Task = None
+        self._resume_token: Optional[dict] = None
+
+    async def __aenter__(self):
+        self._sync_task = asyncio.create_task(self.run())
+        return self
+
+    async def __aexit__(self, _exc_type, _exc, _tb):
+        self._shutdown_event.set()
+        self._sync_task.cancel()
+        try:
+            await self._sync_task
+        except asyncio.CancelledError:
+            pass
+
+    async def run(self):
+        while not self._shutdown_event.is_set():
+            try:
+                await self._follow_change_stream()
+            except OperationFailure as e:
+                logger.warning(f"Zone change stream is not available, polling zones instead: {e}")
+                await self._poll()
+                return
+            except PyMongoError as e:
+                logger.error("Zone change stream failed", exc_info=e)
+                await self._sleep(ZoneSync.RETRY_DELAY)
+
+    async def _follow_change_stream(self):
+        async with mongo_db.watch_zones(self._resume_token) as stream:
+            # the first call opens the stream, changes made from now on are not missed by the reload
+            change = await stream.try_next()
+            if self._resume_token is None:
+                await zone_index.reload()
+
+            while stream.alive and not self._shutdown_event.is_set():
+                if change is not None:
+                    self._apply(change)
+                self._resume_token = stream.resume_token
+                change = await stream.try_next()
+
+    def _apply(self, change: dict):
+        operation = change["operationType"]
+        if operation in ("insert", "update", "replace"):
+            if (zone_doc := change.get("fullDocument")) is not None:
+                try:
+                    zone = Zone(**zone_doc)
+                except ValidationError as e:
+                    logger.error("Skipping invalid zone %s of the change stream", zone_doc.get("_id"), exc_info=e)
+                    return
+                zone_index.upsert(zone)
+        elif operation == "delete":
+            zone_index.remove(str(change["documentKey"]["_id"]))
+        elif operation in ("drop", "rename", "dropDatabase", "invalidate"):
+            # the stream is closed after these, it is reopened with a full reload
+            self._resume_token = None
+
+    async def _poll(self):
+        while True:
+            try:
+                await zone_index.reload()
+            except PyMongoError as e:
+                logger.error("Reloading zones failed", exc_info=e)
+
+            if await self._sleep(ZONE_SYNC_POLL_INTERVAL):
+                return
+
+    async def _sleep(self, seconds: float) -> bool:
+        """Sleeps for the given time, returns True when interrupted by shutdown."""
+        try:
+            await asyncio.wait_for(self._shutdown_event.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            return False
+        return True
@@ -0,0 +1,110 @@
+"""
+Local stand-in for the OpenWeather current weather API used by the benchmarks.
+
+The server answers `GET /weather?lat=..&lon=..` with a deterministic response for the
+coordinates after a configurable latency. With a rate limit, requests above the limit
+within one second are answered with 429 and `Retry-After: 1` like the real API.
+"""
+
+import asyncio
+import math
+import random
+import threading
+import time
+import uvicorn
+from fastapi import FastAPI, Response
+
+
+class FakeOpenWeather:
+    """
+    Runs the fake API with uvicorn in a background thread, use it as a context manager:
+
+        with FakeOpenWeather(latency=0.05) as server:
+            os.environ["OPEN_WEATHER_URL"] = server.url
+
+    Args:
+        latency (float): Seconds each response is delayed by.
+        jitter (float): Seconds of uniform random variation added to the latency.
+        rate_limit (int): Requests per second answered with 200, 0 for no limit.
+    """
+
+    def __init__(self, latency: float = 0.02, jitter: float = 0.0, rate_limit: int = 0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self.throttled = 0
+        self._window = (0, 0)  # (second, requests within it)
+        self._server: uvicorn.Server = None
+        self._thread: threading.Thread = None
+        self.url: str = None
+
+    def __enter__(self):
+        config = uvicorn.Config(self._app(), host="127.0.0.1", port=0, log_level="warning", lifespan="off")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+
+        port = self._server.servers[0].sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    def __exit__(self, _exc_type, _exc, _tb):
+        self._server.should_exit = True
+        self._thread.join()
+
+    def stats(self) -> dict:
+        return {"requests": self.requests, "throttled": self.throttled}
+
+    def _app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.get("/weather")
+        async def weather(lat: float, lon: float, response: Response):
+            self.requests += 1
+            if self._throttle():
+                self.throttled += 1
+                response.status_code = 429
+                response.headers["Retry-After"] = "1"
+                return {"cod": 429, "message": "Too many requests"}
+
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+            return weather_response(lat, lon)
+
+        return app
+
+    def _throttle(self) -> bool:
+        if self.rate_limit <= 0:
+            return False
+
+        second = int(time.monotonic())
+        window_second, count = self._window
+        count = count + 1 if window_second == second else 1
+        self._window = (second, count)
+        return count > self.rate_limit
+
+
+def weather_response(lat: float, lon: float) -> dict:
+    """Current weather response shaped like OpenWeather's, the values depend only on the coordinates."""
+    wave = math.sin(lat * 7.3) * math.cos(lon * 5.1)
+    return {
+        "coord": {"lat": lat, "lon": lon},
+        "weather": [{"id": 500, "main": "Rain", "description": "light rain", "icon": "10d"}],
+        "main": {
+            "temp": round(10 + 8 * wave, 2),
+            "feels_like": round(9 + 8 * wave, 2),
+            "temp_min": round(8 + 8 * wave, 2),
+            "temp_max": round(12 + 8 * wave, 2),
+            "pressure": 1000 + int(20 * wave),
+            "humidity": 60 + int(30 * wave),
+        },
+        "visibility": 10000 - int(5000 * abs(wave)),
+        "wind": {"speed": round(abs(12 * wave), 2), "deg": int(180 + 180 * wave)},
+        "rain": {"1h": round(max(wave, 0) * 4, 2)},
+        "clouds": {"all": 75},
+        "dt": int(time.time()),
+        "name": "Benchmark",
+        "cod": 200,
+    }
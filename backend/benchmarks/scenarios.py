@@ -0,0 +1,201 @@
+"""
+Benchmark scenarios of the backend hot paths. Imported by `benchmarks.suite` after it has
+configured the environment, the app reads its settings when it is imported.
+
+Zones are stored in mongomock collections swapped into `mongo_db` like the tests swap
+the database, requests go through the ASGI app without a network or a lifespan.
+"""
+
+import asyncio
+import datetime
+import math
+import random
+import statistics
+import sys
+import time
+import httpx
+from mongomock_motor import AsyncMongoMockClient
+from app.background import Background
+from app.client.mongo import mongo_db
+from app.client.weather_cache import weather_cache
+from app.main import app
+from app.routers.zones import create_sub_zone_grid, create_sub_zones
+from app.types.zone_types import METERS_PER_DEGREE, AutoGroupPayload, Zone, ZoneType, create_zone_bbox
+from app.zone_index import zone_index
+
+SOUTH_WEST = (51.0, -1.0)
+CELL_SIZE = 1000  # meters, sampling size of the benchmark auto groups
+GROUP_CELLS = 10_000  # sub-zones per auto group, larger sizes are split into more groups
+
+
+def use_memory_store():
+    """Replaces the MongoDB collections used by the app with empty in-memory ones."""
+    mongo_db._client = AsyncMongoMockClient()
+    mongo_db._db = mongo_db._client["gaof-db-benchmark"]
+    mongo_db._zones = mongo_db._db["zones"]
+    mongo_db._sub_zones = mongo_db._db["sub_zones"]
+    zone_index.invalidate()
+    weather_cache.clear()
+
+
+def square_rect(south_west: tuple[float, float], cells: int) -> list[float]:
+    """Rectangle holding about `cells` sub-zones of CELL_SIZE."""
+    side = math.sqrt(cells) * CELL_SIZE
+    lat, lon = south_west
+    return [
+        lat,
+        lon,
+        lat + side / METERS_PER_DEGREE,
+        lon + side / (METERS_PER_DEGREE * math.cos(math.radians(lat))),
+    ]
+
+
+async def insert_groups(sub_zones: int, next_refresh: datetime.datetime = None) -> list[Zone]:
+    """Stores auto groups with `sub_zones` sub-zones in total, placed side by side to the north."""
+    groups = []
+    lat, lon = SOUTH_WEST
+    for start in range(0, sub_zones, GROUP_CELLS):
+        rect = square_rect((lat, lon), min(GROUP_CELLS, sub_zones - start))
+        zone = Zone(
+            name=f"benchmark-{len(groups)}",
+            zone_type=ZoneType.AUTO_GROUP,
+            bbox=create_zone_bbox(rect),
+            payload=AutoGroupPayload(
+                sampling_size=CELL_SIZE,
+                refresh_rate=600,
+                next_refresh=next_refresh or datetime.datetime.now() + datetime.timedelta(hours=1),
+                sub_zone_type=ZoneType.WEATHER,
+                grid=create_sub_zone_grid(rect, CELL_SIZE),
+            ),
+        )
+        groups.append(await mongo_db.insert_zone(zone))
+        lat = rect[2]
+
+    return groups
+
+
+def app_client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark", timeout=None)
+
+
+def summarize(durations: list[float]) -> dict:
+    ordered = sorted(durations)
+    return {
+        "count": len(ordered),
+        "mean_s": statistics.fmean(ordered),
+        "p50_s": ordered[len(ordered) // 2],
+        "p95_s": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)],
+        "min_s": ordered[0],
+    }
+
+
+async def bench_near_zones(sub_zones: int, queries: int, radius: float = 5000) -> dict:
+    use_memory_store()
+    groups = await insert_groups(sub_zones)
+    south, west = groups[0].bbox.south_west.lat, groups[0].bbox.south_west.lon
+    north, east = groups[-1].bbox.north_east.lat, groups[-1].bbox.north_east.lon
+
+    rng = random.Random(sub_zones)
+    durations, returned = [], []
+    async with app_client() as client:
+        started = time.perf_counter()
+        response = await client.post("/near_zones", params={"lat": south, "lon": west, "radius": radius}, json=[])
+        response.raise_for_status()
+        cold = time.perf_counter() - started  # includes loading the zone index
+
+        for _ in range(queries):
+            params = {"lat": rng.uniform(south, north), "lon": rng.uniform(west, east), "radius": radius}
+            started = time.perf_counter()
+            response = await client.post("/near_zones", params=params, json=[])
+            response.raise_for_status()
+            durations.append(time.perf_counter() - started)
+            returned.append(len(response.json()))
+
+    return {
+        "name": "near_zones",
+        "params": {"sub_zones": sub_zones, "radius": radius},
+        "metrics": {"cold_s": cold, **summarize(durations), "returned_mean": statistics.fmean(returned)},
+    }
+
+
+async def bench_create_sub_zones(sub_zones: int, repeat: int) -> dict:
+    rect = square_rect(SOUTH_WEST, sub_zones)
+    grid_durations, list_durations = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        grid = create_sub_zone_grid(rect, CELL_SIZE)
+        grid_durations.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        create_sub_zones("benchmark", ZoneType.WEATHER, rect, CELL_SIZE)
+        list_durations.append(time.perf_counter() - started)
+
+    return {
+        "name": "create_sub_zones",
+        "params": {"sub_zones": grid.cell_count},
+        "metrics": {"grid_min_s": min(grid_durations), "list_min_s": min(list_durations)},
+    }
+
+
+async def bench_refresh_cycle(sub_zones: int, server) -> dict:
+    """Time for a Background task to refresh all due groups once, upstream calls go to the fake server."""
+    use_memory_store()
+    started_at = datetime.datetime.now()
+    groups = await insert_groups(sub_zones, next_refresh=started_at - datetime.timedelta(seconds=1))
+    pending = {
+        "zone_type": ZoneType.AUTO_GROUP,
+        "$or": [{"lease": {"$exists": True}}, {"payload.next_refresh": {"$lte": started_at}}],
+    }
+
+    upstream = server.stats()
+    started = time.perf_counter()
+    async with Background():
+        while await mongo_db._zones.count_documents(pending):
+            await asyncio.sleep(0.01)
+    duration = time.perf_counter() - started
+    upstream = {name: value - upstream[name] for name, value in server.stats().items()}
+
+    return {
+        "name": "refresh_cycle",
+        "params": {"sub_zones": sub_zones, "groups": len(groups)},
+        "metrics": {
+            "duration_s": duration,
+            "upstream_requests": upstream["requests"],
+            "throttled": upstream["throttled"],
+        },
+    }
+
+
+async def bench_list_zones(sub_zones: int, repeat: int) -> dict:
+    use_memory_store()
+    await insert_groups(sub_zones)
+
+    metrics = {}
+    async with app_client() as client:
+        for variant, params in (("expanded", {}), ("compact", {"compact_grid": "true"})):
+            durations = []
+            for _ in range(repeat + 1):
+                started = time.perf_counter()
+                response = await client.get("/list_zones", params=params)
+                response.raise_for_status()
+                durations.append(time.perf_counter() - started)
+
+            # the first request serializes the zones, later ones are served from the cached JSON
+            metrics[variant] = {
+                "cold_s": durations[0],
+                "warm_min_s": min(durations[1:]),
+                "bytes": len(response.content),
+            }
+
+    return {"name": "list_zones", "params": {"sub_zones": sub_zones}, "metrics": metrics}
+
+
+async def run(sizes: list[int], queries: int, repeat: int, server) -> list[dict]:
+    results = []
+    for sub_zones in sizes:
+        results.append(await bench_near_zones(sub_zones, queries))
+        results.append(await bench_create_sub_zones(sub_zones, repeat))
+        results.append(await bench_refresh_cycle(sub_zones, server))
+        results.append(await bench_list_zones(sub_zones, repeat))
+        print(f"{sub_zones} sub-zones done", file=sys.stderr)
+    return results
@@ -0,0 +1,87 @@
+"""
+Compares serialization of zone documents for the read endpoints:
+validating them as Zone and dumping them back (the former path) against
+converting the raw documents to JSON directly.
+
+    cd backend && python -m benchmarks.serialization --groups 20 --sampling 1000
+"""
+
+import argparse
+import datetime
+import json
+import time
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+from app.types.zone_types import AutoGroupPayload, TemperaturePayload, Zone, ZoneType, create_zone_bbox
+from app.zone_json import dumps_zone_document
+
+
+def make_zone_docs(groups: int, sub_zones: int) -> list[dict]:
+    zone_docs = []
+    for group in range(groups):
+        payload = AutoGroupPayload(
+            sampling_size=1000,
+            refresh_rate=600,
+            next_refresh=datetime.datetime.now(),
+            sub_zone_type=ZoneType.TEMPERATURE,
+            zones=[
+                Zone(
+                    name=f"group-{group}_{i}",
+                    zone_type=ZoneType.TEMPERATURE,
+                    bbox=create_zone_bbox([51.0 + i * 0.01, 0.1, 51.01 + i * 0.01, 0.11]),
+                    payload=TemperaturePayload(temp=7.5, temp_min=6.1, temp_max=8.0, pressure=1012, humidity=70),
+                )
+                for i in range(sub_zones)
+            ],
+        )
+        zone = Zone(
+            name=f"group-{group}",
+            zone_type=ZoneType.AUTO_GROUP,
+            bbox=create_zone_bbox([51.0, 0.1, 52.0, 0.2]),
+            payload=payload,
+        )
+        zone_doc = zone.model_dump(exclude_none=True, by_alias=True)
+        zone_doc["_id"] = ObjectId()
+        zone_docs.append(zone_doc)
+    return zone_docs
+
+
+def validate_then_dump(zone_docs: list[dict]) -> bytes:
+    out_zones = [Zone(**zone_doc).model_dump(exclude_none=True) for zone_doc in zone_docs]
+    return json.dumps(jsonable_encoder(out_zones)).encode()
+
+
+def raw_dump(zone_docs: list[dict]) -> bytes:
+    return b"[" + b",".join(dumps_zone_document(zone_doc) for zone_doc in zone_docs) + b"]"
+
+
+def measure(func, zone_docs: list[dict], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func(zone_docs)
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--sampling", type=int, default=1000, help="sub-zones per group")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    zone_docs = make_zone_docs(args.groups, args.sampling)
+    assert json.loads(validate_then_dump(zone_docs)) == json.loads(raw_dump(zone_docs))
+
+    results = {
+        "zones": args.groups * (args.sampling + 1),
+        "validate_then_dump_s": measure(validate_then_dump, zone_docs, args.repeat),
+        "raw_dump_s": measure(raw_dump, zone_docs, args.repeat),
+    }
+    results["speedup"] = results["validate_then_dump_s"] / results["raw_dump_s"]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Offline benchmark suite of the backend hot paths: /near_zones, creating sub-zones,
+a full Background refresh cycle and /list_zones, each at the given numbers of sub-zones.
+
+No MongoDB or OpenWeather API key is needed, zones are kept in an in-memory mongomock
+store and weather is served by a local fake OpenWeather server. Results are printed
+as JSON and optionally written to a file, so they can be compared across releases.
+
+    cd backend && pip install -r benchmarks/requirements.txt
+    python -m benchmarks.suite --sizes 1000,10000,100000 --latency 0.02 --output results.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import subprocess
+from benchmarks.fake_openweather import FakeOpenWeather
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated numbers of sub-zones")
+    parser.add_argument("--queries", type=int, default=50, help="/near_zones queries per size")
+    parser.add_argument("--repeat", type=int, default=3, help="repetitions of the other measurements")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds of the fake OpenWeather latency")
+    parser.add_argument("--jitter", type=float, default=0.0, help="seconds of random latency variation")
+    parser.add_argument("--rate-limit", type=int, default=0, help="fake OpenWeather requests per second, 0 unlimited")
+    parser.add_argument("--calls-per-minute", type=int, default=0, help="WEATHER_CALLS_PER_MINUTE, 0 unlimited")
+    parser.add_argument("--output", help="file the JSON results are written to")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    with FakeOpenWeather(args.latency, args.jitter, args.rate_limit) as server:
+        # the app reads its settings on import
+        os.environ["OPEN_WEATHER_URL"] = server.url
+        os.environ["OPEN_WEATHER_API_KEY"] = "benchmark"
+        os.environ["WEATHER_CALLS_PER_MINUTE"] = str(args.calls_per_minute)
+        os.environ.setdefault("MONGODB_CONNECTION_STRING", "mongodb://localhost:27017/")  # never connected
+        os.environ.setdefault("MAX_SUB_ZONES", str(max(sizes)))
+
+        from benchmarks import scenarios
+
+        results = asyncio.run(scenarios.run(sizes, args.queries, args.repeat, server))
+
+    report = {
+        "suite": "backend",
+        "started_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "rate_limit": args.rate_limit,
+            "calls_per_minute": args.calls_per_minute,
+        },
+        "results": results,
+    }
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ export enum ZoneType {
     rain = "rain",
     visibility = "visibility",
     temperature = "temperature",
+    weather = "weather",
     auto_group = "auto_group",
 }
 